@@ -0,0 +1,354 @@
+import collections
+import logging
+import os
+import struct
+
+import numpy as np
+import cv2 as cv
+
+# Indexes of the last uncompressed AVI files opened (see rawIndex)
+INDEX_CACHE = collections.OrderedDict()
+INDEX_CACHE_SIZE = 4
+
+
+class AviIndex:
+
+    # Index of the chunks of an AVI file (RIFF AVI and OpenDML AVIX parts): the format of
+    # its first video stream and the offset (of the data) and the size of each one of its
+    # frame chunks, in file order. With raw, a compressed video stream (or not of 8 or 24
+    # bits per pixel) raises as soon as its format is read.
+
+    def __init__(self, path, raw=False):
+        self.path = str(path)
+        self.raw = raw
+        self.map = np.memmap(self.path, np.uint8, "r")
+        self.chunks = []
+
+        if self.map[0:4].tobytes() != b"RIFF" or self.map[8:12].tobytes() != b"AVI ":
+            raise Exception("Not an AVI file: " + self.path)
+
+        self.width = 0
+        self.height = 0
+        self.bitCount = 0
+        self.compression = 0
+        self.palette = None
+        self.fps = 0.
+        self.numStreams = 0
+        self.stream = None
+        self.readChunks(12, self.chunkEnd(0))
+
+        # Next RIFF AVIX parts of the OpenDML files
+        start = self.chunkEnd(0)
+        while start + 12 <= self.map.size and self.map[start:start+4].tobytes() == b"RIFF":
+            if self.map[start+8:start+12].tobytes() == b"AVIX":
+                self.readChunks(start+12, self.chunkEnd(start))
+            start = self.chunkEnd(start)
+
+        if self.width == 0:
+            raise Exception("The AVI file has not a video stream: " + self.path)
+
+        # The offsets and sizes are kept in an array (16 bytes per frame), not the map
+        self.chunks = np.array(self.chunks, np.int64).reshape(-1, 2)
+        self.map = None
+
+    def chunkEnd(self, start):
+        # Chunks are padded to an even size
+        size = struct.unpack_from("<I", self.map, start+4)[0]
+        return start + 8 + size + (size & 1)
+
+    def readChunks(self, start, end):
+        end = min(end, self.map.size)
+        while start + 8 <= end:
+            fourcc = self.map[start:start+4].tobytes()
+
+            if fourcc == b"LIST":
+                listType = self.map[start+8:start+12].tobytes()
+                if listType in (b"hdrl", b"strl", b"movi", b"rec "):
+                    self.readChunks(start+12, self.chunkEnd(start))
+            elif fourcc == b"strh":
+                # First video stream, its chunks are named NNdb or NNdc (NN: number of the stream)
+                (fccType, _handler, _flags, _priority, _language, _initial, scale, rate) = struct.unpack_from("<4s4sIHHIII", self.map, start+8)
+                if fccType == b"vids" and self.stream is None:
+                    self.stream = "{:02d}".format(self.numStreams).encode()
+                    self.fps = rate/scale if scale > 0 else 0.
+                self.numStreams += 1
+            elif fourcc == b"strf" and self.stream == "{:02d}".format(self.numStreams-1).encode():
+                (size, self.width, self.height, _planes, self.bitCount, self.compression) = struct.unpack_from("<IiiHHI", self.map, start+8)
+                if self.raw and (self.bitCount not in (8, 24) or self.compression not in (0, 0x20424944)):  # BI_RGB or 'DIB '
+                    raise Exception("The AVI file is compressed or has not 8 or 24 bits per pixel: " + self.path)
+                # Palette (BGRx colors) of the 8-bit frames after the header
+                if self.bitCount == 8:
+                    nColors = struct.unpack_from("<I", self.map, start+8+32)[0] or 256
+                    nColors = min(nColors, 256, (self.chunkEnd(start) - (start+8+size))//4)
+                    self.palette = np.array(self.map[start+8+size:start+8+size+4*nColors]).reshape(nColors, 4)
+            elif fourcc[:2] == self.stream and fourcc[2:] in (b"db", b"dc"):
+                self.chunks.append((start+8, struct.unpack_from("<I", self.map, start+4)[0]))
+
+            start = self.chunkEnd(start)
+
+
+def rawIndex(path):
+
+    # Index of an uncompressed AVI file, walked once per path, size and modification time (the video is
+    # opened several times per run). Only the last INDEX_CACHE_SIZE indexes are kept.
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key in INDEX_CACHE:
+        INDEX_CACHE.move_to_end(key)
+        return INDEX_CACHE[key]
+
+    index = AviIndex(path, raw=True)
+    INDEX_CACHE[key] = index
+    while len(INDEX_CACHE) > INDEX_CACHE_SIZE:
+        INDEX_CACHE.popitem(last=False)
+
+    return index
+
+
+class AviReader:
+
+    # Reader of uncompressed 8-bit (gray or paletted) and 24-bit AVI files (RIFF AVI and
+    # OpenDML AVIX parts) with the same interface as the used parts of cv.VideoCapture. The
+    # file is memory mapped and the frames are returned as views of the map (read-only, no
+    # copy), so a crop of a frame is a slice. The 8-bit frames are returned as gray images
+    # (2 dimensions), a copy only if the palette is not the gray ramp. The offsets of all the
+    # frames are indexed when the file is opened, so any frame can be read in O(1).
+
+    def __init__(self, path):
+        self.path = str(path)
+        index = rawIndex(self.path)
+
+        self.map = np.memmap(self.path, np.uint8, "r")
+        self.position = 0
+        self.frame = None
+        (self.width, self.height, self.fps) = (index.width, index.height, index.fps)
+        self.channels = index.bitCount//8
+
+        # Gray levels of the palette colors (None for the gray ramp)
+        self.lut = None
+        if index.palette is not None:
+            lut = np.zeros(256, np.uint8)
+            lut[:len(index.palette)] = cv.cvtColor(np.ascontiguousarray(index.palette[:, None, :3]), cv.COLOR_BGR2GRAY).ravel()
+            if not np.array_equal(lut, np.arange(256)):
+                self.lut = lut
+
+        # Size of the frame rows (padded to 4 bytes) and order (bottom-up if the height is positive)
+        self.stride = ((self.width*self.channels + 3)//4)*4
+        self.bottomUp = self.height > 0
+        self.height = abs(self.height)
+
+        # Empty chunks are dropped frames, repeat the previous one
+        frameSize = self.stride*self.height
+        (offsets, sizes) = (index.chunks[:, 0], index.chunks[:, 1])
+        numbers = np.arange(len(sizes))
+        truncated = np.flatnonzero((sizes < frameSize) & ((sizes > 0) | (numbers == 0)))
+        if truncated.size > 0:
+            raise Exception("The frame " + str(truncated[0]) + " of the AVI file is truncated: " + self.path)
+        self.offsets = offsets[np.maximum.accumulate(np.where(sizes > 0, numbers, 0))] if len(sizes) > 0 else offsets
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def getFrame(self, index):
+        offset = self.offsets[index]
+        frame = self.map[offset:offset+self.stride*self.height].reshape(self.height, self.stride)
+        if self.channels == 1:
+            frame = frame[:, :self.width]
+        else:
+            frame = frame[:, :self.width*3].reshape(self.height, self.width, 3)
+        if self.bottomUp:
+            frame = frame[::-1]
+        if self.lut is not None:
+            return cv.LUT(np.ascontiguousarray(frame), self.lut)
+        return np.asarray(frame)
+
+    # cv.VideoCapture interface
+
+    def isOpened(self):
+        return self.map is not None
+
+    def grab(self):
+        if self.map is None or self.position >= len(self.offsets):
+            self.frame = None
+            return False
+        self.frame = self.position
+        self.position += 1
+        return True
+
+    def retrieve(self):
+        if self.frame is None:
+            return False, None
+        return True, self.getFrame(self.frame)
+
+    def read(self):
+        if not self.grab():
+            return False, None
+        return self.retrieve()
+
+    def get(self, prop):
+        if prop == cv.CAP_PROP_POS_FRAMES:
+            return float(self.position)
+        if prop == cv.CAP_PROP_FRAME_COUNT:
+            return float(len(self.offsets))
+        if prop == cv.CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        if prop == cv.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        if prop == cv.CAP_PROP_FPS:
+            return self.fps
+        return 0.
+
+    def set(self, prop, value):
+        if prop != cv.CAP_PROP_POS_FRAMES:
+            return False
+        self.position = min(max(int(value), 0), len(self.offsets))
+        return True
+
+    def release(self):
+        self.map = None
+        self.frame = None
+
+
+class AviWriter:
+
+    # Writer of RIFF AVI files of one video stream (idx1 index) with the interface of cv.VideoWriter.
+    # The frame chunks are written as they come (writeChunk) and the sizes and the number of frames of
+    # the headers are updated when the file is released. The stream format is given by the handler and
+    # the BITMAPINFOHEADER fields (bufferSize is the suggested buffer size, 0 if unknown).
+
+    def __init__(self, path, fps, frameSize, handler, bitCount, compression, sizeImage, bufferSize=0, palette=b""):
+        self.path = str(path)
+        (self.width, self.height) = frameSize
+        self.index = []
+
+        rate = int(round(fps*1000))
+        avih = struct.pack("<14I", int(round(1e6/fps)), int(bufferSize*fps), 0, 0x10, 0, 0, 1, bufferSize, self.width, self.height, 0, 0, 0, 0)
+        strh = struct.pack("<4s4sIHHIIIIIIII4h", b"vids", handler, 0, 0, 0, 0, 1000, rate, 0, 0, bufferSize, 0xFFFFFFFF, 0,
+                           0, 0, self.width, self.height)
+        strf = struct.pack("<IiiHHIIiiII", 40, self.width, self.height, 1, bitCount, compression, sizeImage, 0, 0, len(palette)//4, 0) + palette
+        strl = b"strl" + chunk(b"strh", strh) + chunk(b"strf", strf)
+        self.header = chunk(b"LIST", b"hdrl" + chunk(b"avih", avih) + chunk(b"LIST", strl))
+
+        self.file = open(self.path, "wb")
+        self.file.write(b"RIFF" + struct.pack("<I", 0) + b"AVI ")
+        self.file.write(self.header)
+        self.moviStart = self.file.tell()
+        self.file.write(b"LIST" + struct.pack("<I", 0) + b"movi")
+
+    def isOpened(self):
+        return self.file is not None
+
+    def writeChunk(self, fourcc, data):
+        # Offsets of the index from the movi list type
+        self.index.append(struct.pack("<4sIII", fourcc, 0x10, self.file.tell() - self.moviStart - 8, len(data)))
+        self.file.write(chunk(fourcc, data))
+
+        if self.file.tell() > 0xFFFFFFFF - 16*len(self.index):
+            raise Exception("The video is too large for a RIFF AVI file: " + self.path)
+
+    def release(self):
+        if self.file is None:
+            return
+
+        # Sizes of the movi list, the index and the RIFF file
+        moviEnd = self.file.tell()
+        self.file.write(chunk(b"idx1", b"".join(self.index)))
+        fileEnd = self.file.tell()
+
+        self.file.seek(4)
+        self.file.write(struct.pack("<I", fileEnd - 8))
+        self.file.seek(self.moviStart + 4)
+        self.file.write(struct.pack("<I", moviEnd - self.moviStart - 8))
+
+        # Number of frames of the main header and the stream header
+        self.file.seek(12 + 12 + 8 + 16)
+        self.file.write(struct.pack("<I", len(self.index)))
+        self.file.seek(12 + 12 + 8 + 56 + 12 + 8 + 32)
+        self.file.write(struct.pack("<I", len(self.index)))
+
+        self.file.close()
+        self.file = None
+
+
+class MjpgWriter(AviWriter):
+
+    # Writer of MJPG AVI files. Each frame is compressed alone by cv.imencode, so the frame chunks
+    # of several files of the same size can be concatenated without decoding them (see joinAvi).
+
+    def __init__(self, path, fps, frameSize, quality=95):
+        (width, height) = frameSize
+        AviWriter.__init__(self, path, fps, frameSize, b"MJPG", 24, 0x47504A4D, width*height*3)
+        self.params = [cv.IMWRITE_JPEG_QUALITY, quality]
+
+    def write(self, frame):
+        if frame.shape[:2] != (self.height, self.width):
+            raise Exception("The frame size differs from the video size.")
+
+        _ret, data = cv.imencode(".jpg", frame, self.params)
+        self.writeChunk(b"00dc", data.tobytes())
+
+
+def chunk(fourcc, data):
+
+    # RIFF chunk padded to an even size
+    return fourcc + struct.pack("<I", len(data)) + data + (b"\x00" if len(data) & 1 else b"")
+
+
+def joinAvi(partPaths, videoPath, fps):
+
+    # Concatenate the MJPG videos (of the same frame size) in one file without decoding them,
+    # copying the frame chunks of each part and rebuilding the index
+    parts = [AviIndex(partPath) for partPath in partPaths]
+    out = MjpgWriter(videoPath, fps, (parts[0].width, abs(parts[0].height)))
+    try:
+        for part in parts:
+            with open(part.path, "rb") as f:
+                for (offset, size) in part.chunks:
+                    f.seek(offset)
+                    out.writeChunk(b"00dc", f.read(size))
+    finally:
+        out.release()
+
+
+def openVideo(videoPath):
+
+    # Open the uncompressed AVI files with the memory-mapped reader, the others with OpenCV
+    try:
+        return AviReader(videoPath)
+    except Exception as e:
+        logging.info("Reading the video with OpenCV (" + str(e) + ").")
+        return cv.VideoCapture(str(videoPath))
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s: %(message)s (%(funcName)s:%(lineno)d)"
+    )
+
+    videoPath = "./test/testVideo.avi"
+
+    # Compare the frames of the reader with the OpenCV ones
+    vid = openVideo(videoPath)
+    ref = cv.VideoCapture(videoPath)
+
+    numFrame = 0
+    _ret, frame = vid.read()
+    _ret, refFrame = ref.read()
+    while frame is not None and refFrame is not None:
+        numFrame += 1
+        if frame.ndim == 2:
+            frame = cv.cvtColor(frame, cv.COLOR_GRAY2BGR)
+        if not np.array_equal(frame, refFrame):
+            raise Exception("The frame " + str(numFrame) + " differs from the OpenCV one.")
+        _ret, frame = vid.read()
+        _ret, refFrame = ref.read()
+
+    if (frame is None) != (refFrame is None):
+        raise Exception("The number of frames differs from the OpenCV one.")
+
+    vid.release()
+    ref.release()
+
+    logging.info(str(numFrame) + " frames equal to the OpenCV ones.")
@@ -0,0 +1,246 @@
+import argparse
+import concurrent.futures
+import datetime
+import json
+import logging
+import os
+import pathlib
+import time
+
+import cv2 as cv
+
+import config
+from swimTunnel import swimTunnel
+from treatData import treatData
+
+# Job states of the manifest
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+LOG_FORMAT = "[%(asctime)s] %(levelname)s: %(message)s (%(funcName)s:%(lineno)d)"
+
+
+def loadManifest(manifestPath):
+
+    # Manifest of a batch: {"exportPath": ..., "jobs": [{"video", "expID", "roi", "contrast", "fps", "status", ...}]}
+    with open(str(manifestPath)) as f:
+        manifest = json.load(f)
+
+    if "jobs" not in manifest:
+        raise Exception("The manifest has not a jobs list: " + str(manifestPath))
+
+    return manifest
+
+
+def saveManifest(manifest, manifestPath):
+
+    # Write a temporary file and replace the manifest, so an interrupted batch never leaves it truncated
+    manifestPath = pathlib.Path(manifestPath)
+    tmpPath = manifestPath.with_name(manifestPath.name + ".tmp")
+    with open(str(tmpPath), "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(str(tmpPath), str(manifestPath))
+
+
+def scanVideos(videoDir, roi=None, contrast=None, fps=None):
+
+    # One job per AVI video of the directory, the expID is the name of the video
+    jobs = []
+    for videoPath in sorted(pathlib.Path(videoDir).glob("*.avi")):
+        jobs.append({"video": str(videoPath), "expID": videoPath.stem, "roi": roi, "contrast": contrast, "fps": fps})
+
+    if len(jobs) == 0:
+        raise Exception("There are not AVI videos in the directory: " + str(videoDir))
+
+    return jobs
+
+
+def mergeJobs(manifest, jobs):
+
+    # Add the new jobs to the manifest, keeping the state of the known ones
+    known = {job["expID"] for job in manifest["jobs"]}
+    for job in jobs:
+        if job["expID"] not in known:
+            manifest["jobs"].append(job)
+            known.add(job["expID"])
+
+    return manifest
+
+
+def checkJobs(jobs, defaultFps):
+
+    # Complete the jobs with the defaults and check them before running any
+    expIDs = set()
+    for job in jobs:
+        if job["expID"] in expIDs:
+            raise Exception("The expID " + job["expID"] + " is repeated in the batch.")
+        expIDs.add(job["expID"])
+
+        job.setdefault("status", PENDING)
+        if job.get("fps") is None:
+            job["fps"] = defaultFps
+        if job.get("contrast") is None:
+            job["contrast"] = config.DEFAULT_CONTRAST
+        if not (0 < job["fps"] <= 1000):
+            raise Exception("The fps value must be in [1,1000]: " + job["expID"])
+        if job.get("roi") is not None and len(job["roi"]) != 4:
+            raise Exception("The ROI must be [x, y, w, h]: " + job["expID"])
+
+    return jobs
+
+
+def fullFrameRoi(videoPath):
+
+    # Region of interest covering the whole frame
+    vid = cv.VideoCapture(str(videoPath))
+    if not vid.isOpened():
+        vid.release()
+        raise Exception("Could not open the video reference: " + str(videoPath))
+    roi = (0, 0, int(vid.get(cv.CAP_PROP_FRAME_WIDTH)), int(vid.get(cv.CAP_PROP_FRAME_HEIGHT)))
+    vid.release()
+
+    return roi
+
+
+def runJob(job, exportPath, legacyExport=False, streaming=False, writeCsv=False):
+
+    # Extract and treat one experiment in a worker process, logging in the experiment log file
+    expID = job["expID"]
+    pathlib.Path(exportPath, expID, "logs").mkdir(parents=True, exist_ok=True)
+
+    logger = logging.getLogger()
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+    handler = logging.FileHandler(str(pathlib.Path(exportPath, expID, "logs", "log_file.log")))
+    handler.setFormatter(logging.Formatter(LOG_FORMAT, "%m/%d/%Y %H:%M:%S"))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+    tic = time.perf_counter()
+    try:
+        if job.get("roi") is None:
+            roi = fullFrameRoi(job["video"])
+            logging.warning("No ROI given, using the whole frame: " + str(roi))
+        else:
+            roi = tuple(int(v) for v in job["roi"])
+
+        failedFrames, contrast = swimTunnel(job["video"], exportPath, expID, job["fps"], roi, contrast=job["contrast"], headless=True,
+                                            legacyExport=legacyExport, streaming=streaming, writeCsv=writeCsv)
+        if not streaming:
+            treatData(exportPath, expID, job["fps"], contrast, failedFrames, writeCsv=writeCsv)
+        logging.info("The video has been processed.")
+    except Exception as err:
+        logging.error(err)
+        return {"status": FAILED, "error": str(err), "seconds": time.perf_counter() - tic}
+    finally:
+        logger.removeHandler(handler)
+        handler.close()
+
+    return {"status": DONE, "failedFrames": failedFrames, "contrast": contrast, "seconds": time.perf_counter() - tic}
+
+
+def runBatch(manifest, manifestPath, workers=None, retryFailed=False, legacyExport=False, streaming=False, writeCsv=False):
+
+    # Run the unfinished jobs in a pool of processes, saving the manifest after each job.
+    # The running jobs of an interrupted batch are run again.
+    workers = os.cpu_count() if workers is None else workers
+    exportPath = manifest["exportPath"]
+    states = (PENDING, RUNNING, FAILED) if retryFailed else (PENDING, RUNNING)
+    jobs = [job for job in manifest["jobs"] if job["status"] in states]
+
+    logging.info("Batch: " + str(len(jobs)) + " of " + str(len(manifest["jobs"])) + " jobs to run in " + str(workers) + " processes.")
+    if len(jobs) == 0:
+        return manifest
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for job in jobs:
+            job["status"] = RUNNING
+            job.pop("error", None)
+            futures[pool.submit(runJob, dict(job), exportPath, legacyExport, streaming, writeCsv)] = job
+        saveManifest(manifest, manifestPath)
+
+        for future in concurrent.futures.as_completed(futures):
+            job = futures[future]
+            try:
+                result = future.result()
+            except Exception as err:  # i.e. a crashed worker process
+                result = {"status": FAILED, "error": str(err)}
+            result["finished"] = datetime.datetime.now().isoformat(timespec="seconds")
+            job.update(result)
+            saveManifest(manifest, manifestPath)
+
+            done = sum(job["status"] == DONE for job in manifest["jobs"])
+            logging.info(job["expID"] + ": " + job["status"] + (" (" + job["error"] + ")" if job["status"] == FAILED else "") + ". "
+                         + str(done) + "/" + str(len(manifest["jobs"])) + " jobs done.")
+
+    return manifest
+
+
+def parseArgs():
+
+    parser = argparse.ArgumentParser(description="Extract and treat a batch of swimming-tunnel videos.")
+    parser.add_argument("input", help="directory of AVI videos or JSON manifest of a batch")
+    parser.add_argument("-o", "--export", default="./export/", help="export path of the experiments (new batches)")
+    parser.add_argument("-m", "--manifest", help="manifest of the batch (default: <export>/batch_manifest.json)")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of processes (default: number of CPUs)")
+    parser.add_argument("--fps", type=int, default=1000, help="fps of the videos without fps")
+    parser.add_argument("--contrast", type=float, default=None, help="contrast of the videos without contrast")
+    parser.add_argument("--roi", type=int, nargs=4, metavar=("X", "Y", "W", "H"), default=None, help="ROI of the videos without ROI")
+    parser.add_argument("--retry-failed", action="store_true", help="run again the failed jobs")
+    parser.add_argument("--legacy", action="store_true", help="also save one skeleton file per frame")
+    # Switches with a default of config.py, each one can be turned on and off (--x/--no-x)
+    # (argparse.BooleanOptionalAction needs Python 3.9)
+    switches = (
+        ("stream", config.STREAMING_TREATMENT, "treat the data during the extraction", "treat the data after the extraction"),
+        ("csv", config.EXPORT_CSV, "also export the treated data in a csv file", "do not export the csv file")
+    )
+    for (name, default, helpOn, helpOff) in switches:
+        group = parser.add_mutually_exclusive_group()
+        group.add_argument("--" + name, dest=name, action="store_true", help=helpOn + (" (default)" if default else ""))
+        group.add_argument("--no-" + name, dest=name, action="store_false", help=helpOff + ("" if default else " (default)"))
+        parser.set_defaults(**{name: default})
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format=LOG_FORMAT
+    )
+
+    args = parseArgs()
+    inputPath = pathlib.Path(args.input)
+
+    if inputPath.is_dir():
+        # New batch (or resumed one) from a directory of videos
+        manifestPath = pathlib.Path(args.manifest) if args.manifest else pathlib.Path(args.export, "batch_manifest.json")
+        manifest = loadManifest(manifestPath) if manifestPath.exists() else {"exportPath": args.export, "jobs": []}
+        mergeJobs(manifest, scanVideos(inputPath, args.roi, args.contrast, args.fps))
+    else:
+        # Batch of a manifest, its state is saved in the same file
+        manifestPath = inputPath
+        manifest = loadManifest(manifestPath)
+        manifest.setdefault("exportPath", args.export)
+        for job in manifest["jobs"]:
+            job.setdefault("expID", pathlib.Path(job["video"]).stem)
+            if job.get("roi") is None:
+                job["roi"] = args.roi
+            if job.get("contrast") is None:
+                job["contrast"] = args.contrast
+
+    checkJobs(manifest["jobs"], args.fps)
+    pathlib.Path(manifestPath).parent.mkdir(parents=True, exist_ok=True)
+    saveManifest(manifest, manifestPath)
+
+    runBatch(manifest, manifestPath, args.workers, args.retry_failed, args.legacy, args.stream, args.csv)
+
+    failed = [job["expID"] for job in manifest["jobs"] if job["status"] == FAILED]
+    if failed:
+        logging.warning("Failed jobs: " + ", ".join(failed))
+    logging.info("DONE.")
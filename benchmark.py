@@ -0,0 +1,1116 @@
+import csv
+import logging
+import pathlib
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import numpy as np
+import cv2 as cv
+from scipy.interpolate import CubicSpline
+
+try:
+    import resource
+except ImportError:  # not available under Windows
+    resource = None
+
+import config
+import stageTimer
+import swimTunnel as st
+import treatData as td
+from aviReader import openVideo
+from dataStore import SkeletonStore, resultPath, loadColumn, loadMeta, storePath
+from synthVideo import synthVideo, loadTruth, fishMidline, keyPoints
+
+# Stages of the extraction (per frame) and of the treatment (per experiment)
+EXTRACT_STAGES = ("decode", "crop", "preprocess", "getFishContours", "getFishSkeleton", "checkFrame", "export")
+TREAT_STAGES = ("importData", "computeAngle", "angleData")
+
+
+def equalNan(a, b):
+
+    # Element-wise equality with the NaNs of the same positions as equal
+    (a, b) = (np.asarray(a, float), np.asarray(b, float))
+    return a.shape == b.shape and bool(np.all((a == b) | (np.isnan(a) & np.isnan(b))))
+
+
+def checkFrameLoop(fishSkeleton, fishContours, fishContoursPrev):
+
+    # Reference (loop based) frame validator, the vectorized checkFrame must give the same results
+    if fishContours is None or fishSkeleton is None or fishContoursPrev is None:
+        return False
+
+    # Check the ressemblance of the blob detected fish shape in the previous frame
+    if cv.matchShapes(fishContours, fishContoursPrev, 3, 0.0) > 0.1:
+        return False
+
+    # Check if the fish rect. boundary contains the fish skeleton
+    (fx, fy, fw, fh) = cv.boundingRect(fishContours)
+    for i in range(np.size(fishSkeleton, 0)):
+        if not ((fx < fishSkeleton[i][0, 0] < (fx+fw)) and (fy < fishSkeleton[i][0, 1] < (fy+fh))):
+            return False
+
+    # Check if the skeleton contains branches
+    fishSkeleton = np.reshape(fishSkeleton, (np.size(fishSkeleton, 0), 2))  # convert the array-points to a matrix
+    fishSkeleton = fishSkeleton[np.argsort(fishSkeleton[:, 0])]  # sort points by x
+
+    for i in range(1, len(fishSkeleton)):
+        if (fishSkeleton[i-1, 0] == fishSkeleton[i, 0]) and (np.abs(fishSkeleton[i-1, 1]-fishSkeleton[i, 1])>3):
+            return False
+
+    return True
+
+
+def fishSkeletonFrame(frame):
+
+    # Reference skeleton of the whole frame thinning (the longest skeleton of all the blobs)
+    frame = cv.ximgproc.thinning(frame, thinningType=cv.ximgproc.THINNING_ZHANGSUEN)
+    contours, _hier = cv.findContours(frame, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)
+
+    maxLen = -1
+    for i in range(len(contours)):
+        length = cv.arcLength(contours[i], False)
+        if length > maxLen:
+            maxLen = length
+            iFishSkeleton = i
+
+    return contours[iFishSkeleton]
+
+
+def lenSKLoop(skeleton, proportion):
+
+    # Reference (loop based) key point sampler, the vectorized keyPointIndexes must give the same indexes
+    # Compute the length of the skeleton
+    skeletonLen = 0
+    for i in range(1,len(skeleton)):
+        skeletonLen += ((skeleton[i-1][0] - skeleton[i][0])**2 + (skeleton[i-1][1] - skeleton[i][1])**2)**(1/2)
+
+    # Compute the desired index point on proportion measure
+    measure = 0
+    for i in range(1,len(skeleton)):
+        measure += ((skeleton[i-1][0] - skeleton[i][0])**2 + (skeleton[i-1][1] - skeleton[i][1])**2)**(1/2)
+        if measure > skeletonLen*proportion:
+            point = i
+            break
+
+    return skeletonLen, point
+
+
+def uniqueMeanLoop(skeleton, fixed=True):
+
+    # Reference (loop based) uniqueMean. With fixed=False it takes the coords. of the i-th point
+    # instead of the ind-th one, as the original version did.
+    skmean = np.array([], int).reshape(0,2)
+
+    # Count the repeated coords. x and get they index
+    _sk, skind, skcounts = np.unique(skeleton[:,0], return_index=True, return_counts=True)
+
+    # Copy unique x coords. and assign the y coords mean
+    for i,ind in enumerate(skind):
+        row = ind if fixed else i
+        if skcounts[i] > 1: 
+            ymean = 0
+            for j in range(skcounts[i]):
+                ymean = ymean + skeleton[ind+j, 1]
+            skmean = np.vstack([skmean,[skeleton[row,0], int(ymean/skcounts[i])]])
+        else:  # if not repeated x
+            skmean = np.vstack([skmean,[skeleton[row,0], skeleton[row,1]]])
+
+    return skmean
+
+
+def computeAngleLoop(A, B, C, nValidFrames):
+
+    # Reference (loop based) computeAngle, the vectorized one must give the same angles (the
+    # degenerate frames, printed by the original version, are NaN here)
+    h = np.zeros(nValidFrames)
+    sinAlpha = np.zeros(nValidFrames)
+    ampl = np.zeros(nValidFrames)
+    alpha = np.zeros(nValidFrames)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for i in range(nValidFrames):
+            h[i] = np.sqrt(np.abs(C[i,0]-A[i,0])**2 + np.abs(C[i,1]-A[i,1])**2)
+            sinAlpha[i] = ((C[i,0]-A[i,0])*(B[i,1]-A[i,1]) - (B[i,0]-A[i,0])*(C[i,1]-A[i,1])) / (np.sqrt((C[i,0]-A[i,0])**2 + (C[i,1]-A[i,1])**2) * np.sqrt((B[i,0]-A[i,0])**2 + (B[i,1]-A[i,1])**2))
+            ampl[i] = h[i]*sinAlpha[i]
+            alpha[i] = np.rad2deg(np.arcsin(ampl[i]/np.sqrt(np.abs(C[i,0]-B[i,0])**2 + np.abs(C[i,1]-B[i,1])**2)))
+
+    return alpha, ampl
+
+
+def randomKeyPoints(nFrames, nDegenerate=0, seed=0):
+
+    # Head, joint and tail points of a swimming-like fish (integer pixel coords.), with some
+    # degenerate frames (joint on the head or tail on the joint)
+    rng = np.random.RandomState(seed)
+    headP = np.stack([rng.randint(400, 420, nFrames), -rng.randint(150, 160, nFrames)], 1)
+    jointP = headP + np.stack([rng.randint(90, 110, nFrames), rng.randint(-10, 11, nFrames)], 1)
+    tailP = jointP + np.stack([rng.randint(150, 200, nFrames), rng.randint(-60, 61, nFrames)], 1)
+
+    frames = rng.choice(nFrames, nDegenerate, replace=False)
+    jointP[frames[::2]] = headP[frames[::2]]
+    tailP[frames[1::2]] = jointP[frames[1::2]]
+
+    return headP, jointP, tailP
+
+
+def benchComputeAngle(headP, jointP, tailP, repeat=3):
+
+    # computeAngle against the loop reference (the angles must be the same, NaN in the degenerate frames)
+    nValidFrames = len(headP)
+
+    tLoop = np.inf
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        alphaLoop, amplLoop = computeAngleLoop(headP, jointP, tailP, nValidFrames)
+        tLoop = min(tLoop, time.perf_counter() - tic)
+
+    tVect = np.inf
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        alpha, ampl, degenerate = td.computeAngle(headP, jointP, tailP, nValidFrames)
+        tVect = min(tVect, time.perf_counter() - tic)
+
+    if not (np.all(np.isnan(alpha[degenerate])) and np.all(np.isnan(ampl[degenerate]))):
+        raise Exception("computeAngle has not NaN angles in the degenerate frames.")
+    if not (equalNan(alpha[~degenerate], alphaLoop[~degenerate]) and equalNan(ampl[~degenerate], amplLoop[~degenerate])):
+        raise Exception("computeAngle differs from the reference loop.")
+
+    alpha32 = td.computeAngle(headP, jointP, tailP, nValidFrames, np.float32)[0]
+    error32 = np.nanmax(np.abs(alpha32 - alpha)) if np.any(~degenerate) else 0.
+
+    logging.info("computeAngle: loop " + "{:.3f}".format(1e3*tLoop) + " ms, vectorized " + "{:.3f}".format(1e3*tVect) + " ms ("
+                 + "{:.0f}".format(tLoop/tVect) + "x) for " + str(nValidFrames) + " frames, " + str(np.count_nonzero(degenerate))
+                 + " degenerate, float32 max. error " + "{:.1e}".format(error32) + " dg.")
+
+    return tLoop, tVect
+
+
+def angleDataLoop(time, angle, fixed=True):
+
+    # Reference (loop based) angleData. With fixed=False the mid roots compare the spline values of the
+    # first two roots instead of the current pair, as the original version did.
+    interpPart = 15
+    dist = 1.5
+    kerPts = 9
+
+    ker = np.ones(kerPts)/kerPts
+    smoothAngle = np.convolve(angle, ker, mode='same')
+
+    x = time[0:-1:interpPart]
+    x = np.append(x,[time[-1]])
+    y = smoothAngle[0:-1:interpPart]
+    y = np.append(y,[smoothAngle[-1]])
+
+    cs = CubicSpline(x, y)
+    rootsd = cs.derivative().roots()
+
+    noiseHDist = dist*interpPart
+    noiseVDist = noiseHDist*time[-1]/np.abs(np.max(y)-np.min(y))
+    relativeP = []
+    noiseP = []
+
+    if rootsd[0] >= x[0]:  # first root
+        if (np.abs(rootsd[0]-rootsd[1]) > noiseHDist) or (np.abs(cs(rootsd[0])-cs(rootsd[1])) > noiseVDist):
+            relativeP.append(rootsd[0])
+        else:
+            noiseP.append(rootsd[0])
+
+    for i in range(1, len(rootsd)-1):  # mid roots
+        pair = (i, i+1) if fixed else (0, 1)
+        if (np.abs(rootsd[i]-rootsd[i+1]) > noiseHDist) or (np.abs(cs(rootsd[pair[0]])-cs(rootsd[pair[1]])) > noiseVDist):
+            if (len(noiseP) == 0 ):
+                relativeP.append(rootsd[i])
+            elif (len(noiseP)%2 == 0):
+                noiseP.append(rootsd[i])
+                relativeP.append(np.median(noiseP))
+            noiseP = []
+        else:
+            noiseP.append(rootsd[i])
+
+    if rootsd[-1] <= x[-1]:  # last root
+        if len(noiseP) == 0:
+            relativeP.append(rootsd[-1])
+        else:
+            noiseP.append(rootsd[-1])
+            relativeP.append(np.median(noiseP))
+
+    amp = np.zeros(max(len(relativeP)-1, 0), float)
+    for i in range(1, len(relativeP)):
+        amp[i-1] = np.abs(cs(relativeP[i])-cs(relativeP[i-1]))/2
+
+    with np.errstate(invalid="ignore"):
+        meanAmp = np.mean(amp) if len(amp) > 0 else np.nan
+    freq = (int((len(relativeP)-1)/2) * 1000)/time[-1]
+
+    return meanAmp, freq
+
+
+def randomSinusoids(nSeries, nFrames=1000, seed=0, params=False):
+
+    # Noisy tail-beat like angle series (ms) of random amplitude, frequency and phase
+    # (with params, the series are (timeMs, angle, amp, freq))
+    rng = np.random.RandomState(seed)
+    series = []
+    for _ in range(nSeries):
+        timeMs = np.arange(nFrames)*(1000/1000)
+        (amp, freq, phase) = (rng.uniform(2, 40), rng.uniform(5, 60), rng.uniform(0, 2*np.pi))
+        angle = amp*np.sin(2*np.pi*freq*timeMs/1000 + phase) + rng.normal(0, rng.uniform(0, 0.3)*amp, nFrames)
+        series.append((timeMs, angle, amp, freq) if params else (timeMs, angle))
+
+    return series
+
+
+def benchFrequencyBackends(series, repeat=1):
+
+    # Errors of the frequencies/amplitudes of the spline and spectral backends against the true ones of the
+    # series (timeMs, angle, amp, freq), and their times. The amplitudes are compared with the true ones
+    # attenuated by the smoothing kernel of angleData.
+    nSeries = len(series)
+    kerPts = 9
+    results = {}
+    for backend in ("spline", "spectral"):
+        tBackend = np.inf
+        for _ in range(repeat):
+            tic = time.perf_counter()
+            with np.errstate(invalid="ignore"):
+                res = np.array([td.angleData(timeMs, angle, backend) for (timeMs, angle, _amp, _freq) in series], float)
+            tBackend = min(tBackend, time.perf_counter() - tic)
+
+        step = np.array([timeMs[1] - timeMs[0] for (timeMs, _angle, _amp, _freq) in series])/1000
+        freq = np.array([freq for (_timeMs, _angle, _amp, freq) in series])
+        gain = np.abs(np.sin(np.pi*freq*step*kerPts)/(kerPts*np.sin(np.pi*freq*step)))
+        amp = np.array([amp for (_timeMs, _angle, amp, _freq) in series])*gain
+
+        freqErr = np.abs(res[:, 1] - freq)/freq
+        ampErr = np.abs(res[:, 0] - amp)/amp
+        results[backend] = (tBackend, freqErr, ampErr)
+        logging.info("Frequency backend " + backend.ljust(8) + ": " + "{:.3f}".format(1e3*tBackend/nSeries) + " ms/series, median error freq. "
+                     + "{:.2f}".format(100*np.nanmedian(freqErr)) + " %, amp. " + "{:.2f}".format(100*np.nanmedian(ampErr)) + " %, "
+                     + str(int(np.sum(~(freqErr < 0.05)))) + "/" + str(nSeries) + " freq. off by >5 %.")
+
+    return results
+
+
+def benchAngleData(series, repeat=1):
+
+    # angleData against the fixed loop reference, reporting the series changed by the fix of the original version
+    tLoop = np.inf
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        for (timeMs, angle) in series:
+            angleDataLoop(timeMs, angle)
+        tLoop = min(tLoop, time.perf_counter() - tic)
+
+    tVect = np.inf
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        with np.errstate(invalid="ignore"):
+            resVect = [td.angleData(timeMs, angle) for (timeMs, angle) in series]
+        tVect = min(tVect, time.perf_counter() - tic)
+
+    changed = sum(not equalNan(angleDataLoop(timeMs, angle, fixed=False), res) for ((timeMs, angle), res) in zip(series, resVect))
+    logging.info("angleData: loop " + "{:.2f}".format(1e3*tLoop/len(series)) + " ms/series, vectorized " + "{:.2f}".format(1e3*tVect/len(series))
+                 + " ms/series, " + str(len(series)) + " series (" + str(changed) + " changed by the fix of the mid roots).")
+
+    return tLoop, tVect
+
+
+def randomSkeletons(nSkeletons, nPoints=300, seed=0, repeatX=False):
+
+    # Prepared-like skeletons (increasing x, random walk y) of random lengths. With repeatX the x coords.
+    # do not always increase (repeated x as the raw skeletons) and the y coords. cross the zero.
+    rng = np.random.RandomState(seed)
+    skeletons = []
+    for _ in range(nSkeletons):
+        n = rng.randint(nPoints//2, nPoints*3//2)
+        x = np.cumsum(rng.randint(0 if repeatX else 1, 3, n))
+        y = np.cumsum(rng.randint(-2, 3, n)) - (rng.randint(-20, 20) if repeatX else 100)
+        skeletons.append(np.stack([x, y], 1))
+
+    return skeletons
+
+
+def fullRoi(videoPath):
+
+    # Region of interest covering the whole frame
+    vid = cv.VideoCapture(str(videoPath))
+    if not vid.isOpened():
+        vid.release()
+        raise Exception("Could not open the video reference: " + str(videoPath))
+    roi = (0, 0, int(vid.get(cv.CAP_PROP_FRAME_WIDTH)), int(vid.get(cv.CAP_PROP_FRAME_HEIGHT)))
+    vid.release()
+
+    return roi
+
+
+def extractDetections(videoPath, roi, contrast):
+
+    # Contours and skeletons of all the frames of a video
+    _totalFrames, contrast, mainBox, _decodeTime = st.getMainBox(str(videoPath), config.DEFAULT_CONTRAST, config.BOX_AREA_MIN, config.BOX_AREA_MAX, roi, None, contrast)
+
+    detections = []
+    for frame in st.readFrames(cv.VideoCapture(str(videoPath))):
+        _originalFrame, fishContours, fishSkeleton, _fishMoments = st.extractFrame(frame, mainBox, contrast, config.FISH_AREA_MIN, config.FISH_AREA_MAX, config.BLANK_BORDER)
+        detections.append((fishContours, fishSkeleton))
+
+    return detections
+
+
+def corruptDetections(detections, every=10):
+
+    # Every other frame of the detections of a video is corrupted in turn so that each test of checkFrame fails:
+    # no blob, a blob of another shape, a skeleton out of the blob bounding box and a branched skeleton
+    detections = list(detections)
+    for (k, i) in enumerate(range(every//2, len(detections), every)):
+        (fishContours, fishSkeleton) = detections[i]
+        if fishContours is None or fishSkeleton is None:
+            continue
+        (fx, fy, fw, fh) = cv.boundingRect(fishContours)
+        kind = k % 4
+        if kind == 0:
+            fishContours = None
+        elif kind == 1:
+            fishContours = cv.ellipse2Poly((fx + fw//2, fy + fh//2), (fw//2, fw//2), 0, 0, 360, 5).reshape(-1, 1, 2)
+        elif kind == 2:
+            fishSkeleton = fishSkeleton + np.array([fw, 0], np.int32)
+        else:
+            branch = fishSkeleton[len(fishSkeleton)//2] + np.array([0, 4], np.int32)
+            fishSkeleton = np.concatenate([fishSkeleton, branch[None]])
+        detections[i] = (fishContours, fishSkeleton)
+
+    return detections
+
+
+def signChangePairs(sizes=((125, 10, 126, 10), (100, 20, 101, 20), (125, 10, 125, 11)), center=(200, 200)):
+
+    # Pairs of ellipse contours (half axes in px) whose Hu moments have opposite signs in some order,
+    # a case of the shape measure that the synthetic fish does not reach
+    pairs = []
+    for (a0, b0, a1, b1) in sizes:
+        contours = [cv.ellipse2Poly(center, axes, 0, 0, 360, 1).reshape(-1, 1, 2) for axes in ((a0, b0), (a1, b1))]
+        (hu0, hu1) = [cv.HuMoments(cv.moments(c)).flatten() for c in contours]
+        if not np.any(np.sign(hu0)*np.sign(hu1) < 0):
+            raise Exception("The Hu moments of the ellipses " + str((a0, b0)) + " and " + str((a1, b1)) + " have the same signs.")
+        pairs.append(tuple(contours))
+
+    return pairs
+
+
+def detectionAngles(detections, fps):
+
+    # Time (ms) and angles (alpha, beta, gamma) of the frames of the detections of a video that checkFrame
+    # validates, as the treatment computes them
+    validFrames = np.zeros(len(detections), bool)
+    fishMomentsPrev = None
+    for (i, (fishContours, fishSkeleton)) in enumerate(detections):
+        fishMoments = st.getShapeMoments(fishContours)
+        if fishMomentsPrev is None:
+            fishMomentsPrev = fishMoments
+        validFrames[i] = st.checkFrame(fishSkeleton, fishContours, fishMoments, fishMomentsPrev)
+        fishMomentsPrev = fishMoments
+
+    keyPoints = np.zeros((len(detections), 4, 2), int)
+    keyPoints[validFrames] = td.batchKeyPoints([td.prepareSkeleton(detections[i][1]) for i in np.flatnonzero(validFrames)],
+                                               config.PROPORTION_JOINT, config.PROPORTION_TORSION)
+    (ind, tailP, headP, jointP, nValidFrames, torsionP) = td.validKeyPoints(validFrames, keyPoints)
+    timeMs = td.frameTime(ind[:nValidFrames], fps)
+
+    return [(timeMs, td.computeAngle(A, B, C, nValidFrames)[0]) for (A, B, C) in ((headP, jointP, torsionP), (headP, jointP, tailP), (jointP, torsionP, tailP))]
+
+
+def readVideoFrames(videoPath, maxFrames=None):
+
+    # First frames of a video in memory
+    frames = []
+    for frame in st.readFrames(cv.VideoCapture(str(videoPath))):
+        frames.append(frame)
+        if len(frames) == maxFrames:
+            break
+
+    return frames
+
+
+def benchCheckFrame(detections, repeat=5):
+
+    # Micro-benchmark of the frame validators over the same detections. The shape measure of the cached
+    # moments must be the cv.matchShapes one, also for contours with Hu moments of opposite signs.
+    nFrames = len(detections)
+
+    pairs = [(detections[i][0], detections[max(i-1, 0)][0]) for i in range(nFrames)] + signChangePairs()
+    for (fishContours, fishContoursPrev) in pairs:
+        if fishContours is None or fishContoursPrev is None:
+            continue
+        measure = st.matchShapeMoments(st.getShapeMoments(fishContours), st.getShapeMoments(fishContoursPrev))
+        reference = cv.matchShapes(fishContours, fishContoursPrev, 3, 0.0)
+        if not np.isclose(measure, reference, rtol=1e-9, atol=0.):
+            raise Exception("The shape measure of the cached moments is " + str(measure) + " instead of " + str(reference) + ".")
+
+    tLoop = np.inf
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        resLoop = [checkFrameLoop(detections[i][1], detections[i][0], detections[max(i-1, 0)][0]) for i in range(nFrames)]
+        tLoop = min(tLoop, time.perf_counter() - tic)
+
+    tVect = np.inf
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        resVect = []
+        fishMomentsPrev = None
+        for (fishContours, fishSkeleton) in detections:
+            fishMoments = st.getShapeMoments(fishContours)
+            if fishMomentsPrev is None:
+                fishMomentsPrev = fishMoments
+            resVect.append(st.checkFrame(fishSkeleton, fishContours, fishMoments, fishMomentsPrev))
+            fishMomentsPrev = fishMoments
+        tVect = min(tVect, time.perf_counter() - tic)
+
+    if resLoop != resVect:
+        raise Exception("The vectorized checkFrame differs from the reference validator in " + str(np.sum(np.array(resLoop) != np.array(resVect))) + " frames.")
+
+    logging.info("checkFrame: loop " + "{:.1f}".format(1e6*tLoop/nFrames) + " us/frame, vectorized " + "{:.1f}".format(1e6*tVect/nFrames)
+                 + " us/frame (x" + "{:.1f}".format(tLoop/tVect) + "), " + str(nFrames) + " frames, " + str(sum(resVect)) + " valid.")
+
+    return tLoop, tVect
+
+
+def benchUniqueMean(skeletons, repeat=3):
+
+    # uniqueMean against the loop reference, reporting the skeletons changed by the fix of the original
+    # version (tests/test_treatData.py checks that they are the same)
+    skeletons = [np.unique(np.reshape(skeleton, (-1, 2)), axis=0) for skeleton in skeletons]
+    nSkeletons = len(skeletons)
+
+    tLoop = np.inf
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        for skeleton in skeletons:
+            uniqueMeanLoop(skeleton)
+        tLoop = min(tLoop, time.perf_counter() - tic)
+
+    tVect = np.inf
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        resVect = [td.uniqueMean(skeleton) for skeleton in skeletons]
+        tVect = min(tVect, time.perf_counter() - tic)
+
+    changed = sum(not np.array_equal(uniqueMeanLoop(skeleton, fixed=False), res) for (skeleton, res) in zip(skeletons, resVect))
+    logging.info("uniqueMean: loop " + "{:.1f}".format(1e6*tLoop/nSkeletons) + " us/skeleton, vectorized " + "{:.1f}".format(1e6*tVect/nSkeletons)
+                 + " us/skeleton (x" + "{:.1f}".format(tLoop/tVect) + "), " + str(changed) + "/" + str(nSkeletons) + " skeletons changed by the index fix.")
+
+    return tLoop, tVect
+
+
+def benchKeyPoints(skeletons, repeat=3):
+
+    # Key point indexes of the lenSK loops against the vectorized sampler
+    proportions = (config.PROPORTION_JOINT, config.PROPORTION_TORSION)
+    nSkeletons = len(skeletons)
+
+    tLoop = np.inf
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        for skeleton in skeletons:
+            _skeletonLen, joint = lenSKLoop(skeleton, proportions[0])
+            lenSKLoop(skeleton[joint:, :], proportions[1])
+        tLoop = min(tLoop, time.perf_counter() - tic)
+
+    tVect = np.inf
+    for _ in range(repeat):
+        tic = time.perf_counter()
+        offsets = np.concatenate([[0], np.cumsum([len(skeleton) for skeleton in skeletons])])
+        td.keyPointIndexes(np.concatenate(skeletons), offsets, proportions)
+        tVect = min(tVect, time.perf_counter() - tic)
+
+    logging.info("Key points: lenSK loops " + "{:.1f}".format(1e6*tLoop/nSkeletons) + " us/skeleton, vectorized " + "{:.1f}".format(1e6*tVect/nSkeletons)
+                 + " us/skeleton (x" + "{:.1f}".format(tLoop/tVect) + "), " + str(nSkeletons) + " skeletons.")
+
+    return tLoop, tVect
+
+
+def exportCsvSavetxt(exportPath, expID, csvPath):
+
+    # Reference (np.savetxt) csv export of the result file, the chunked writer must give the same bytes
+    meta = loadMeta(exportPath, expID)
+    dataHeader = "Time(ms), x_Head, y_Head, x_Joint, y_Joint, x_Torsion, y_Torsion, x_Tail, y_Tail, AngleAlpha(dg), AngleBeta(dg), AngleGamma(dg)"
+    data = np.transpose([loadColumn(exportPath, expID, column) for column in td.RESULT_COLUMNS])
+    np.savetxt(csvPath, data, fmt="%10.5f", delimiter=',', header=dataHeader, comments="")
+
+    with open(csvPath, 'a') as f:
+        w = csv.writer(f)
+        w.writerow([None])
+        w.writerow([None, "MeanAmp", "Freq(Hz)"])
+        for name in ("alpha", "beta", "gamma"):
+            w.writerow([name.capitalize(), meta["angles"][name]["meanAmp"], meta["angles"][name]["freq"]])
+        w.writerow([None])
+        w.writerow(["Contrast", "Fps", "Failed Frames"])
+        w.writerow([meta["contrast"], meta["fps"], meta["failedFrames"]])
+
+
+def benchExport(nFrames, seed=0):
+
+    # Result file against the csv file of a long recording (the chunked csv writer against np.savetxt),
+    # and the memory mapped read of a column. Some angles are NaN/inf as in the degenerate frames.
+    rng = np.random.RandomState(seed)
+    (headP, jointP, tailP) = randomKeyPoints(nFrames, seed=seed)
+    torsionP = (jointP + tailP)//2
+    timeMs = np.arange(nFrames, dtype=float)
+    angles = rng.uniform(-30, 30, (3, nFrames))
+    angles[:, rng.choice(nFrames, 10)] = np.nan
+    angles[0, rng.choice(nFrames, 2)] = np.inf
+    aData = rng.uniform(0, 30, (3, 2))
+    expID = "bench"
+
+    with tempfile.TemporaryDirectory() as exportPath:
+        pathlib.Path(exportPath, expID, "data").mkdir(parents=True)
+
+        tic = time.perf_counter()
+        td.exportData(timeMs, headP, jointP, torsionP, tailP, angles[0], angles[1], angles[2], aData, exportPath, expID, nFrames, 1000, 1.0, 0)
+        tResult = time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        td.exportCsv(exportPath, expID)
+        tCsv = time.perf_counter() - tic
+
+        csvPath = pathlib.Path(exportPath, expID, expID + ".csv")
+        tic = time.perf_counter()
+        exportCsvSavetxt(exportPath, expID, pathlib.Path(exportPath, expID, "savetxt.csv"))
+        tSavetxt = time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        beta = loadColumn(exportPath, expID, "beta")
+        if not equalNan(beta, angles[1]):
+            raise Exception("The memory mapped column differs from the exported one.")
+        tColumn = time.perf_counter() - tic
+        del beta
+
+        sizeResult = resultPath(exportPath, expID).stat().st_size/1024**2
+        sizeCsv = csvPath.stat().st_size/1024**2
+
+    logging.info("Export of " + str(nFrames) + " frames: result " + "{:.3f}".format(tResult) + " s (" + "{:.1f}".format(sizeResult) + " MB), csv "
+                 + "{:.3f}".format(tCsv) + " s (np.savetxt " + "{:.3f}".format(tSavetxt) + " s, " + "{:.1f}".format(sizeCsv) + " MB), column read "
+                 + "{:.1f}".format(1e3*tColumn) + " ms.")
+
+    return tResult, tCsv, tSavetxt
+
+
+def benchWindows(nFrames, windowMs=1000, overlap=0.5, backend="spectral", seed=0):
+
+    # Sliding-window analysis of a long recording whose tail-beat frequency drifts (5 to 40 Hz), reporting the
+    # time, the peak of the memory allocated by the window pass alone (it must not depend on nFrames, the result
+    # file is written before) and the error of the frequencies
+    rng = np.random.RandomState(seed)
+    timeMs = np.arange(nFrames, dtype=float)
+    freq = 5 + 35*timeMs/nFrames
+    phase = 2*np.pi*np.cumsum(freq)/1000
+    angles = [amp*np.sin(phase + shift) + rng.normal(0, 1, nFrames) for (amp, shift) in ((5, 0), (15, 0.5), (25, 1))]
+    points = np.zeros((nFrames, 2), int)
+    expID = "bench"
+
+    with tempfile.TemporaryDirectory() as exportPath:
+        pathlib.Path(exportPath, expID, "data").mkdir(parents=True)
+        td.exportData(timeMs, points, points, points, points, angles[0], angles[1], angles[2], np.zeros((3, 2)), exportPath, expID, nFrames,
+                      1000, 1.0, 0)
+        del angles, points
+
+        tracemalloc.start()
+        tic = time.perf_counter()
+        nWindows = td.windowData(exportPath, expID, windowMs, overlap, backend)
+        tWindows = time.perf_counter() - tic
+        (_current, peak) = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        windows = np.array(loadColumn(exportPath, expID, "windows"))
+
+    center = (windows["start"] + windows["end"])/2
+    freqErr = np.abs(windows["gammaFreq"] - (5 + 35*center/nFrames))/(5 + 35*center/nFrames)
+    logging.info("Windows of " + str(nFrames) + " frames (" + backend + "): " + str(nWindows) + " windows in " + "{:.3f}".format(tWindows) + " s ("
+                 + "{:.2f}".format(1e3*tWindows/max(nWindows, 1)) + " ms/window), peak " + "{:.2f}".format(peak/1024**2) + " MB allocated, median error freq. "
+                 + "{:.2f}".format(100*np.median(freqErr)) + " %.")
+
+    return tWindows, peak
+
+
+def synthKeyPoints(nFrames, fps, tailFreq, failEvery=0):
+
+    # Key points (as importData returns them) of the synthetic fish of synthVideo sampled at fps, without
+    # rendering the frames. Every failEvery-th frame is failed.
+    points = np.array([keyPoints(fishMidline(numFrame, fps, (500, 150), 300, 30., tailFreq, 0.9)) for numFrame in range(nFrames)])
+    validFrames = np.ones(nFrames, bool)
+    if failEvery:
+        validFrames[::failEvery] = False
+
+    return td.validKeyPoints(validFrames, np.round(points).astype(int))
+
+
+def benchTimeBase(nFrames, fps, tailFreq=20., failEvery=0):
+
+    # Treatment of the synthetic key points of a recording of nFrames at fps: the saved time column must be
+    # in ms whatever the length of the recording, and the frequencies of the result file must be the true one
+    # (within 5 %, or one cycle over the recording for the spline backend that counts whole cycles)
+    fishPoints = synthKeyPoints(nFrames, fps, tailFreq, failEvery)
+    (ind, nValidFrames) = (fishPoints[0], fishPoints[4])
+    expID = "bench"
+    backend = config.FREQUENCY_BACKEND
+    results = {}
+    try:
+        for name in ("spline", "spectral"):
+            config.FREQUENCY_BACKEND = name
+            with tempfile.TemporaryDirectory() as exportPath:
+                pathlib.Path(exportPath, expID, "data").mkdir(parents=True)
+                td.treatKeyPoints(fishPoints, exportPath, expID, fps, 1.0, nFrames-nValidFrames, nFrames, stageTimer.NULL_TIMER)
+                timeMs = np.array(loadColumn(exportPath, expID, "time"))
+                angles = loadMeta(exportPath, expID)["angles"]
+
+            if not np.allclose(timeMs, ind[:nValidFrames]*1000/fps):
+                raise Exception("The saved time column is not in ms (" + str(nFrames) + " frames at " + str(fps) + " fps).")
+            freq = np.array([angles[angle]["freq"] for angle in ("alpha", "beta", "gamma")])
+            tolerance = max(0.05*tailFreq, 1000/timeMs[-1]) if name == "spline" else 0.05*tailFreq
+            if not np.all(np.abs(freq - tailFreq) <= tolerance):
+                raise Exception("Frequencies " + str(freq) + " Hz of the " + name + " backend instead of " + str(tailFreq)
+                                + " Hz (" + str(nFrames) + " frames at " + str(fps) + " fps).")
+            results[name] = freq
+            logging.info("Time base of " + str(nFrames) + " frames at " + str(fps) + " fps (" + name + "): last time "
+                         + "{:.1f}".format(timeMs[-1]) + " ms, freq. (alpha, beta, gamma) " + "({:.2f}, {:.2f}, {:.2f})".format(*freq)
+                         + " Hz, truth " + "{:.2f}".format(tailFreq) + " Hz.")
+    finally:
+        config.FREQUENCY_BACKEND = backend
+
+    return results
+
+
+def benchWindowTime(nFrames, fps, tailFreq=20., windowMs=1000, overlap=0.5, failEvery=0):
+
+    # Windows of the treatment (WINDOW_ANALYSIS) of the synthetic key points of a recording of nFrames at fps,
+    # cut on the time column that treatKeyPoints writes: the number of windows must follow the duration of the
+    # recording in ms, each window must hold windowMs of frames and its frequencies must be the true one, or NaN
+    # if it has too few frames for the spectrum
+    fishPoints = synthKeyPoints(nFrames, fps, tailFreq, failEvery)
+    (ind, nValidFrames) = (fishPoints[0], fishPoints[4])
+    expID = "bench"
+    settings = (config.WINDOW_ANALYSIS, config.WINDOW_MS, config.WINDOW_OVERLAP, config.FREQUENCY_BACKEND)
+    try:
+        (config.WINDOW_ANALYSIS, config.WINDOW_MS, config.WINDOW_OVERLAP, config.FREQUENCY_BACKEND) = (True, windowMs, overlap, "spectral")
+        with tempfile.TemporaryDirectory() as exportPath:
+            pathlib.Path(exportPath, expID, "data").mkdir(parents=True)
+            td.treatKeyPoints(fishPoints, exportPath, expID, fps, 1.0, nFrames-nValidFrames, nFrames, stageTimer.NULL_TIMER)
+            windows = np.array(loadColumn(exportPath, expID, "windows"))
+    finally:
+        (config.WINDOW_ANALYSIS, config.WINDOW_MS, config.WINDOW_OVERLAP, config.FREQUENCY_BACKEND) = settings
+
+    duration = (ind[nValidFrames-1] - ind[0] + 1)*1000/fps
+    nWindows = int((duration - windowMs)//(windowMs*(1-overlap))) + 1
+    windowFrames = windowMs*fps/1000
+    if len(windows) != nWindows or not np.allclose(windows["end"] - windows["start"], windowMs):
+        raise Exception(str(len(windows)) + " windows instead of " + str(nWindows) + " windows of " + str(windowMs) + " ms (" + str(nFrames)
+                        + " frames at " + str(fps) + " fps).")
+    if np.any(windows["frames"] > windowFrames) or np.any(windows["frames"] < windowFrames*(1 - 1/failEvery if failEvery else 1) - 1):
+        raise Exception("Windows of " + str(windows["frames"].min()) + " to " + str(windows["frames"].max()) + " frames instead of "
+                        + "{:.0f}".format(windowFrames) + " frames.")
+    short = windows["frames"] < max(windowFrames/2, td.SPECTRAL_MIN_FRAMES)
+    if np.any(np.isnan(windows["gammaFreq"]) != short):
+        raise Exception("The NaN windows are not the " + str(np.sum(short)) + " windows with too few frames.")
+    freqErr = np.abs(windows["gammaFreq"][~short] - tailFreq)/tailFreq
+    if not np.all(freqErr < 0.05):
+        raise Exception("Window frequencies off by " + "{:.1f}".format(100*np.max(freqErr)) + " % of " + str(tailFreq) + " Hz.")
+
+    logging.info("Windows of the treatment of " + str(nFrames) + " frames at " + str(fps) + " fps: " + str(len(windows)) + " windows of "
+                 + str(windowMs) + " ms (" + str(windows["frames"].min()) + " to " + str(windows["frames"].max()) + " frames, " + str(np.sum(short))
+                 + " NaN), max. error freq. " + "{:.2f}".format(100*np.max(freqErr, initial=0.)) + " %.")
+
+    return windows
+
+
+def runExperiment(videoPath, exportPath, roi, contrast, fps, cancelAt=None, **kwargs):
+
+    # Headless extraction of a video in exportPath (expID "bench"), cancelled at the frame cancelAt if given.
+    # The keyword arguments are the ones of swimTunnel (i.e. checkpoint, threads or streaming).
+    cancel = threading.Event()
+
+    def progress(numFrame, _totalFrames):
+        if cancelAt is not None and numFrame >= cancelAt:
+            cancel.set()
+
+    failFrames, contrast = st.swimTunnel(str(videoPath), exportPath, "bench", fps, roi, contrast=contrast, headless=True, progress=progress,
+                                         cancel=cancel, **kwargs)
+
+    return failFrames, contrast
+
+
+def resultColumns(exportPath, expID="bench"):
+
+    # Columns and metadata of a result file in memory
+    columns = {column: np.array(loadColumn(exportPath, expID, column)) for column in td.RESULT_COLUMNS}
+
+    return columns, loadMeta(exportPath, expID)
+
+
+def sameResults(resultA, resultB):
+
+    # Result files with the same columns (NaN in the same frames) and the same metadata
+    (columnsA, metaA) = resultA
+    (columnsB, metaB) = resultB
+
+    return all(equalNan(columnsA[column], columnsB[column]) for column in td.RESULT_COLUMNS) and metaA == metaB
+
+
+def benchCheckpoint(videoPath, roi, contrast, fps, checkpoint=100, cancelAt=350, threads=0):
+
+    # Extraction cancelled at the frame cancelAt and resumed from its last checkpoint against an uninterrupted one:
+    # the treated result files and the output videos (the joined segments) must be the same. It reports the frames
+    # left to extract by the resumed run.
+    results = []
+    videos = []
+    with tempfile.TemporaryDirectory() as exportPath:
+        failFrames, treatContrast = runExperiment(videoPath, exportPath, roi, contrast, fps, threads=threads)
+        td.treatData(exportPath, "bench", fps, treatContrast, failFrames)
+        results.append(resultColumns(exportPath))
+        videos.append(pathlib.Path(exportPath, "bench", "bench.avi").read_bytes())
+
+    with tempfile.TemporaryDirectory() as exportPath:
+        try:
+            runExperiment(videoPath, exportPath, roi, contrast, fps, cancelAt, checkpoint=checkpoint, threads=threads)
+            raise Exception("The extraction of " + str(videoPath) + " was not cancelled at the frame " + str(cancelAt) + ".")
+        except Exception as e:
+            if str(e) != "Process aborted by the user.":
+                raise
+        state = st.loadCheckpoint(str(videoPath), exportPath, "bench", roi)
+        if state is None:
+            raise Exception("No checkpoint left by the cancelled extraction.")
+
+        tic = time.perf_counter()
+        failFrames, treatContrast = runExperiment(videoPath, exportPath, roi, contrast, fps, checkpoint=checkpoint, threads=threads)
+        tResume = time.perf_counter() - tic
+        td.treatData(exportPath, "bench", fps, treatContrast, failFrames)
+        results.append(resultColumns(exportPath))
+        videos.append(pathlib.Path(exportPath, "bench", "bench.avi").read_bytes())
+        if st.checkpointPath(exportPath, "bench").exists():
+            raise Exception("The checkpoint of the finished extraction was not removed.")
+
+    if not sameResults(*results):
+        raise Exception("The resumed extraction of " + str(videoPath) + " differs from the uninterrupted one.")
+    if videos[0] != videos[1]:
+        raise Exception("The video of the resumed extraction of " + str(videoPath) + " differs from the uninterrupted one.")
+
+    logging.info("Checkpoint every " + str(checkpoint) + " frames (" + str(threads) + " threads): cancelled at the frame " + str(cancelAt)
+                 + ", resumed from the frame " + str(state["lastFrame"]) + " in " + "{:.2f}".format(tResume) + " s, same result file and video as the"
+                 + " uninterrupted run.")
+
+    return state["lastFrame"], tResume
+
+
+def benchIncremental(videoPath, roi, contrast, fps, nChanged=10):
+
+    # Incremental treatment of an extraction of the video against the full one: with the key points cached, then
+    # after moving the skeletons of nChanged valid frames by one pixel. The result files must be the same.
+    def treat(incremental):
+        tic = time.perf_counter()
+        td.treatData(exportPath, "bench", fps, treatContrast, failFrames, incremental, False)
+        return time.perf_counter() - tic, resultColumns(exportPath)
+
+    with tempfile.TemporaryDirectory() as exportPath:
+        failFrames, treatContrast = runExperiment(videoPath, exportPath, roi, contrast, fps)
+
+        (tFull, full) = treat(False)
+        (tFirst, first) = treat(True)
+        (tCached, cached) = treat(True)
+        if not (sameResults(full, first) and sameResults(full, cached)):
+            raise Exception("The incremental treatment of " + str(videoPath) + " differs from the full one.")
+
+        # Move the skeletons of some valid frames
+        points = np.load(storePath(exportPath, "bench", "points"), mmap_mode="r+")
+        offsets = np.load(storePath(exportPath, "bench", "offsets"))
+        validInd = np.flatnonzero(np.load(storePath(exportPath, "bench", "valid")))
+        for i in validInd[np.linspace(0, len(validInd)-1, nChanged).astype(int)]:
+            points[offsets[i]:offsets[i+1], 1] += 1
+        points.flush()
+        del points
+
+        (tChanged, changed) = treat(True)
+        (_tFull, fullChanged) = treat(False)
+        if not sameResults(changed, fullChanged) or sameResults(changed, full):
+            raise Exception("The incremental treatment of " + str(videoPath) + " does not follow the changed frames.")
+
+    logging.info("Incremental treatment of " + str(videoPath) + ": full " + "{:.3f}".format(tFull) + " s, first incremental " + "{:.3f}".format(tFirst)
+                 + " s, cached " + "{:.3f}".format(tCached) + " s, " + str(nChanged) + " changed frames " + "{:.3f}".format(tChanged)
+                 + " s, same result files as the full treatment.")
+
+    return tFull, tCached, tChanged
+
+
+def benchStreaming(videoPath, roi, contrast, fps, checkpoint=100, cancelAt=350):
+
+    # Streaming treatment of the video (plain, threaded, with the skeletons dumped and cancelled/resumed from a
+    # checkpoint) against the extraction to the skeleton store followed by treatData: the result files must be the same
+    with tempfile.TemporaryDirectory() as exportPath:
+        tic = time.perf_counter()
+        failFrames, treatContrast = runExperiment(videoPath, exportPath, roi, contrast, fps, streaming=False)
+        td.treatData(exportPath, "bench", fps, treatContrast, failFrames)
+        tStore = time.perf_counter() - tic
+        reference = resultColumns(exportPath)
+
+    runs = (("plain", {}), ("threaded", {"threads": 2}), ("dumped", {"dumpSkeletons": True}), ("resumed", {"checkpoint": checkpoint}))
+    times = {}
+    for (name, kwargs) in runs:
+        with tempfile.TemporaryDirectory() as exportPath:
+            if name == "resumed":
+                try:
+                    runExperiment(videoPath, exportPath, roi, contrast, fps, cancelAt, streaming=True, **kwargs)
+                    raise Exception("The streaming extraction of " + str(videoPath) + " was not cancelled at the frame " + str(cancelAt) + ".")
+                except Exception as e:
+                    if str(e) != "Process aborted by the user.":
+                        raise
+
+            tic = time.perf_counter()
+            runExperiment(videoPath, exportPath, roi, contrast, fps, streaming=True, **kwargs)
+            times[name] = time.perf_counter() - tic
+            if not sameResults(reference, resultColumns(exportPath)):
+                raise Exception("The " + name + " streaming treatment of " + str(videoPath) + " differs from the skeleton store one.")
+
+    logging.info("Streaming treatment of " + str(videoPath) + ": store and treatData " + "{:.2f}".format(tStore) + " s, streaming "
+                 + ", ".join(name + " " + "{:.2f}".format(times[name]) + " s" for (name, _kwargs) in runs) + ", same result files.")
+
+    return tStore, times
+
+
+def peakMemory():
+
+    # Peak resident memory of the process in MB (ru_maxrss is in KB under Linux and in bytes under macOS)
+    if resource is None:
+        return np.nan
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return maxrss/1024**2 if sys.platform == "darwin" else maxrss/1024
+
+
+def benchStages(videoPath, roi, contrast, fps, truth=None, traceMemory=False):
+
+    # Time each stage of the extraction and the treatment of a video. With the ground truth of a
+    # synthetic video, the angles are compared with the true ones. The memory allocations are traced
+    # (slower) only if traceMemory is set.
+    times = dict.fromkeys(EXTRACT_STAGES + TREAT_STAGES, 0.)
+    if traceMemory:
+        tracemalloc.start()
+
+    tic = time.perf_counter()
+    _totalFrames, contrast, mainBox, _decodeTime = st.getMainBox(str(videoPath), config.DEFAULT_CONTRAST, config.BOX_AREA_MIN, config.BOX_AREA_MAX, roi, None, contrast)
+    tMainBox = time.perf_counter() - tic
+    (mbx, mby, mbw, mbh) = mainBox
+    border = config.BLANK_BORDER
+
+    with tempfile.TemporaryDirectory() as exportPath:
+        expID = "bench"
+        store = SkeletonStore(exportPath, expID)
+        vid = openVideo(str(videoPath))
+
+        nFrames = 0
+        failFrames = 0
+        fishMomentsPrev = None
+        while True:
+            t0 = time.perf_counter()
+            _ret, frame = vid.read()
+            if frame is None:
+                break
+            t1 = time.perf_counter()
+            frame = frame[mby:(mby+mbh), mbx:(mbx+mbw)]
+            frame = cv.copyMakeBorder(frame, border, border, border, border, cv.BORDER_CONSTANT, None, st.WHITE)
+            t2 = time.perf_counter()
+            frame = st.preprocess(frame, contrast, True, True)
+            t3 = time.perf_counter()
+            fishContours = st.getFishContours(frame, config.FISH_AREA_MIN, config.FISH_AREA_MAX)
+            t4 = time.perf_counter()
+            fishSkeleton = st.getFishSkeleton(frame, fishContours)
+            t5 = time.perf_counter()
+            fishMoments = st.getShapeMoments(fishContours)
+            if fishMomentsPrev is None:
+                fishMomentsPrev = fishMoments
+            validFrame = st.checkFrame(fishSkeleton, fishContours, fishMoments, fishMomentsPrev)
+            fishMomentsPrev = fishMoments
+            t6 = time.perf_counter()
+            st.exportResults(store, fishSkeleton, validFrame)
+            t7 = time.perf_counter()
+
+            for (stage, dt) in zip(EXTRACT_STAGES, (t1-t0, t2-t1, t3-t2, t4-t3, t5-t4, t6-t5, t7-t6)):
+                times[stage] += dt
+            nFrames += 1
+            failFrames += not validFrame
+
+        vid.release()
+        store.close()
+
+        # Treatment stages
+        tic = time.perf_counter()
+        ind, tailP, headP, jointP, nValidFrames, torsionP = td.importData(exportPath, expID, config.PROPORTION_JOINT, config.PROPORTION_TORSION, nFrames)
+        times["importData"] = time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        angles = {
+            "alpha": td.computeAngle(headP, jointP, torsionP, nValidFrames)[0],
+            "beta": td.computeAngle(headP, jointP, tailP, nValidFrames)[0],
+            "gamma": td.computeAngle(jointP, torsionP, tailP, nValidFrames)[0]
+        }
+        times["computeAngle"] = time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        for angle in angles.values():
+            td.angleData(td.frameTime(ind[:nValidFrames], fps), angle)
+        times["angleData"] = time.perf_counter() - tic
+
+        # The accuracy is checked on the time column and the frequencies saved in the result file
+        fishPoints = (ind, tailP, headP, jointP, nValidFrames, torsionP)
+        pathlib.Path(exportPath, expID, "data").mkdir(parents=True, exist_ok=True)
+        td.treatKeyPoints(fishPoints, exportPath, expID, fps, contrast, failFrames, nFrames, stageTimer.NULL_TIMER)
+        timeMs = np.array(loadColumn(exportPath, expID, "time"))
+        savedAngles = loadMeta(exportPath, expID)["angles"]
+        data = {name: (savedAngles[name]["meanAmp"], savedAngles[name]["freq"]) for name in angles}
+
+    memory = peakMemory()
+    tracedMemory = np.nan
+    if traceMemory:
+        tracedMemory = tracemalloc.get_traced_memory()[1]/1024**2
+        tracemalloc.stop()
+
+    # Report
+    tExtract = sum(times[stage] for stage in EXTRACT_STAGES)
+    logging.info("Stages of " + str(videoPath) + " (" + str(nFrames) + " frames, " + str(failFrames) + " failed, main box "
+                 + "{:.3f}".format(tMainBox) + " s):")
+    for stage in EXTRACT_STAGES:
+        logging.info("  " + stage.ljust(16) + "{:8.3f}".format(1e3*times[stage]/nFrames) + " ms/frame " + "{:5.1f}".format(100*times[stage]/tExtract) + " %")
+    for stage in TREAT_STAGES:
+        logging.info("  " + stage.ljust(16) + "{:8.3f}".format(times[stage]) + " s")
+    logging.info("Extraction " + "{:.1f}".format(nFrames/tExtract) + " frames/s, peak memory " + "{:.1f}".format(memory) + " MB"
+                 + (" (traced " + "{:.1f}".format(tracedMemory) + " MB)." if traceMemory else "."))
+
+    accuracy = {}
+    if truth is not None:
+        for (name, angle) in angles.items():
+            error = angle - truth[name][ind[:nValidFrames]]
+            trueAmp, trueFreq = td.angleData(timeMs, truth[name][ind[:nValidFrames]])
+            accuracy[name] = (np.sqrt(np.mean(error**2)), data[name], (trueAmp, trueFreq))
+            logging.info("  " + name.ljust(6) + "RMSE " + "{:.2f}".format(accuracy[name][0]) + " dg, (amp, freq) "
+                         + "({:.2f}, {:.2f})".format(*data[name]) + ", truth " + "({:.2f}, {:.2f})".format(trueAmp, trueFreq))
+        logging.info("  Tail-beat frequency of the synthetic fish: " + "{:.2f}".format(float(truth["tailFreq"])) + " Hz.")
+
+    return times, nFrames, failFrames, (memory, tracedMemory), accuracy
+
+
+def benchSkeleton(videoPath, roi, contrast, maxFrames=None):
+
+    # Thinning of the fish blob (getFishSkeleton) against the thinning of the whole frame on the same
+    # preprocessed frames, reporting the time per frame. It raises if the skeletons of the frames with a fish
+    # blob differ.
+    _totalFrames, contrast, (mbx, mby, mbw, mbh), _decodeTime = st.getMainBox(str(videoPath), config.DEFAULT_CONTRAST, config.BOX_AREA_MIN,
+                                                                              config.BOX_AREA_MAX, roi, None, contrast)
+    border = config.BLANK_BORDER
+
+    (tFrame, tBlob) = (0., 0.)
+    (same, noFish, nFrames) = (0, 0, 0)
+    for frame in readVideoFrames(videoPath, maxFrames):
+        frame = cv.copyMakeBorder(frame[mby:(mby+mbh), mbx:(mbx+mbw)], border, border, border, border, cv.BORDER_CONSTANT, None, st.WHITE)
+        frame = st.preprocess(frame, contrast, True, True)
+        fishContours = st.getFishContours(frame, config.FISH_AREA_MIN, config.FISH_AREA_MAX)
+
+        tic = time.perf_counter()
+        frameSkeleton = fishSkeletonFrame(frame)
+        tFrame += time.perf_counter() - tic
+
+        tic = time.perf_counter()
+        blobSkeleton = st.getFishSkeleton(frame, fishContours)
+        tBlob += time.perf_counter() - tic
+
+        noFish += fishContours is None
+        same += blobSkeleton is not None and np.array_equal(frameSkeleton, blobSkeleton)
+        nFrames += 1
+
+    logging.info("getFishSkeleton of " + str(videoPath) + ": whole frame " + "{:.3f}".format(1e3*tFrame/nFrames) + " ms/frame, fish blob "
+                 + "{:.3f}".format(1e3*tBlob/nFrames) + " ms/frame (saves " + "{:.3f}".format(1e3*(tFrame-tBlob)/nFrames) + " ms/frame, x"
+                 + "{:.1f}".format(tFrame/tBlob) + "), " + str(same) + "/" + str(nFrames) + " identical skeletons, " + str(noFish) + " frames without fish blob.")
+
+    if same + noFish != nFrames:
+        raise Exception("The skeletons of the fish blob differ from the whole frame ones in " + str(nFrames - noFish - same) + " frames.")
+
+    return tFrame, tBlob
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s: %(message)s (%(funcName)s:%(lineno)d)"
+    )
+
+    videoPath = "./test/testVideo.avi"
+    synthPath = "./test/synthVideo.avi"
+    contrast = config.DEFAULT_CONTRAST
+
+    # Stages on a synthetic video with known kinematics
+    if not pathlib.Path(synthPath).exists():
+        pathlib.Path(synthPath).parent.mkdir(parents=True, exist_ok=True)
+        synthVideo(synthPath, 1000, 1000)
+    truth = loadTruth(synthPath)
+    benchStages(synthPath, tuple(truth["roi"]), contrast, float(truth["fps"]), truth)
+
+    # Thinning of the fish blob on the synthetic video
+    benchSkeleton(synthPath, tuple(truth["roi"]), contrast)
+
+    # Time base and frequencies of the treatment for recordings of other lengths than 1000 frames
+    benchTimeBase(300, 1000)
+    benchTimeBase(2500, 500, 12., failEvery=7)
+
+    # Validators on the detections of the synthetic video, with corrupted frames for each rejection
+    synthDetections = extractDetections(synthPath, tuple(truth["roi"]), contrast)
+    benchCheckFrame(corruptDetections(synthDetections))
+
+    # Extrema of the angles extracted from the synthetic video
+    benchAngleData(detectionAngles(synthDetections, float(truth["fps"])))
+
+    # Deduplication of the skeletons of the synthetic video
+    benchUniqueMean([fishSkeleton for (_fishContours, fishSkeleton) in synthDetections if np.size(fishSkeleton) > 2])
+
+    # Extraction cancelled and resumed from its checkpoint (sequential and threaded)
+    benchCheckpoint(synthPath, tuple(truth["roi"]), contrast, float(truth["fps"]))
+    benchCheckpoint(synthPath, tuple(truth["roi"]), contrast, float(truth["fps"]), threads=2)
+
+    # Streaming treatment of the synthetic video
+    benchStreaming(synthPath, tuple(truth["roi"]), contrast, float(truth["fps"]))
+
+    # Incremental treatment of the synthetic video
+    benchIncremental(synthPath, tuple(truth["roi"]), contrast, float(truth["fps"]))
+
+    # Key points of random skeletons
+    benchKeyPoints(randomSkeletons(20000), repeat=1)
+    benchUniqueMean(randomSkeletons(2000, repeatX=True), repeat=1)
+
+    # Extrema of noisy sinusoids and of the true angles of the synthetic video
+    benchAngleData(randomSinusoids(200) + [(np.arange(len(truth[name]))*(1000/float(truth["fps"])), truth[name]) for name in ("alpha", "beta", "gamma")])
+
+    # Frequency backends on noisy sinusoids of short and long recordings
+    benchFrequencyBackends(randomSinusoids(200, params=True))
+    benchFrequencyBackends(randomSinusoids(20, 60000, params=True))
+
+    # Angles of random key points
+    benchComputeAngle(*randomKeyPoints(100000, 20), repeat=1)
+
+    # Sliding windows of 1 min and 10 min recordings (the same peak of memory)
+    benchWindows(60000)
+    benchWindows(600000)
+    benchWindowTime(2500, 500, 12., failEvery=7)
+    # Windows of a 10 fps recording, with too few frames for the spectrum
+    benchWindowTime(200, 10, 2., failEvery=3)
+
+    # Result file of a long recording
+    benchExport(1000000)
+
+    # Optimized steps against the reference ones on the reference video
+    if pathlib.Path(videoPath).exists():
+        detections = extractDetections(videoPath, fullRoi(videoPath), contrast)
+        benchSkeleton(videoPath, fullRoi(videoPath), contrast, 500)
+        benchCheckFrame(detections)
+        benchKeyPoints([td.prepareSkeleton(fishSkeleton) for (_fishContours, fishSkeleton) in detections if np.size(fishSkeleton) > 2])
+        benchUniqueMean([fishSkeleton for (_fishContours, fishSkeleton) in detections if np.size(fishSkeleton) > 2])
+    else:
+        logging.warning("Reference video not found: " + videoPath)
+
+    logging.info("DONE.")
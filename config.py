@@ -10,7 +10,32 @@ FISH_AREA_MAX = 15000  # Min area of the fish blob
 BOX_AREA_MIN = 20000  # Max area of the fish movement box
 BOX_AREA_MAX = 50000  # Min are of the fish movement box
 
+SINGLE_PASS_BUFFER_MB = 4096 # Max. memory of the buffered frames in a single-pass extraction
+PIPELINE_QUEUE_SIZE = 64 # Max. frames waiting between the stages of the threaded pipeline
+
+MAIN_BOX_STEP = 1 # Use one of every k frames to detect the movement domain (1: all the frames)
+MAIN_BOX_SAMPLES = 0 # Number of time-spaced frames used to detect the movement domain (0: use MAIN_BOX_STEP)
+MAIN_BOX_STABLE = 0 # Stop the detection when the movement domain is unchanged for N samples (0: never)
+
+CHECKPOINT_FRAMES = 0 # Save the state of the extraction every N frames to resume it after a crash (0: off)
+
+STAGE_TIMING = False # Time the stages of the extraction and the treatment (saved in logs/timing.json)
+
 # Treatment Variables
 
 PROPORTION_JOINT = 1/3  # Length proportion of the headP-JointP
 PROPORTION_TORSION = 1/2 # Length proportion of the JointP-TorsionP
+
+INCREMENTAL_TREATMENT = False # Cache the key points of each frame and compute only the new or changed frames
+
+STREAMING_TREATMENT = False # Compute the key points during the extraction and treat the data at its end, without saving/reading the skeletons
+STREAMING_DUMP_SKELETONS = False # Also save the skeletons in a streaming treatment
+
+FREQUENCY_BACKEND = "spline" # Estimator of the tail-beat frequency/amplitude: "spline" (extrema of a cubic spline) or "spectral" (peak of the spectrum)
+SPECTRAL_AMPLITUDE = "peak" # Amplitude of the spectral backend: "peak" (sinusoid of the spectral peak) or "rms" (RMS of the band around the peak)
+
+WINDOW_ANALYSIS = False # Also compute the amplitudes/frequencies in sliding windows of the recording (saved in the result file)
+WINDOW_MS = 1000 # Length of the windows (ms)
+WINDOW_OVERLAP = 0.5 # Overlap of consecutive windows (fraction of the length, in [0,1))
+
+EXPORT_CSV = False # Also export the treated data in a csv file (it is always saved in data/<expID>_result.npz)
@@ -0,0 +1,316 @@
+import json
+import os
+import pathlib
+import shutil
+import struct
+import time
+import zipfile
+
+import numpy as np
+
+# Size in bytes of the .npy headers written by NpyWriter (multiple of 64 to keep the data aligned)
+HEADER_LEN = 128
+
+
+class NpyWriter:
+
+    # Write a .npy file row by row. The header is written with the shape of the rows
+    # appended so far and it is updated when the file is flushed/closed, so the result can be
+    # read with np.load (also with mmap_mode='r').
+    # With nRows > 0 an existing file is continued after its first nRows rows.
+
+    def __init__(self, path, dtype, rowShape=(), nRows=0):
+        self.path = pathlib.Path(path)
+        self.dtype = np.dtype(dtype)
+        self.rowShape = tuple(rowShape)
+        self.nRows = nRows
+
+        if nRows > 0:
+            self.file = open(str(self.path), "r+b")
+            self.file.truncate(HEADER_LEN + nRows*self.dtype.itemsize*int(np.prod(self.rowShape)))
+            self.file.seek(0, 2)
+        else:
+            self.file = open(str(self.path), "wb")
+            self.file.write(self.header())
+
+    def header(self):
+        return npyHeader(self.dtype, (self.nRows,) + self.rowShape)
+
+    def append(self, rows):
+        rows = np.ascontiguousarray(rows, self.dtype).reshape((-1,) + self.rowShape)
+        self.file.write(rows.tobytes())
+        self.nRows += np.size(rows, 0)
+
+    def flush(self):
+        # Update the header with the current shape and write the data to the disk
+        self.file.seek(0)
+        self.file.write(self.header())
+        self.file.seek(0, 2)
+        self.file.flush()
+
+    def close(self):
+        # Update the header with the final shape
+        self.file.seek(0)
+        self.file.write(self.header())
+        self.file.close()
+
+
+def npyHeader(dtype, shape):
+
+    # .npy header (version 1.0) of HEADER_LEN bytes (or the next multiple of 64 for long structured dtypes)
+    header = repr({"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": shape})
+    header = header.ljust(max(HEADER_LEN, -(-(len(header) + 11)//64)*64) - 10 - 1) + "\n"
+    return b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1")
+
+
+class SkeletonStore:
+
+    # Store all the skeletons of an experiment in three files of the skeleton folder:
+    #   expID_points.npy: (N,2) flat array with the points of all the skeletons
+    #   expID_offsets.npy: (nFrames+1) array, the frame i points are points[offsets[i]:offsets[i+1]]
+    #   expID_valid.npy: (nFrames) mask of the valid frames
+    # The legacy layout (one expID_N.npy file per frame) can be written too.
+    # A store is continued from a checkpoint (see checkpoint) with resume={"frames": ..., "rows": ...}.
+
+    def __init__(self, dataPath, expID, legacy=False, name=None, firstFrame=1, resume=None):
+        self.dataPath = dataPath
+        self.expID = expID
+        self.legacy = legacy
+        self.name = expID if name is None else name
+        self.numFrame = firstFrame - 1
+
+        pathlib.Path(dataPath, expID, "skeleton").mkdir(parents=True, exist_ok=True)
+
+        if resume is None:
+            self.offsets = [0]
+            self.valid = []
+            self.points = NpyWriter(storePath(dataPath, expID, "points", self.name), np.int32, (2,))
+        else:
+            # Drop the frames saved after the checkpoint
+            nFrames = resume["frames"]
+            self.offsets = np.load(storePath(dataPath, expID, "offsets", self.name))[:nFrames+1].tolist()
+            self.valid = np.load(storePath(dataPath, expID, "valid", self.name))[:nFrames].tolist()
+            if len(self.valid) != nFrames or self.offsets[-1] != resume["rows"]:
+                raise Exception("The skeleton store does not match the checkpoint.")
+            self.points = NpyWriter(storePath(dataPath, expID, "points", self.name), np.int32, (2,), resume["rows"])
+            self.numFrame += nFrames
+
+    def append(self, skeleton, validFrame):
+        self.numFrame += 1
+
+        if validFrame:
+            self.points.append(np.reshape(skeleton, (-1, 2)))
+        self.offsets.append(self.points.nRows)
+        self.valid.append(validFrame)
+
+        if self.legacy:
+            exportLegacy(self.dataPath, self.expID, skeleton, self.numFrame, validFrame)
+
+    def checkpoint(self):
+        # Save the frames appended so far, returns the state to resume the store
+        self.points.flush()
+        np.save(storePath(self.dataPath, self.expID, "offsets", self.name), np.array(self.offsets, np.int64))
+        np.save(storePath(self.dataPath, self.expID, "valid", self.name), np.array(self.valid, bool))
+
+        return {"frames": len(self.valid), "rows": self.points.nRows}
+
+    def close(self):
+        self.points.close()
+        np.save(storePath(self.dataPath, self.expID, "offsets", self.name), np.array(self.offsets, np.int64))
+        np.save(storePath(self.dataPath, self.expID, "valid", self.name), np.array(self.valid, bool))
+
+
+def storePath(dataPath, expID, field, name=None):
+
+    name = expID if name is None else name
+
+    return pathlib.Path(dataPath, expID, "skeleton", name + "_" + field + ".npy")
+
+
+def exportLegacy(dataPath, expID, fishSkeleton, step, validFrame):
+
+    # Save skeleton to a numpy binary array file *.npy
+    if (validFrame):
+        np.save(pathlib.Path(dataPath, expID, "skeleton", expID + "_" + str(step)), fishSkeleton)
+    else:
+        # Write an empty file if the frame is failed
+        np.save(pathlib.Path(dataPath, expID, "skeleton", expID + "_" + str(step)), 0)
+
+
+def hasStore(dataPath, expID):
+
+    return storePath(dataPath, expID, "offsets").exists()
+
+
+def loadSkeletons(dataPath, expID):
+
+    # Load the skeleton store, the points are memory mapped
+    points = np.load(storePath(dataPath, expID, "points"), mmap_mode="r")
+    offsets = np.load(storePath(dataPath, expID, "offsets"))
+    valid = np.load(storePath(dataPath, expID, "valid"))
+
+    return points, offsets, valid
+
+
+def legacyFiles(dataPath, expID):
+
+    # Per-frame skeleton files (expID_N.npy) of the legacy layout
+    files = pathlib.Path(dataPath, expID, "skeleton").glob(expID + "_*.npy")
+
+    return [f for f in files if f.stem[len(expID)+1:].isdigit()]
+
+
+def countFrames(dataPath, expID):
+
+    if hasStore(dataPath, expID):
+        return np.size(np.load(storePath(dataPath, expID, "valid")))
+
+    return len(legacyFiles(dataPath, expID))
+
+
+def joinStores(dataPath, expID, names, chunkRows=2**20):
+
+    # Join the stores of consecutive frame ranges in one store, deleting the parts
+    points = NpyWriter(storePath(dataPath, expID, "points"), np.int32, (2,))
+    offsets = [np.zeros(1, np.int64)]
+    valid = []
+
+    for name in names:
+        partPoints = np.load(storePath(dataPath, expID, "points", name), mmap_mode="r")
+        partOffsets = np.load(storePath(dataPath, expID, "offsets", name))
+
+        offsets.append(partOffsets[1:] + points.nRows)
+        valid.append(np.load(storePath(dataPath, expID, "valid", name)))
+        for i in range(0, np.size(partPoints, 0), chunkRows):
+            points.append(partPoints[i:i+chunkRows])
+
+        del partPoints
+        for field in ("points", "offsets", "valid"):
+            storePath(dataPath, expID, field, name).unlink()
+
+    points.close()
+    np.save(storePath(dataPath, expID, "offsets"), np.concatenate(offsets))
+    np.save(storePath(dataPath, expID, "valid"), np.concatenate(valid) if valid else np.zeros(0, bool))
+
+
+def resultPath(dataPath, expID):
+
+    return pathlib.Path(dataPath, expID, "data", expID + "_result.npz")
+
+
+def saveResult(dataPath, expID, columns, meta):
+
+    # Save the treated data in a single file: one .npy member per column (in order) and the run
+    # metadata as a JSON string. The members are not compressed, so they can be memory mapped (see loadColumn).
+    # (numpy scalars of the metadata are saved as their Python values and the non-finite ones as null,
+    # NaN is not valid JSON).
+    meta = dict(meta, columns=list(columns))
+    np.savez(str(resultPath(dataPath, expID)), meta=np.array(json.dumps(jsonValue(meta), allow_nan=False)), **columns)
+
+
+def jsonValue(value):
+
+    # Metadata value with Python types and null instead of NaN/inf
+    if isinstance(value, dict):
+        return {key: jsonValue(item) for (key, item) in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [jsonValue(item) for item in value]
+    if isinstance(value, np.generic):
+        value = value.item()
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+
+    return value
+
+
+def saveMember(dataPath, expID, name, blocks, dtype, nRows):
+
+    # Write a (nRows,) array in the result file as a new .npy member (replacing the one of the same name),
+    # streaming its blocks of rows as they come. It is not compressed either, so it can be memory mapped.
+    path = resultPath(dataPath, expID)
+    dropMember(path, name + ".npy")
+
+    dtype = np.dtype(dtype)
+    header = npyHeader(dtype, (nRows,))
+
+    info = zipfile.ZipInfo(name + ".npy", time.localtime()[:6])
+    info.file_size = len(header) + nRows*dtype.itemsize
+
+    rows = 0
+    with zipfile.ZipFile(str(path), "a") as archive:
+        with archive.open(info, "w") as f:
+            f.write(header)
+            for block in blocks:
+                block = np.ascontiguousarray(block, dtype)
+                f.write(block.tobytes())
+                rows += len(block)
+            if rows != nRows:
+                raise Exception("The member " + name + " has " + str(rows) + " rows instead of " + str(nRows) + ": " + str(path))
+
+
+def dropMember(path, member, chunkBytes=2**24):
+
+    # Remove a member of a zip file, copying the other ones (by chunks) to a new file
+    with zipfile.ZipFile(str(path)) as archive:
+        if member not in archive.namelist():
+            return
+        tmpPath = pathlib.Path(path).with_name(pathlib.Path(path).name + ".tmp")
+        with zipfile.ZipFile(str(tmpPath), "w") as copy:
+            for info in archive.infolist():
+                if info.filename == member:
+                    continue
+                copyInfo = zipfile.ZipInfo(info.filename, info.date_time)
+                copyInfo.compress_type = info.compress_type
+                copyInfo.file_size = info.file_size
+                with archive.open(info) as src, copy.open(copyInfo, "w") as dst:
+                    shutil.copyfileobj(src, dst, chunkBytes)
+
+    os.replace(str(tmpPath), str(path))
+
+
+def loadMeta(dataPath, expID):
+
+    # The null amplitudes/frequencies (non-finite when saved) are NaN
+    with np.load(str(resultPath(dataPath, expID))) as result:
+        meta = json.loads(str(result["meta"]))
+
+    for values in meta.get("angles", {}).values():
+        for (key, value) in values.items():
+            if value is None:
+                values[key] = np.nan
+
+    return meta
+
+
+def loadColumn(dataPath, expID, column, mmap=True):
+
+    # Column of the result file, memory mapped from the position of its member in the .npz file
+    path = resultPath(dataPath, expID)
+    if not mmap:
+        with np.load(str(path)) as result:
+            return result[column]
+
+    with zipfile.ZipFile(str(path)) as archive:
+        try:
+            info = archive.getinfo(column + ".npy")
+        except KeyError:
+            raise Exception("The result file has not the column " + column + ": " + str(path))
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise Exception("The column " + column + " is compressed, it can not be memory mapped: " + str(path))
+
+    with open(str(path), "rb") as f:
+        # Skip the local header of the member (its extra field can differ from the central directory one)
+        f.seek(info.header_offset)
+        (nameLen, extraLen) = struct.unpack("<26xHH", f.read(30))
+        f.seek(info.header_offset + 30 + nameLen + extraLen)
+
+        if np.lib.format.read_magic(f) == (1, 0):
+            (shape, fortranOrder, dtype) = np.lib.format.read_array_header_1_0(f)
+        else:
+            (shape, fortranOrder, dtype) = np.lib.format.read_array_header_2_0(f)
+        offset = f.tell()
+
+    if np.prod(shape) == 0:
+        return np.zeros(shape, dtype)
+
+    return np.memmap(str(path), dtype, "r", offset, shape, "F" if fortranOrder else "C")
@@ -2,6 +2,8 @@ import pathlib
 import numpy as np
 import matplotlib.pyplot as plt
 
+from dataStore import resultPath, loadColumn
+
 
 def showData(exportPath, expID, gui=False):
 
@@ -17,7 +19,11 @@ def showData(exportPath, expID, gui=False):
 
 def importMesures(dataPath, expID):
 
-    # Import all the data in npy files
+    # Import the columns of the result file (memory mapped)
+    if resultPath(dataPath, expID).exists():
+        return loadColumn(dataPath, expID, "time"), loadColumn(dataPath, expID, "beta")
+
+    # Import all the data in npy files (experiments treated before the result file)
     ind = np.load(pathlib.Path(dataPath,expID,"data", expID + "_time.npy"))
     beta = np.load(pathlib.Path(dataPath,expID, "data", expID + "_beta.npy"))
 
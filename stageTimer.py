@@ -0,0 +1,140 @@
+import array
+import json
+import logging
+import pathlib
+import time
+
+import numpy as np
+
+import config
+
+
+class StageTimer:
+
+    # Timers and counters of the hot paths of a run. Each call of a stage appends its elapsed
+    # time (s) to a compact array, so the percentiles can be computed at the end of the run.
+    # Usage: t = timer.tic(); ...; t = timer.toc("stage", t)
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.samples = {}
+        self.counters = {}
+
+    def tic(self):
+        return time.perf_counter()
+
+    def toc(self, stage, tic):
+        toc = time.perf_counter()
+        samples = self.samples.get(stage)
+        if samples is None:
+            samples = self.samples.setdefault(stage, array.array("d"))
+        samples.append(toc - tic)
+        return toc
+
+    def count(self, counter, n=1):
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def merge(self, samples, counters):
+        # Add the timers/counters of other timer (i.e. of a worker process)
+        for (stage, values) in samples.items():
+            self.samples.setdefault(stage, array.array("d")).extend(values)
+        for (counter, n) in counters.items():
+            self.count(counter, n)
+
+    def summary(self, nFrames=0, failFrames=0):
+        wallTime = time.perf_counter() - self.start
+
+        stages = {}
+        for (stage, samples) in self.samples.items():
+            values = np.frombuffer(samples, float)*1e3 if len(samples) > 0 else np.zeros(1)
+            (p50, p90, p99) = np.percentile(values, (50, 90, 99))
+            stages[stage] = {
+                "calls": len(samples), "total_s": float(np.sum(values))/1e3, "mean_ms": float(np.mean(values)),
+                "p50_ms": float(p50), "p90_ms": float(p90), "p99_ms": float(p99), "max_ms": float(np.max(values))
+            }
+
+        return {
+            "wall_s": wallTime, "frames": nFrames, "failed_frames": failFrames,
+            "frames_per_s": nFrames/wallTime if wallTime > 0 else 0., "stages": stages, "counters": dict(self.counters)
+        }
+
+
+class NullTimer:
+
+    # Timer of the runs without timing, its calls do nothing
+
+    samples = {}
+    counters = {}
+
+    def tic(self):
+        return 0.
+
+    def toc(self, stage, tic):
+        return 0.
+
+    def count(self, counter, n=1):
+        pass
+
+    def merge(self, samples, counters):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+# Timing switch (see enable) and timer of the current run
+enabled = config.STAGE_TIMING
+current = NULL_TIMER
+
+
+def enable(on=True):
+
+    # Switch the timing on/off, the change applies from the next run
+    global enabled
+    enabled = on
+
+
+def startRun():
+
+    # Timer of a new run (the null timer if the timing is off)
+    global current
+    current = StageTimer() if enabled else NULL_TIMER
+
+    return current
+
+
+def saveSummary(exportPath, expID, section, summary):
+
+    # Write the summary of a run in the section of logs/timing.json (next to the log file)
+    path = pathlib.Path(exportPath, expID, "logs", "timing.json")
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    data = {}
+    if path.exists():
+        with open(str(path)) as f:
+            data = json.load(f)
+    data[section] = summary
+
+    with open(str(path), "w") as f:
+        json.dump(data, f, indent=2)
+
+    logging.info("Stage timing of " + section + " saved in " + str(path))
+
+
+def logSummary(summary):
+
+    # Log the stages sorted by total time
+    for (stage, stats) in sorted(summary["stages"].items(), key=lambda item: -item[1]["total_s"]):
+        logging.info("  " + stage.ljust(16) + "{:9.3f}".format(stats["total_s"]) + " s, " + "{:8.3f}".format(stats["mean_ms"]) + " ms/call, p99 "
+                     + "{:8.3f}".format(stats["p99_ms"]) + " ms")
+
+
+def finishRun(timer, exportPath, expID, section, nFrames=0, failFrames=0):
+
+    # Log and save the summary of a timed run
+    if timer is NULL_TIMER:
+        return
+
+    summary = timer.summary(nFrames, failFrames)
+    logging.info("Stage timing of " + section + ": " + str(nFrames) + " frames, " + "{:.1f}".format(summary["frames_per_s"]) + " frames/s")
+    logSummary(summary)
+    saveSummary(exportPath, expID, section, summary)
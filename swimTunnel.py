@@ -1,10 +1,22 @@
+import collections
+import concurrent.futures
+import json
 import logging
+import multiprocessing
+import os
 import pathlib
+import queue
+import threading
+import time
 
 import numpy as np
 import cv2 as cv
 
 import config
+import stageTimer
+from aviReader import AviReader, MjpgWriter, joinAvi, openVideo
+from dataStore import SkeletonStore, joinStores, storePath
+from treatData import KeyPointSink, treatStream
 
 # Colors
 WHITE = (255, 255, 255)
@@ -12,8 +24,27 @@ GREEN = (51, 153, 0)
 RED = (0, 0, 255)
 BLUE = (255, 153, 0)
 
+# Ellipse structuring element of the morphology operations
+MORPH_SIZE = 2
+MORPH_ELEMENT = cv.getStructuringElement(cv.MORPH_ELLIPSE, (2*MORPH_SIZE+1, 2*MORPH_SIZE+1), (MORPH_SIZE, MORPH_SIZE))
 
-def swimTunnel(videoPath, exportPath, expID, fps, roi=()):
+
+def swimTunnel(videoPath, exportPath, expID, fps, roi=(), singlePass=False, contrast=None, headless=False, progress=None, cancel=None, workers=1, legacyExport=False, threads=0,
+               checkpoint=None, streaming=None, dumpSkeletons=None, writeCsv=None):
+
+    # Headless runs do not open any OpenCV window. The progress is reported through the
+    # progress(numFrame, totalFrames) callback, and the run is aborted when the cancel
+    # token (i.e. a threading.Event) is set.
+    # With workers > 1 the frames are split in ranges extracted in a pool of processes.
+    # The skeletons are saved in a single store, legacyExport also writes one file per frame.
+    # With threads > 0 the decoding, the processing (in threads workers) and the writing run in a threaded pipeline.
+    # If the stage timing is enabled (see stageTimer), the summary is saved in logs/timing.json.
+    # Every checkpoint frames (config.CHECKPOINT_FRAMES if None, 0: off) the state of the extraction is saved,
+    # and a rerun of an unfinished extraction of the same video continues from the last checkpoint.
+    # In streaming mode (config.STREAMING_TREATMENT if None) the key points are computed as the frames are
+    # validated and the data is treated at the end of the extraction (treatData must not be called), the
+    # skeletons are saved only with dumpSkeletons (config.STREAMING_DUMP_SKELETONS if None) and the csv file only
+    # with writeCsv (as in treatData).
 
     # Init. Data
     defaultContrast = config.DEFAULT_CONTRAST
@@ -22,19 +53,43 @@ def swimTunnel(videoPath, exportPath, expID, fps, roi=()):
     bAreaMin = config.BOX_AREA_MIN
     bAreaMax = config.BOX_AREA_MAX
     blankBorder = config.BLANK_BORDER
+    timer = stageTimer.startRun()
 
     videoPath = str(pathlib.Path(videoPath)) # OpenCV do not admit pathlib inside his functions
 
     # Check/Create paths
     pathlib.Path(exportPath, expID, "skeleton").mkdir(parents=True, exist_ok=True)
 
-    # Open the video in a VideoCapture object
-    vid = cv.VideoCapture(videoPath)
-    
-    # Check if the video object has opened the reference
-    if not vid.isOpened():
-        vid.release()
-        raise Exception("Could not open the video reference: " + videoPath)
+    # Streaming treatment
+    streaming = config.STREAMING_TREATMENT if streaming is None else streaming
+    dumpSkeletons = config.STREAMING_DUMP_SKELETONS if dumpSkeletons is None else dumpSkeletons
+    if streaming and workers > 1:
+        raise Exception("The streaming treatment and the parallel extraction can not be combined.")
+
+    # Checkpoint of an unfinished extraction
+    checkpoint = config.CHECKPOINT_FRAMES if checkpoint is None else checkpoint
+    if checkpoint > 0 and workers > 1:
+        logging.warning("The parallel extraction does not save checkpoints.")
+        checkpoint = 0
+    state = loadCheckpoint(videoPath, exportPath, expID, roi) if checkpoint > 0 else None
+    if state is not None and [state.get("streaming", False), state.get("dumpSkeletons", False)] != [streaming, streaming and dumpSkeletons]:
+        logging.warning("The checkpoint was saved with other treatment mode, the extraction starts again.")
+        state = None
+    if state is not None:
+        roi = tuple(state["roi"])
+
+    # Select the region of interest and the contrast
+    if headless:
+        if roi == ():
+            raise Exception("The region of interest must be given in headless mode.")
+        if contrast is None:
+            contrast = defaultContrast
+    elif roi == ():
+        roi = selectRoi(videoPath)
+    (rx, ry, _rw, _rh) = roi
+
+    if singlePass and workers > 1:
+        raise Exception("The single-pass and the parallel extraction can not be combined.")
 
     # Define main objects
     numFrame = 0
@@ -43,106 +98,744 @@ def swimTunnel(videoPath, exportPath, expID, fps, roi=()):
 
     # First video loop. Define a smaller image movement subset and crop it. Choose the ROI and the contrast.
     # The crop region is bigger than the main box. The main box is only to verify the location of the correct blob and to save computations in each step.
-    totalFrames, contrast, (mbx, mby, mbw, mbh) = getMainBox(videoPath, defaultContrast, bAreaMin, bAreaMax, roi)
-
-    # Open the save video object
-    codec = cv.VideoWriter_fourcc('M', 'J', 'P', 'G')
-    out = cv.VideoWriter(str(pathlib.Path(exportPath,expID,expID + ".avi")), codec, fps, (mbw + 2*blankBorder, mbh + 2*blankBorder))
+    # In single-pass mode the ROI frames are buffered in this loop and the video is not decoded again.
+    # A resumed extraction takes them from the checkpoint.
+    frameBuffer = collections.deque() if (singlePass and state is None) else None
+    t = timer.tic()
+    if state is None:
+        totalFrames, contrast, (mbx, mby, mbw, mbh), decodeTime = getMainBox(videoPath, defaultContrast, bAreaMin, bAreaMax, roi, frameBuffer, contrast)
+    else:
+        (totalFrames, contrast, (mbx, mby, mbw, mbh)) = (state["totalFrames"], state["contrast"], state["mainBox"])
+        (numFrame, failFrames, consecFails) = (state["lastFrame"], state["failFrames"], state["consecFails"])
+        fishMomentsPrev = (np.array(state["moments"][0], float), state["moments"][1])
+        logging.info("Resuming the extraction from the checkpoint of the frame " + str(numFrame) + "/" + str(totalFrames) + ".")
+    timer.toc("getMainBox", t)
+
+    if workers > 1:
+        # Extract the frame ranges in parallel and merge them
+        failFrames = extractParallel(videoPath, exportPath, expID, fps, (mbx, mby, mbw, mbh), contrast, totalFrames, workers, progress, cancel, legacyExport)
+        stageTimer.finishRun(timer, exportPath, expID, "swimTunnel", totalFrames, failFrames)
+
+        logging.info("Extraction DONE.")
+        logging.info("Failed frames: " + str(failFrames) + "/" + str(totalFrames))
+
+        return failFrames, contrast
+
+    if frameBuffer is not None and len(frameBuffer) == totalFrames:
+        # Buffered frames are already cropped to the ROI
+        frames = bufferedFrames(frameBuffer)
+        (ox, oy) = (rx, ry)
+        logging.info("Single-pass extraction: second video decode skipped, saved " + "{:.2f}".format(decodeTime) + " s.")
+    else:
+        # Open the video (memory mapped if it is an uncompressed AVI)
+        vid = openVideo(videoPath)
+
+        # Check if the video object has opened the reference
+        if not vid.isOpened():
+            vid.release()
+            raise Exception("Could not open the video reference: " + videoPath)
+
+        vid.set(cv.CAP_PROP_POS_FRAMES, numFrame)
+        frames = readFrames(vid)
+        (ox, oy) = (0, 0)
+
+    # Open the save video and skeleton store objects. With checkpoints the video is written in segments
+    # (a new one after each checkpoint), joined at the end.
+    if checkpoint > 0:
+        out = videoOut = SegmentWriter(exportPath, expID, fps, (mbw + 2*blankBorder, mbh + 2*blankBorder), 0 if state is None else state["segments"])
+    else:
+        out = MjpgWriter(pathlib.Path(exportPath,expID,expID + ".avi"), fps, (mbw + 2*blankBorder, mbh + 2*blankBorder))
+    resume = None if state is None else state["store"]
+    if streaming:
+        # The key points are computed in the sink, the skeletons are saved only if they are dumped
+        dump = SkeletonStore(exportPath, expID, legacyExport, resume=None if resume is None else resume["store"]) if dumpSkeletons else None
+        store = skeletonStore = KeyPointSink(exportPath, expID, config.PROPORTION_JOINT, config.PROPORTION_TORSION, dump, resume=resume)
+    else:
+        store = skeletonStore = SkeletonStore(exportPath, expID, legacyExport, resume=resume)
 
-    # Read the first frame for second video walk
-    _ret, frame = vid.read()
+    # Crop, preprocess and detect the fish contour and skeleton of each frame (Step1/2/3)
+    if threads > 0:
+        results = processFrames(frames, (mbx-ox, mby-oy, mbw, mbh), contrast, fAreaMin, fAreaMax, blankBorder, threads)
+        out = store = PipelineWriter(out, store)
+    else:
+        results = (extractFrame(frame, (mbx-ox, mby-oy, mbw, mbh), contrast, fAreaMin, fAreaMax, blankBorder) for frame in frames)
 
     # Second video loop to find the skeleton and its data
     logging.info("Extracting data...")
 
-    while frame is not None:
-        numFrame += 1
+    try:
+        for (originalFrame, fishContours, fishSkeleton, fishMoments) in results:
+            numFrame += 1
+
+            # Step4 -- Validate and Show/Save the results
+
+            # First frame condition
+            if numFrame == 1:
+                fishMomentsPrev = fishMoments
+
+            # Check the the conditions and save the results
+            t = timer.tic()
+            validFrame = checkFrame(fishSkeleton, fishContours, fishMoments, fishMomentsPrev)
+            timer.toc("checkFrame", t)
+
+            if validFrame:
+                # Export and draw the Results
+                exportResults(store, fishSkeleton, validFrame=True)
+                drawResults(originalFrame, fishContours, fishSkeleton, out, validFrame=True)
+
+                # Reset consecutive failed frames counter
+                consecFails = 0
+
+            else:
+                consecFails += 1
+                failFrames += 1
+
+                # Export Results
+                exportResults(store, fishSkeleton, validFrame=False)
+
+                # Check the fail proportion
+                if (failFrames >= 10*totalFrames/100) or (consecFails >= 5*totalFrames/100):
+                    raise Exception("Too much failed frames! The computation do not proceed, it could be wrong.")
+
+                drawResults(originalFrame, fishContours, fishSkeleton, out, validFrame=False)
+
+            # Save a checkpoint (in the writer thread in the pipeline, after the pending writes)
+            if checkpoint > 0 and numFrame % checkpoint == 0 and numFrame < totalFrames:
+                state = {
+                    "video": videoFingerprint(videoPath), "roi": [int(v) for v in roi], "contrast": contrast, "totalFrames": totalFrames,
+                    "mainBox": [int(mbx), int(mby), int(mbw), int(mbh)], "lastFrame": numFrame, "failFrames": failFrames, "consecFails": consecFails,
+                    "moments": [fishMoments[0].tolist(), bool(fishMoments[1])], "streaming": streaming, "dumpSkeletons": streaming and dumpSkeletons
+                }
+                if threads > 0:
+                    out.submit("checkpoint", saveCheckpoint, exportPath, expID, state, videoOut, skeletonStore)
+                else:
+                    saveCheckpoint(exportPath, expID, state, videoOut, skeletonStore)
+
+            # Report the progress
+            if progress is not None:
+                progress(numFrame, totalFrames)
+
+            if headless:
+                # Abort if the cancel token is set
+                aborted = (cancel is not None) and cancel.is_set()
+            else:
+                # DebugOnly: Show results
+                cv.imshow("Zebra Gait", originalFrame)
+                # Abort if ESC button is pressed
+                aborted = (cv.waitKey(10) == 27) or ((cancel is not None) and cancel.is_set())
+
+            if aborted:
+                raise Exception("Process aborted by the user.")
 
-        # Step1 -- Initial crops/adds
+            # Step5 -- Update the next frame
+            fishMomentsPrev = fishMoments
+
+    finally:
+        # Clean (the windows and the timer too if a writer fails)
+        try:
+            results.close()
+            frames.close()
+            out.release()
+            store.close()
+        finally:
+            if not headless:
+                cv.destroyAllWindows()
+            stageTimer.finishRun(timer, exportPath, expID, "swimTunnel", numFrame, failFrames)
 
-        # Crop the main movement box
-        frame = frame[mby:(mby+mbh), mbx:(mbx+mbw)]
-        # Add a solid border to avoid blob border fusion
-        frame = cv.copyMakeBorder(frame, blankBorder, blankBorder, blankBorder, blankBorder, cv.BORDER_CONSTANT, None, WHITE)
-        # Hard copy of frame without changes
-        originalFrame = frame.copy()
+    # Join the video segments and remove the checkpoint of the finished extraction
+    if checkpoint > 0:
+        videoOut.join()
+        removeCheckpoint(exportPath, expID)
 
-        # Step2 -- PreProcess the image
+    logging.info("Extraction DONE.")
+    logging.info("Failed frames: " + str(failFrames) + "/" + str(totalFrames))
 
-        frame = preprocess(frame, contrast, True, True)
+    # Treat the streamed key points
+    if streaming:
+        treatStream(skeletonStore, exportPath, expID, fps, contrast, failFrames, writeCsv)
+
+    return failFrames, contrast
+
+
+def extractFrame(frame, mainBox, contrast, fAreaMin, fAreaMax, blankBorder):
+
+    (mbx, mby, mbw, mbh) = mainBox
+    timer = stageTimer.current
+    t = timer.tic()
+
+    # Step1 -- Initial crops/adds
+
+    # Crop the main movement box
+    frame = frame[mby:(mby+mbh), mbx:(mbx+mbw)]
+    # Add a solid border to avoid blob border fusion
+    frame = cv.copyMakeBorder(frame, blankBorder, blankBorder, blankBorder, blankBorder, cv.BORDER_CONSTANT, None, WHITE)
+    # The preprocessing does not change its input, so the bordered frame is kept without changes
+    # (the gray frames of the 8-bit videos are drawn in color)
+    originalFrame = frame if frame.ndim == 3 else cv.cvtColor(frame, cv.COLOR_GRAY2BGR)
+    t = timer.toc("crop", t)
+
+    # Step2 -- PreProcess the image
+
+    frame = preprocess(frame, contrast, True, True)
+    t = timer.toc("preprocess", t)
+
+    # Step3 -- Fish contour and fish skeleton detection
+
+    fishContours = getFishContours(frame, fAreaMin, fAreaMax)
+    t = timer.toc("getFishContours", t)
+    fishSkeleton = getFishSkeleton(frame, fishContours)
+    t = timer.toc("getFishSkeleton", t)
+    fishMoments = getShapeMoments(fishContours)
+    timer.toc("getShapeMoments", t)
+
+    return originalFrame, fishContours, fishSkeleton, fishMoments
+
+
+def extractParallel(videoPath, exportPath, expID, fps, mainBox, contrast, totalFrames, workers, progress=None, cancel=None, legacyExport=False):
+
+    # Split the video in one frame range per worker
+    bounds = np.linspace(0, totalFrames, workers+1).astype(int)
+    ranges = [(bounds[i]+1, bounds[i+1]) for i in range(workers) if bounds[i+1] > bounds[i]]
+
+    logging.info("Extracting data in " + str(len(ranges)) + " frame ranges...")
+
+    # The workers stop at the next frame when the shared stop event is set, and report their extracted frames
+    # (one item per range) for the progress
+    manager = multiprocessing.Manager()
+    stop = manager.Event()
+    doneFrames = manager.list([0]*len(ranges))
+
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(extractRange, videoPath, exportPath, expID, fps, mainBox, contrast, firstFrame, lastFrame, totalFrames, part, legacyExport,
+                                   stageTimer.enabled, stop, doneFrames)
+                       for part, (firstFrame, lastFrame) in enumerate(ranges)]
+
+            # Wait the ranges, reporting the progress and attending the cancel token
+            try:
+                pending = set(futures)
+                reported = -1
+                while pending:
+                    done, pending = concurrent.futures.wait(pending, timeout=0.1, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                    if (cancel is not None) and cancel.is_set():
+                        raise Exception("Process aborted by the user.")
+                    numFrame = sum(doneFrames)
+                    if (progress is not None) and numFrame != reported:
+                        progress(numFrame, totalFrames)
+                        reported = numFrame
+            except Exception:
+                # Stop the running ranges (the pool waits them) and drop the queued ones
+                stop.set()
+                for future in futures:
+                    future.cancel()
+                raise
+    except Exception:
+        removeParts(exportPath, expID, len(ranges))
+        raise
+    finally:
+        manager.shutdown()
+
+    results = [future.result() for future in futures]
+
+    # Merge the failure counters. The consecutive failures can run across the ranges.
+    failFrames = 0
+    consecFails = 0
+    maxConsecFails = 0
+    for (rangeFails, leadFails, rangeMaxFails, trailFails, nFrames, _partPath, _partName, (samples, counters)) in results:
+        stageTimer.current.merge(samples, counters)
+        failFrames += rangeFails
+        if leadFails == nFrames:
+            consecFails += nFrames
+        else:
+            maxConsecFails = max(maxConsecFails, consecFails + leadFails, rangeMaxFails)
+            consecFails = trailFails
+    maxConsecFails = max(maxConsecFails, consecFails)
+
+    # Merge the ranges videos and skeleton stores
+    timer = stageTimer.current
+    t = timer.tic()
+    joinVideos([result[5] for result in results], pathlib.Path(exportPath, expID, expID + ".avi"), fps)
+    t = timer.toc("joinVideos", t)
+    joinStores(exportPath, expID, [result[6] for result in results])
+    timer.toc("joinStores", t)
+
+    # Check the fail proportion
+    if (failFrames >= 10*totalFrames/100) or (maxConsecFails >= 5*totalFrames/100):
+        raise Exception("Too much failed frames! The computation do not proceed, it could be wrong.")
+
+    return failFrames
 
-        # Step3 -- Fish contour and fish skeleton detection
 
-        fishContours = getFishContours(frame, fAreaMin, fAreaMax)
-        fishSkeleton = getFishSkeleton(frame)
+def extractRange(videoPath, exportPath, expID, fps, mainBox, contrast, firstFrame, lastFrame, totalFrames, part, legacyExport=False, timing=False,
+                 stop=None, doneFrames=None):
 
-        # Step4 -- Validate and Show/Save the results
+    # The timers of the range are returned to be merged in the main process.
+    # The range is aborted when the stop event is set, and its extracted frames are reported in doneFrames[part].
+    stageTimer.enable(timing)
+    timer = stageTimer.startRun()
+
+    # Init. Data
+    fAreaMin = config.FISH_AREA_MIN
+    fAreaMax = config.FISH_AREA_MAX
+    blankBorder = config.BLANK_BORDER
+    (_mbx, _mby, mbw, mbh) = mainBox
+
+    failFrames = 0
+    consecFails = 0
+    maxConsecFails = 0
+    leadFails = None
+
+    # Open the video (memory mapped if it is an uncompressed AVI)
+    vid = openVideo(videoPath)
+
+    # Check if the video object has opened the reference
+    if not vid.isOpened():
+        vid.release()
+        raise Exception("Could not open the video reference: " + videoPath)
+
+    # Seek one frame before the range (overlap) to initialize the previous fish shape moments
+    overlapFrame = max(firstFrame-1, 1)
+    vid.set(cv.CAP_PROP_POS_FRAMES, overlapFrame-1)
+    frames = readFrames(vid)
+
+    # Open the save video and skeleton store objects of the range
+    partName = expID + "_part" + str(part)
+    partPath = pathlib.Path(exportPath, expID, partName + ".avi")
+    out = MjpgWriter(partPath, fps, (mbw + 2*blankBorder, mbh + 2*blankBorder))
+    store = SkeletonStore(exportPath, expID, legacyExport, partName, firstFrame)
+
+    numFrame = overlapFrame - 1
+    for frame in frames:
+        numFrame += 1
+
+        originalFrame, fishContours, fishSkeleton, fishMoments = extractFrame(frame, mainBox, contrast, fAreaMin, fAreaMax, blankBorder)
 
         # First frame condition
-        if numFrame == 1:
-            fishContoursPrev = fishContours
-        
+        if numFrame == overlapFrame:
+            fishMomentsPrev = fishMoments
+            if numFrame < firstFrame:
+                continue
+
         # Check the the conditions and save the results
-        if checkFrame(fishSkeleton, fishContours, fishContoursPrev):
-            # Export and draw the Results
-            exportResults(exportPath, expID, fishSkeleton, numFrame, validFrame=True)
+        t = timer.tic()
+        validFrame = checkFrame(fishSkeleton, fishContours, fishMoments, fishMomentsPrev)
+        timer.toc("checkFrame", t)
+
+        if validFrame:
+            exportResults(store, fishSkeleton, validFrame=True)
             drawResults(originalFrame, fishContours, fishSkeleton, out, validFrame=True)
 
-            # Reset consecutive failed frames counter
+            if leadFails is None:
+                leadFails = consecFails
             consecFails = 0
-
-            # DebugOnly: Show results
-            cv.imshow("Zebra Gait", originalFrame)
-            # Abort if ESC button is pressed
-            if cv.waitKey(10) == 27:
-                vid.release()
-                cv.destroyAllWindows()
-                raise Exception("Process aborted by the user.")
-            
         else:
             consecFails += 1
             failFrames += 1
+            maxConsecFails = max(maxConsecFails, consecFails)
 
-            # Export Results
-            exportResults(exportPath, expID, fishSkeleton, numFrame, validFrame=False)
+            exportResults(store, fishSkeleton, validFrame=False)
 
-            # Check the fail proportion
+            # Check the fail proportion (the range failures are a lower bound of the total ones)
             if (failFrames >= 10*totalFrames/100) or (consecFails >= 5*totalFrames/100):
-                vid.release()
-                cv.destroyAllWindows()
-                raise Exception("Too much failed frames! The computation do not proceed, it could be wrong.")   
-
-            drawResults(originalFrame, fishContours, fishSkeleton, out, validFrame=False)
-            
-            # DebugOnly: Show results
-            cv.imshow("Zebra Gait", originalFrame)
-            # Abort if ESC button is pressed
-            if cv.waitKey(10) == 27:
-                vid.release()
-                cv.destroyAllWindows()
-                raise Exception("Process aborted by the user.")
+                frames.close()
+                out.release()
+                store.close()
+                raise Exception("Too much failed frames! The computation do not proceed, it could be wrong.")
+
+        # Report the progress and attend the stop event
+        if doneFrames is not None:
+            doneFrames[part] = numFrame - firstFrame + 1
+        if (stop is not None) and stop.is_set():
+            frames.close()
+            out.release()
+            store.close()
+            raise Exception("Process aborted by the user.")
+
+        fishMomentsPrev = fishMoments
+        if numFrame == lastFrame:
+            break
+
+    # Clean
+    frames.close()
+    out.release()
+    store.close()
+
+    nFrames = numFrame - firstFrame + 1
+    if leadFails is None:
+        leadFails = nFrames
+
+    return failFrames, leadFails, maxConsecFails, consecFails, nFrames, partPath, partName, (timer.samples, timer.counters)
+
+
+def removeParts(exportPath, expID, nParts):
+
+    # Delete the videos and the skeleton stores of the frame ranges of an aborted extraction
+    for part in range(nParts):
+        partName = expID + "_part" + str(part)
+        paths = [pathlib.Path(exportPath, expID, partName + ".avi")] + [storePath(exportPath, expID, field, partName) for field in ("points", "offsets", "valid")]
+        for path in paths:
+            if path.exists():
+                path.unlink()
+
+
+def joinVideos(partPaths, videoPath, fps):
+
+    # Concatenate the videos in one file (without decoding them), deleting the parts
+    joinAvi(partPaths, videoPath, fps)
+    for partPath in partPaths:
+        pathlib.Path(partPath).unlink()
+
+
+class MeteredQueue(queue.Queue):
+
+    # Bounded queue that measures its depth and the time the producers/consumers are stalled on it
+
+    def __init__(self, name, maxsize):
+        queue.Queue.__init__(self, maxsize)
+        self.name = name
+        self.nPuts = 0
+        self.depthSum = 0
+        self.depthMax = 0
+        self.putStall = 0.
+        self.getStall = 0.
+
+    def putWait(self, item, stop):
+        # Put blocking while the queue is full (backpressure) until the stop event is set
+        tic = time.perf_counter()
+        while not stop.is_set():
+            try:
+                self.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                pass
+        self.putStall += time.perf_counter() - tic
+
+        depth = self.qsize()
+        self.nPuts += 1
+        self.depthSum += depth
+        self.depthMax = max(self.depthMax, depth)
+
+    def getWait(self, stop=None):
+        # Get blocking while the queue is empty until the stop event is set (then None is returned)
+        tic = time.perf_counter()
+        item = None
+        while (stop is None) or (not stop.is_set()):
+            try:
+                item = self.get(timeout=0.1)
+                break
+            except queue.Empty:
+                pass
+        self.getStall += time.perf_counter() - tic
+        return item
+
+    def logMetrics(self):
+        meanDepth = self.depthSum/self.nPuts if self.nPuts > 0 else 0.
+        logging.info("Queue " + self.name + ": depth mean " + "{:.1f}".format(meanDepth) + ", max " + str(self.depthMax) + "/" + str(self.maxsize)
+                     + "; producers stalled " + "{:.2f}".format(self.putStall) + " s, consumers stalled " + "{:.2f}".format(self.getStall) + " s.")
+
+
+def processFrames(frames, mainBox, contrast, fAreaMin, fAreaMax, blankBorder, threads, queueSize=None):
+
+    # Threaded decode -> process pipeline. A decoder thread walks the frames and a pool of threads
+    # runs extractFrame on them (OpenCV releases the GIL), the results are yielded in frame order.
+    if queueSize is None:
+        queueSize = config.PIPELINE_QUEUE_SIZE
+
+    stop = threading.Event()
+    decodeQueue = MeteredQueue("decode->process", queueSize)
+    processQueue = MeteredQueue("process->validate", queueSize)
+
+    # Frames decoded and not yielded yet (at most queueSize): a slow frame stops the decoder instead of
+    # letting the next ones fill the reorder buffer
+    slots = threading.Semaphore(queueSize)
+
+    def decode():
+        try:
+            for numFrame, frame in enumerate(frames):
+                while not (stop.is_set() or slots.acquire(timeout=0.1)):
+                    pass
+                if stop.is_set():
+                    break
+                decodeQueue.putWait((numFrame, frame), stop)
+        except Exception as err:
+            processQueue.putWait((-1, err), stop)
+        finally:
+            for _ in range(threads):
+                decodeQueue.putWait(None, stop)
+
+    def process():
+        while True:
+            task = decodeQueue.getWait(stop)
+            if task is None:
+                processQueue.putWait(None, stop)
+                break
+            (numFrame, frame) = task
+            try:
+                processQueue.putWait((numFrame, extractFrame(frame, mainBox, contrast, fAreaMin, fAreaMax, blankBorder)), stop)
+            except Exception as err:
+                processQueue.putWait((-1, err), stop)
+
+    pool = [threading.Thread(target=decode, daemon=True)] + [threading.Thread(target=process, daemon=True) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+
+    # Reorder the processed frames
+    try:
+        pending = {}
+        pendingMax = 0
+        nextFrame = 0
+        running = threads
+        while running > 0 or pending:
+            if nextFrame in pending:
+                slots.release()
+                yield pending.pop(nextFrame)
+                nextFrame += 1
+                continue
+            if running == 0:
+                break
+
+            result = processQueue.getWait()
+            if result is None:
+                running -= 1
+            elif result[0] < 0:
+                raise result[1]
+            else:
+                pending[result[0]] = result[1]
+                pendingMax = max(pendingMax, len(pending))
+    finally:
+        # Stop and release the threads
+        stop.set()
+        for thread in pool:
+            thread.join()
+
+        decodeQueue.logMetrics()
+        processQueue.logMetrics()
+        logging.info("Reorder buffer: max " + str(pendingMax) + "/" + str(queueSize) + " frames.")
+
+
+class PipelineWriter(threading.Thread):
+
+    # Writer thread of the pipeline. It works as the VideoWriter and the SkeletonStore objects,
+    # encoding the video frames and saving the skeletons in order out of the validation loop.
+
+    def __init__(self, out, store, queueSize=None):
+        threading.Thread.__init__(self, daemon=True)
+        self.out = out
+        self.store = store
+        self.tasks = MeteredQueue("validate->write", config.PIPELINE_QUEUE_SIZE if queueSize is None else queueSize)
+        self.stop = threading.Event()
+        self.error = None
+        self.start()
+
+    def run(self):
+        timer = stageTimer.current
+        while True:
+            task = self.tasks.getWait()
+            if task is None:
+                break
+            if self.error is None:
+                try:
+                    (stage, func, args) = task
+                    t = timer.tic()
+                    func(*args)
+                    timer.toc(stage, t)
+                except Exception as err:
+                    self.error = err
+
+    def submit(self, stage, func, *args):
+        if self.error is not None:
+            raise self.error
+        self.tasks.putWait((stage, func, args), self.stop)
+
+    def write(self, frame):
+        self.submit("writeVideo", self.out.write, frame)
+
+    def append(self, skeleton, validFrame):
+        self.submit("writeStore", self.store.append, skeleton, validFrame)
+
+    def close(self):
+        # Flush the pending tasks and release the writers (only once)
+        if self.is_alive():
+            self.tasks.put(None)
+            self.join()
+            self.out.release()
+            self.store.close()
+            self.tasks.logMetrics()
+        if self.error is not None:
+            raise self.error
+
+    def release(self):
+        self.close()
+
+
+class SegmentWriter:
+
+    # Video writer in segments (expID_segN.avi). The segment is closed at each checkpoint, so the
+    # video saved before a checkpoint is readable after a crash. The segments are joined at the end (without
+    # decoding them, see joinVideos).
+
+    def __init__(self, exportPath, expID, fps, frameSize, segment=0):
+        self.exportPath = exportPath
+        self.expID = expID
+        self.fps = fps
+        self.frameSize = frameSize
+        self.segment = segment
+
+        # Remove the segments written after the checkpoint
+        for path in pathlib.Path(exportPath, expID).glob(expID + "_seg*.avi"):
+            index = path.stem[len(expID)+4:]
+            if index.isdigit() and int(index) >= segment:
+                path.unlink()
+
+        self.open()
+
+    def segmentPath(self, segment):
+        return pathlib.Path(self.exportPath, self.expID, self.expID + "_seg" + str(segment) + ".avi")
+
+    def open(self):
+        self.out = MjpgWriter(self.segmentPath(self.segment), self.fps, self.frameSize)
+
+    def write(self, frame):
+        self.out.write(frame)
+
+    def rotate(self):
+        # Close the current segment and open the next one
+        self.out.release()
+        self.segment += 1
+        self.open()
+
+    def release(self):
+        self.out.release()
+
+    def join(self):
+        paths = [self.segmentPath(i) for i in range(self.segment+1)]
+        joinVideos([path for path in paths if path.exists()], pathlib.Path(self.exportPath, self.expID, self.expID + ".avi"), self.fps)
+
+
+def checkpointPath(exportPath, expID):
+
+    return pathlib.Path(exportPath, expID, expID + "_checkpoint.json")
+
+
+def videoFingerprint(videoPath):
+
+    # Identify the video of a checkpoint by its path, size and modification time
+    stat = os.stat(videoPath)
+
+    return {"path": str(pathlib.Path(videoPath).resolve()), "size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def loadCheckpoint(videoPath, exportPath, expID, roi=()):
 
-        # Step5 -- Update the next frame
-        fishContoursPrev = fishContours
+    # State of the last checkpoint of the extraction (None if there is not a valid one)
+    path = checkpointPath(exportPath, expID)
+    if not path.exists():
+        return None
+
+    with open(str(path)) as f:
+        state = json.load(f)
+
+    if state["video"] != videoFingerprint(videoPath):
+        logging.warning("The checkpoint belongs to other video, the extraction starts again.")
+        return None
+    if roi != () and tuple(roi) != tuple(state["roi"]):
+        logging.warning("The checkpoint has other region of interest, the extraction starts again.")
+        return None
+
+    return state
+
+
+def saveCheckpoint(exportPath, expID, state, videoOut, store):
+
+    # Close the video segment and save the store before the state (written through a temporary file)
+    videoOut.rotate()
+    state["segments"] = videoOut.segment
+    state["store"] = store.checkpoint()
+
+    path = checkpointPath(exportPath, expID)
+    tmpPath = path.with_name(path.name + ".tmp")
+    with open(str(tmpPath), "w") as f:
+        json.dump(state, f)
+    os.replace(str(tmpPath), str(path))
+
+    logging.info("Checkpoint saved at the frame " + str(state["lastFrame"]) + ".")
+
+
+def removeCheckpoint(exportPath, expID):
+
+    path = checkpointPath(exportPath, expID)
+    if path.exists():
+        path.unlink()
+
+
+def readFrames(vid):
+
+    # Walk the video frames, releasing the reference when the walk ends or is closed
+    timer = stageTimer.current
+    try:
+        t = timer.tic()
         _ret, frame = vid.read()
+        timer.toc("decode", t)
+        while frame is not None:
+            yield frame
+            t = timer.tic()
+            _ret, frame = vid.read()
+            timer.toc("decode", t)
+    finally:
+        vid.release()
 
-    # Clean
+
+def bufferedFrames(frameBuffer):
+
+    # Walk the frames buffered in the first loop, freeing them as they are consumed
+    try:
+        while frameBuffer:
+            yield frameBuffer.popleft()
+    finally:
+        frameBuffer.clear()
+
+
+def selectRoi(videoPath):
+
+    # Open the video and select the region of interest on the first frame
+    vid = openVideo(videoPath)
+    if not vid.isOpened():
+        vid.release()
+        raise Exception("Could not open the video reference: " + videoPath)
+
+    _ret, frame = vid.read()
     vid.release()
-    out.release()
+
+    roi = cv.selectROI("Crop the region of interest", frame)
     cv.destroyAllWindows()
 
-    logging.info("Extraction DONE.")
-    logging.info("Failed frames: " + str(failFrames) + "/" + str(totalFrames))
+    return roi
 
-    return failFrames, contrast
+
+def selectContrast(videoPath, roi, defaultContrast=config.DEFAULT_CONTRAST):
+
+    # Open the video and choose the contrast on the region of interest of the first frame
+    vid = openVideo(videoPath)
+    if not vid.isOpened():
+        vid.release()
+        raise Exception("Could not open the video reference: " + videoPath)
+
+    _ret, frame = vid.read()
+    vid.release()
+
+    (rx, ry, rw, rh) = roi
+    if rh == 0 or rw == 0:
+        raise Exception("The cropped region is empty.")
+
+    return getContrast(defaultContrast, frame[ry:(ry+rh), rx:(rx+rw)])
 
 
 def getMovementBox(frame):
 
     # Dilate one time the image for a better edges detection
-    morphSize = 2
-    element = cv.getStructuringElement(cv.MORPH_ELLIPSE, (2*morphSize+1, 2*morphSize+1), (morphSize, morphSize))
-    frame = cv.morphologyEx(frame, cv.MORPH_DILATE, element)
+    frame = cv.morphologyEx(frame, cv.MORPH_DILATE, MORPH_ELEMENT)
 
     # Auto Canny Edge-Detection
     v = np.median(frame)
@@ -166,24 +859,45 @@ def getMovementBox(frame):
     return np.array([mx, my, mw, mh], int)
 
 
-def getMainBox(videoPath, defaultContrast, bAreaMin, bAreaMax, roi):
+def getMainBox(videoPath, defaultContrast, bAreaMin, bAreaMax, roi, frameBuffer=None, contrast=None):
 
     totalFrames = 0
+    decodeTime = 0.
     layer = 10 # secure layer/border in pixels
+    bufferMax = config.SINGLE_PASS_BUFFER_MB*1024**2 # max. size in bytes of the buffered frames
+    bufferSize = 0
 
-    # Open the video in a VideoCapture object
-    backVid = cv.VideoCapture(videoPath)
+    # Open the video (memory mapped if it is an uncompressed AVI)
+    backVid = openVideo(videoPath)
 
     # Check if the video object has opened the reference
     if not backVid.isOpened():
         backVid.release()
         raise Exception("Could not open the video reference: " + videoPath)
 
+    # The frames of a memory-mapped video are not decoded, reading them again is cheaper than buffering them
+    if frameBuffer is not None and isinstance(backVid, AviReader):
+        logging.info("Memory-mapped video: the frames are not buffered for a single-pass extraction.")
+        frameBuffer = None
+
+    # Frames used to detect the movement domain (all of them in a single-pass extraction)
+    sampled = (frameBuffer is None) and (config.MAIN_BOX_STEP > 1 or config.MAIN_BOX_SAMPLES > 0 or config.MAIN_BOX_STABLE > 0)
+    if sampled:
+        totalFrames = getFrameCount(backVid)
+        if config.MAIN_BOX_SAMPLES > 0:
+            samples = np.unique(np.linspace(0, totalFrames-1, config.MAIN_BOX_SAMPLES).astype(int))
+        else:
+            samples = np.arange(0, totalFrames, max(config.MAIN_BOX_STEP, 1))
+        numSample = 0
+        stableSamples = 0
+
     # Create Background Subtractor object
     pMOG2 = cv.createBackgroundSubtractorMOG2(history=0, detectShadows=False)
 
     # Read the first frame to select the area to track
+    tic = time.perf_counter()
     _ret, backFrame = backVid.read()
+    decodeTime += time.perf_counter() - tic
 
     # Select the region of interest and the contrast
     if roi == ():
@@ -194,7 +908,8 @@ def getMainBox(videoPath, defaultContrast, bAreaMin, bAreaMax, roi):
 
     if rh == 0 or rw == 0:
         raise Exception("The cropped region is empty.")
-    contrast = getContrast(defaultContrast, backFrame[ry:(ry+rh), rx:(rx+rw)])
+    if contrast is None:
+        contrast = getContrast(defaultContrast, backFrame[ry:(ry+rh), rx:(rx+rw)])
 
     # Init. main box of the union
     (mbx, mby, mbw, mbh) = (np.size(backFrame, 0), np.size(backFrame, 1), -np.size(backFrame, 0), -np.size(backFrame, 1))
@@ -203,16 +918,28 @@ def getMainBox(videoPath, defaultContrast, bAreaMin, bAreaMax, roi):
     logging.info("Detecting the movement domain...")
     while backFrame is not None:
         
-        totalFrames += 1
+        if not sampled:
+            totalFrames += 1
 
         # Step1 -- Crop the region of interest
         backFrame = backFrame[ry:(ry+rh), rx:(rx+rw)]
 
+        # Buffer a hard copy of the cropped frame for a single-pass extraction
+        if frameBuffer is not None:
+            bufferSize += backFrame.nbytes
+            if bufferSize > bufferMax:
+                frameBuffer.clear()
+                frameBuffer = None
+                logging.warning("The video does not fit in the single-pass buffer, it will be decoded twice.")
+            else:
+                frameBuffer.append(backFrame.copy())
+
         # Step2 -- Update of the background model and the movement domain
         backFrame = preprocess(backFrame, contrast, True, False)
         backFrame = pMOG2.apply(backFrame)
 
         (mx, my, mw, mh) = getMovementBox(backFrame)
+        stageTimer.current.count("mainBoxFrames")
 
         # Step3 -- Join the boxes omiting the limit ones
         if (mw*mh > bAreaMin) and (mw*mh < bAreaMax):
@@ -221,6 +948,11 @@ def getMainBox(videoPath, defaultContrast, bAreaMin, bAreaMax, roi):
             w = max(mx+mw, mbx+mbw) - x
             h = max(my+mh, mby+mbh) - y
 
+            if sampled and ((x, y, w, h) == (mbx, mby, mbw, mbh)):
+                stableSamples += 1
+            elif sampled:
+                stableSamples = 0
+
             (mbx, mby, mbw, mbh) = (x, y, w, h) 
 
         # # DebugOnly: Show the boxes union
@@ -229,9 +961,24 @@ def getMainBox(videoPath, defaultContrast, bAreaMin, bAreaMax, roi):
         # cv.imshow("Main box", backFrame)
         # cv.waitKey(1)
 
+        # Stop when the movement domain is stable or all the samples are used
+        if sampled:
+            numSample += 1
+            if config.MAIN_BOX_STABLE > 0 and stableSamples >= config.MAIN_BOX_STABLE:
+                logging.info("Movement domain stable after " + str(numSample) + " samples.")
+                break
+            if numSample == len(samples):
+                break
+            if samples[numSample] != samples[numSample-1] + 1:
+                backVid.set(cv.CAP_PROP_POS_FRAMES, int(samples[numSample]))
+
         # Update the frame
+        tic = time.perf_counter()
         _ret, backFrame = backVid.read()
+        decodeTime += time.perf_counter() - tic
 
+    if sampled:
+        logging.info("Movement domain detected with " + str(numSample) + " of " + str(totalFrames) + " frames.")
     logging.info("Movement domain defined.")
     backVid.release()
     
@@ -251,7 +998,31 @@ def getMainBox(videoPath, defaultContrast, bAreaMin, bAreaMax, roi):
     mbx = mbx + rx
     mby = mby + ry
 
-    return totalFrames, contrast, np.array([mbx,mby,mbw,mbh], int)
+    return totalFrames, contrast, np.array([mbx,mby,mbw,mbh], int), decodeTime
+
+
+def getFrameCount(vid):
+
+    # Number of frames of the container metadata, validated reading the last frame
+    position = vid.get(cv.CAP_PROP_POS_FRAMES)
+    count = int(vid.get(cv.CAP_PROP_FRAME_COUNT))
+
+    valid = False
+    if count > 0:
+        vid.set(cv.CAP_PROP_POS_FRAMES, count-1)
+        valid = vid.grab() and not vid.grab()
+
+    # Count the frames if the metadata is wrong
+    if not valid:
+        logging.warning("The frame count of the video metadata is not valid, counting the frames...")
+        vid.set(cv.CAP_PROP_POS_FRAMES, 0)
+        count = 0
+        while vid.grab():
+            count += 1
+
+    vid.set(cv.CAP_PROP_POS_FRAMES, position)
+
+    return count
 
 
 def getContrast(defaultContrast, frame):
@@ -281,8 +1052,9 @@ def getContrast(defaultContrast, frame):
 
 def preprocess(frame, contrast, blur, threshold):
 
-    # B&W, normalize, contrast
-    frame = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+    # B&W (the frames of the 8-bit videos are already gray), normalize, contrast
+    if frame.ndim == 3:
+        frame = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
     frame = cv.normalize(frame, None, 0, 255, cv.NORM_MINMAX)
     frame = cv.convertScaleAbs(frame, alpha=contrast, beta=0)
 
@@ -296,10 +1068,8 @@ def preprocess(frame, contrast, blur, threshold):
         _ret, frame = cv.threshold(frame, 0, 255, cv.THRESH_BINARY_INV+cv.THRESH_OTSU)
      
         # Dilate and close the image for a better edges detection
-        morphSize = 2
-        element = cv.getStructuringElement(cv.MORPH_ELLIPSE, (2*morphSize+1, 2*morphSize+1), (morphSize, morphSize))
-        frame = cv.morphologyEx(frame, cv.MORPH_DILATE, element, iterations=2)
-        frame = cv.morphologyEx(frame, cv.MORPH_CLOSE, element, iterations=2) 
+        frame = cv.morphologyEx(frame, cv.MORPH_DILATE, MORPH_ELEMENT, iterations=2)
+        frame = cv.morphologyEx(frame, cv.MORPH_CLOSE, MORPH_ELEMENT, iterations=2)
 
     # # DebugOnly: Show preprocess image
     # cv.imshow("PreProcess",frame)
@@ -320,9 +1090,9 @@ def getFishContours(frame, fAreaMin, fAreaMax):
     # Find and draw Contours
     contours, _hier = cv.findContours(frame, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)
 
-    # Delete unnecessary blobs
-    iFishContour = 0
-    for i in range(np.size(contours, 0)):
+    # Delete unnecessary blobs (None if no blob has the fish area)
+    iFishContour = None
+    for i in range(len(contours)):
 
         area = cv.contourArea(contours[i])
         if (area > fAreaMin) and (area < fAreaMax):
@@ -340,20 +1110,39 @@ def getFishContours(frame, fAreaMin, fAreaMax):
     # cv.imshow("All Contours",drawing2)
     # cv.waitKey(0)
 
+    if iFishContour is None:
+        return None
+
     return contours[iFishContour]
 
 
-def getFishSkeleton(frame):
+def getFishSkeleton(frame, fishContours):
+
+    # Without fish blob there is nothing to thin
+    if fishContours is None:
+        return None
+
+    # Render the fish blob in a sub-image of its bounding box (plus a blank margin of 2 pixels): the pixels
+    # of the frame inside its contour (the edge pixels of Canny are on both sides of the blob border).
+    (fx, fy, fw, fh) = cv.boundingRect(fishContours)
+    (x0, y0) = (max(fx - 2, 0), max(fy - 2, 0))
+    (x1, y1) = (min(fx + fw + 2, np.size(frame, 1)), min(fy + fh + 2, np.size(frame, 0)))
+    mask = np.zeros((y1 - y0, x1 - x0), np.uint8)
+    cv.drawContours(mask, [fishContours], 0, 255, cv.FILLED, offset=(-x0, -y0))
+    cv.drawContours(mask, [fishContours], 0, 255, 3, offset=(-x0, -y0))
+    blob = cv.bitwise_and(frame[y0:y1, x0:x1], mask)
 
     # Find the skeleton through Zhang-Suen thinning 
-    frame = cv.ximgproc.thinning(frame, thinningType=cv.ximgproc.THINNING_ZHANGSUEN)
+    blob = cv.ximgproc.thinning(blob, thinningType=cv.ximgproc.THINNING_ZHANGSUEN)
     
-    # Find the Skeleton
-    contours, _hier = cv.findContours(frame, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE)
+    # Find the Skeleton (in the frame basis)
+    contours, _hier = cv.findContours(blob, cv.RETR_EXTERNAL, cv.CHAIN_APPROX_NONE, offset=(x0, y0))
+    if len(contours) == 0:
+        return None
 
     # Delete unnecessary lines
-    maxLen = 0
-    for i in range(np.size(contours,0)):
+    maxLen = -1
+    for i in range(len(contours)):
         length = cv.arcLength(contours[i], False)
         if length > maxLen:
             maxLen = length
@@ -362,26 +1151,64 @@ def getFishSkeleton(frame):
     return contours[iFishSkeleton]
 
 
-def checkFrame(fishSkeleton,fishContours, fishContoursPrev):
+def getShapeMoments(fishContours):
+
+    # Hu moments of the fish contour in the log scale used by cv.matchShapes (CONTOURS_MATCH_I3).
+    # They are computed once per frame and reused as the previous moments of the next frame.
+    # A frame without fish blob has not moments.
+    if fishContours is None:
+        return np.full(7, np.nan), False
+
+    eps = 1.e-5
+    huMoments = cv.HuMoments(cv.moments(fishContours)).flatten()
+
+    # Signed log10 of the moments above eps, sign(hu)*log10(|hu|) as in OpenCV
+    logMoments = np.full(7, np.nan)
+    large = np.abs(huMoments) > eps
+    logMoments[large] = np.sign(huMoments[large])*np.log10(np.abs(huMoments[large]))
+
+    return logMoments, bool(np.any(huMoments != 0))
+
+
+def matchShapeMoments(fishMoments, fishMomentsPrev):
+
+    # Same measure than cv.matchShapes(fishContours, fishContoursPrev, 3, 0.0) from the cached moments
+    (logMoments, anyMoments) = fishMoments
+    (logMomentsPrev, anyMomentsPrev) = fishMomentsPrev
+
+    if anyMoments != anyMomentsPrev:
+        return np.finfo(float).max
+
+    valid = ~(np.isnan(logMoments) | np.isnan(logMomentsPrev))
+    if not np.any(valid):
+        return 0.
+
+    return max(0., np.max(np.abs((logMoments[valid] - logMomentsPrev[valid]) / logMoments[valid])))
+
+
+def checkFrame(fishSkeleton, fishContours, fishMoments, fishMomentsPrev):
+
+    # Check that the fish blob and its skeleton are found
+    if fishContours is None or fishSkeleton is None:
+        return False
 
     # Check the ressemblance of the blob detected fish shape in the previous frame
-    if cv.matchShapes(fishContours, fishContoursPrev, 3, 0.0) > 0.1:
+    if matchShapeMoments(fishMoments, fishMomentsPrev) > 0.1:
         return False
 
     # Check if the fish rect. boundary contains the fish skeleton
     (fx, fy, fw, fh) = cv.boundingRect(fishContours)
-    for i in range(np.size(fishSkeleton, 0)):
-        if not ((fx < fishSkeleton[i][0, 0] < (fx+fw)) and (fy < fishSkeleton[i][0, 1] < (fy+fh))):
-            return False
-    
-    # Check if the skeleton contains branches
     fishSkeleton = np.reshape(fishSkeleton, (np.size(fishSkeleton, 0), 2))  # convert the array-points to a matrix
-    fishSkeleton = fishSkeleton[np.argsort(fishSkeleton[:, 0])]  # sort points by x
+    x = fishSkeleton[:, 0]
+    y = fishSkeleton[:, 1]
+    if not np.all((fx < x) & (x < (fx+fw)) & (fy < y) & (y < (fy+fh))):
+        return False
+
+    # Check if the skeleton contains branches (points with the same x and far y once sorted by x)
+    fishSkeleton = fishSkeleton[np.argsort(x)]  # sort points by x
+    if np.any((np.diff(fishSkeleton[:, 0]) == 0) & (np.abs(np.diff(fishSkeleton[:, 1])) > 3)):
+        return False
 
-    for i in range(1, len(fishSkeleton)):
-        if (fishSkeleton[i-1, 0] == fishSkeleton[i, 0]) and (np.abs(fishSkeleton[i-1, 1]-fishSkeleton[i, 1])>3):
-            return False
-    
     return True
 
 
@@ -392,21 +1219,25 @@ def drawResults(frame, contours, skeleton, vidOut, validFrame=False):
     # cv.rectangle(frame, (fx,fy),(fw+fx,fy+fh), GREEN, 1, 8, 0)
 
     # Draw and Save the frame in file
-    cv.drawContours(frame, contours, -1, BLUE, 1)
-    cv.drawContours(frame, skeleton, -1, RED, 1)
+    timer = stageTimer.current
+    t = timer.tic()
+    if contours is not None:
+        cv.drawContours(frame, contours, -1, BLUE, 1)
+    if skeleton is not None:
+        cv.drawContours(frame, skeleton, -1, RED, 1)
 
     if validFrame:
         vidOut.write(frame)
+    timer.toc("drawResults", t)
 
 
-def exportResults(dataPath, expID, fishSkeleton, step, validFrame):
+def exportResults(store, fishSkeleton, validFrame):
 
-    # Save skeleton to a numpy binary array file *.npy
-    if (validFrame):
-        np.save(pathlib.Path(dataPath, expID, "skeleton", expID + "_" + str(step)), fishSkeleton)
-    else:
-        # Write an empty file if the frame is failed
-        np.save(pathlib.Path(dataPath, expID, "skeleton", expID + "_" + str(step)), 0)
+    # Append the skeleton to the experiment store (failed frames are saved as empty)
+    timer = stageTimer.current
+    t = timer.tic()
+    store.append(fishSkeleton, validFrame)
+    timer.toc("exportResults", t)
 
 
 if __name__ == "__main__":
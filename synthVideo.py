@@ -0,0 +1,170 @@
+import logging
+import pathlib
+
+import numpy as np
+import cv2 as cv
+
+import config
+from aviReader import AviWriter
+
+# Colors of the synthetic scene (BGR)
+BACKGROUND = 200
+WALLS = 40
+FISH = 60
+
+
+class RawAviWriter(AviWriter):
+
+    # Writer of uncompressed 24-bit AVI files (bottom-up DIB frames). With gray, the frames are
+    # written in 8 bits per pixel with a gray ramp palette (as the mono high-speed cameras).
+
+    def __init__(self, path, fps, frameSize, gray=False):
+        (width, height) = frameSize
+        self.gray = gray
+        self.channels = 1 if gray else 3
+        self.stride = ((width*self.channels + 3)//4)*4
+        self.frameBytes = self.stride*height
+        palette = np.repeat(np.arange(256, dtype=np.uint8), 4).tobytes() if gray else b""
+        AviWriter.__init__(self, path, fps, frameSize, b"DIB ", 8*self.channels, 0, self.frameBytes, self.frameBytes, palette)
+
+    def write(self, frame):
+        if frame.shape != (self.height, self.width, 3):
+            raise Exception("The frame size differs from the video size.")
+
+        # Bottom-up rows padded to 4 bytes
+        if self.gray:
+            frame = cv.cvtColor(frame, cv.COLOR_BGR2GRAY)
+        data = np.zeros((self.height, self.stride), np.uint8)
+        data[:, :self.width*self.channels] = frame[::-1].reshape(self.height, self.width*self.channels)
+        self.writeChunk(b"00db", data.tobytes())
+
+
+def fishMidline(numFrame, fps, origin, bodyLength, tailAmp, tailFreq, waveLength, nPoints=200):
+
+    # Midline of a carangiform swimmer (head at the left): a travelling wave whose
+    # amplitude grows quadratically from the head to the tail (Videler envelope)
+    t = numFrame/fps
+    s = np.linspace(0., 1., nPoints)
+    envelope = tailAmp*(0.02 - 0.08*s + 0.16*s**2)/0.1
+
+    x = origin[0] + s*bodyLength
+    y = origin[1] + envelope*np.sin(2*np.pi*(s/waveLength - tailFreq*t))
+
+    return np.stack([x, y], 1)
+
+
+def fishOutline(midline, bodyLength):
+
+    # Body polygon around the midline, wide at the head and tapered to the tail
+    s = np.linspace(0., 1., len(midline))
+    halfWidth = 0.1*bodyLength*np.clip(8*s, 0, 1)**0.5*(1-s)**1.2 + 0.01*bodyLength
+
+    tangent = np.gradient(midline, axis=0)
+    normal = np.stack([-tangent[:, 1], tangent[:, 0]], 1)/np.hypot(tangent[:, 0], tangent[:, 1])[:, None]
+    top = midline + normal*halfWidth[:, None]
+    bottom = midline - normal*halfWidth[:, None]
+
+    return np.round(np.concatenate([top, bottom[::-1]])).astype(np.int32)
+
+
+def keyPoints(midline):
+
+    # Head, joint, torsion and tail points by arc length proportions (as treatData does with the skeleton)
+    segLen = np.hypot(np.diff(midline[:, 0]), np.diff(midline[:, 1]))
+    arcLen = np.cumsum(segLen)
+    joint = np.argmax(arcLen > arcLen[-1]*config.PROPORTION_JOINT) + 1
+    restLen = arcLen[joint:] - arcLen[joint-1]
+    torsion = joint + np.argmax(restLen > restLen[-1]*config.PROPORTION_TORSION) + 1
+
+    return midline[0], midline[joint], midline[torsion], midline[-1]
+
+
+def truthAngle(A, B, C):
+
+    # Angle of treatData.computeAngle for the (N,2) point arrays A, B, C
+    (ax, ay) = (C[:, 0]-A[:, 0], C[:, 1]-A[:, 1])
+    (bx, by) = (B[:, 0]-A[:, 0], B[:, 1]-A[:, 1])
+    ampl = (ax*by - bx*ay)/np.hypot(bx, by)
+
+    return np.rad2deg(np.arcsin(ampl/np.hypot(C[:, 0]-B[:, 0], C[:, 1]-B[:, 1])))
+
+
+def synthVideo(videoPath, nFrames=500, fps=1000, frameSize=(1280, 312), raw=False, bodyLength=300, tailAmp=30., tailFreq=20.,
+               waveLength=0.9, noise=10, seed=0, gray=False):
+
+    # Render a deterministic video of a swimming fish in the tunnel and save its ground truth
+    # (key points in image coords. and angles in the treatData convention) in videoPath.npz.
+    # A raw video is written in 8 bits per pixel with gray.
+    (width, height) = frameSize
+    wall = height//15
+    origin = (width*0.4, height/2)
+
+    if raw:
+        out = RawAviWriter(videoPath, fps, frameSize, gray)
+    else:
+        out = cv.VideoWriter(str(videoPath), cv.VideoWriter_fourcc(*"MJPG"), fps, frameSize)
+    if not out.isOpened():
+        raise Exception("Could not open the video writer: " + str(videoPath))
+
+    rng = np.random.RandomState(seed)
+    points = np.zeros((4, nFrames, 2), float)
+
+    logging.info("Rendering " + str(nFrames) + " synthetic frames...")
+    for numFrame in range(nFrames):
+        midline = fishMidline(numFrame, fps, origin, bodyLength, tailAmp, tailFreq, waveLength)
+        points[:, numFrame] = keyPoints(midline)
+
+        # Tunnel background with noise, walls and the fish body
+        frame = np.full((height, width, 3), BACKGROUND, np.uint8)
+        frame += rng.randint(0, noise+1, (height, width, 1)).astype(np.uint8)
+        frame[:wall] = WALLS
+        frame[height-wall:] = WALLS
+        cv.fillPoly(frame, [fishOutline(midline, bodyLength)], (FISH, FISH, FISH))
+
+        out.write(frame)
+
+    out.release()
+
+    # Ground truth, the y coords. are flipped to R^2 as treatData does
+    (headP, jointP, torsionP, tailP) = points * np.array([1., -1.])
+    truth = {
+        "headP": headP, "jointP": jointP, "torsionP": torsionP, "tailP": tailP,
+        "alpha": truthAngle(headP, jointP, torsionP),
+        "beta": truthAngle(headP, jointP, tailP),
+        "gamma": truthAngle(jointP, torsionP, tailP),
+        "roi": np.array([0, wall, width, height-2*wall]),
+        "fps": fps, "tailAmp": tailAmp, "tailFreq": tailFreq
+    }
+    np.savez(truthPath(videoPath), **truth)
+
+    return truth
+
+
+def truthPath(videoPath):
+
+    videoPath = pathlib.Path(videoPath)
+
+    return videoPath.with_name(videoPath.name + ".npz")
+
+
+def loadTruth(videoPath):
+
+    with np.load(truthPath(videoPath)) as truth:
+        return {key: truth[key] for key in truth.files}
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format="[%(asctime)s] %(levelname)s: %(message)s (%(funcName)s:%(lineno)d)"
+    )
+
+    videoPath = "./test/synthVideo.avi"
+    nFrames = 500
+    fps = 1000
+
+    pathlib.Path(videoPath).parent.mkdir(parents=True, exist_ok=True)
+    synthVideo(videoPath, nFrames, fps, raw=True)
+
+    logging.info("DONE.")
@@ -0,0 +1,5 @@
+import pathlib
+import sys
+
+# The modules of the project are scripts of the root folder
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parents[1]))
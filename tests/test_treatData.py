@@ -0,0 +1,107 @@
+import numpy as np
+import pytest
+
+import config
+import treatData as td
+from benchmark import angleDataLoop, equalNan, lenSKLoop, randomSinusoids, randomSkeletons, uniqueMeanLoop
+
+
+def testUniqueMeanPinned():
+
+    # The mean y of the repeated x is truncated to zero and the points after a repeated x keep their own coords.
+    pinned = np.array([[0, 5], [1, -3], [1, -4], [2, 7], [3, -1], [3, 2], [3, 4], [4, 10]])
+    expected = np.array([[0, 5], [1, -3], [2, 7], [3, 1], [4, 10]])
+
+    assert np.array_equal(td.uniqueMean(pinned), expected)
+    assert np.array_equal(uniqueMeanLoop(pinned), expected)
+    # The skeleton reaches the index fix: the original version shifts the points after x=1
+    assert not np.array_equal(uniqueMeanLoop(pinned, fixed=False), expected)
+
+
+def testUniqueMeanLoop():
+
+    for skeleton in randomSkeletons(50, nPoints=60, repeatX=True):
+        assert np.array_equal(td.uniqueMean(skeleton), uniqueMeanLoop(skeleton))
+
+
+def testKeyPointIndexesLenSK():
+
+    proportions = (config.PROPORTION_JOINT, config.PROPORTION_TORSION)
+    skeletons = randomSkeletons(50, nPoints=60)
+    offsets = np.concatenate([[0], np.cumsum([len(skeleton) for skeleton in skeletons])])
+
+    indexes = td.keyPointIndexes(np.concatenate(skeletons), offsets, proportions)
+
+    for (skeleton, (joint, torsion)) in zip(skeletons, indexes):
+        _skeletonLen, jointLoop = lenSKLoop(skeleton, proportions[0])
+        _skeletonLen, torsionLoop = lenSKLoop(skeleton[jointLoop:], proportions[1])
+        assert (joint, torsion) == (jointLoop, jointLoop + torsionLoop)
+
+
+def testKeyPointIndexesLine():
+
+    # Unit segments: the first point farther than the proportion of the length (strictly)
+    line = np.stack([np.arange(11), np.zeros(11, int)], 1)
+
+    assert td.keyPointIndexes(line, np.array([0, 11]), (0.5, 0.5)).tolist() == [[6, 9]]
+    assert td.lenSK(line, 0.25) == (10., 3)
+
+
+def testRelativePointsGroups():
+
+    # Flat spline: the groups of roots are closed by the horizontal distance only
+    cs = lambda roots: np.zeros(len(roots))
+
+    # Odd group of noise roots replaced by its median
+    assert td.relativePoints(cs, np.array([0., 10., 11., 12., 30.]), 0, 30, 5, 1).tolist() == [0., 11., 30.]
+    # Even group dropped
+    assert td.relativePoints(cs, np.array([0., 10., 11., 30.]), 0, 30, 5, 1).tolist() == [0., 30.]
+    # First and last roots outside [start, end], the last group is not closed
+    assert td.relativePoints(cs, np.array([-2., 10., 11., 12., 30., 33.]), 0, 30, 5, 1).tolist() == [11.]
+    # Single root
+    assert td.relativePoints(cs, np.array([35.]), 0, 30, 5, 1).tolist() == []
+
+
+@pytest.mark.filterwarnings("ignore:Mean of empty slice")
+def testRelativePointsLoop():
+
+    # angleData (relativePoints on the roots of the spline) against the fixed loop reference,
+    # some series have less than two extrema (NaN amplitude)
+    for (timeMs, angle) in randomSinusoids(20):
+        with np.errstate(invalid="ignore"):
+            result = td.angleData(timeMs, angle, "spline")
+        assert equalNan(result, angleDataLoop(timeMs, angle))
+
+
+def testFormatRows():
+
+    # Same text as the % operator (np.savetxt), with ties, negative zeros, big and not finite values
+    rng = np.random.RandomState(0)
+    rows = rng.uniform(-1000, 1000, (200, 6))
+    rows[0] = [0.5e-5, 1.5e-5, -2.5e-5, 0.125, -0., 0.]
+    rows[1] = [np.nan, np.inf, -np.inf, 1e12, -123456789.987654, 9.999995]
+    rows[2] = [1., 10., 100., 1e5, -1e5, 99999.999999]
+    rowFormat = ",".join(["%10.5f"]*6) + "\n"
+
+    assert td.formatRows(rows) == "".join(rowFormat % tuple(row) for row in rows)
+    assert td.formatRows(rows[2:]) == "".join(rowFormat % tuple(row) for row in rows[2:])
+    assert td.formatRows(np.zeros((0, 6))) == ""
+
+
+def testFastLength():
+
+    # Smallest 5-smooth number not below n, by brute force
+    smooth = lambda m: m == 1 or any(m % p == 0 and smooth(m//p) for p in (2, 3, 5))
+    for n in range(1, 1000):
+        expected = next(m for m in range(n, 2*n+1) if smooth(m))
+        assert td.fastLength(n) == expected
+
+
+def testSpectralShortSeries():
+
+    # Series shorter than the smoothing kernel are NaN, as the windows with too few frames
+    for nFrames in (3, td.SPECTRAL_MIN_FRAMES - 1):
+        timeMs = 100.*np.arange(nFrames)
+        assert np.all(np.isnan(td.angleData(timeMs, np.sin(timeMs/100), "spectral")))
+    timeMs = 100.*np.arange(td.SPECTRAL_MIN_FRAMES)
+    assert np.all(np.isfinite(td.angleData(timeMs, np.sin(timeMs/100), "spectral")))
@@ -1,6 +1,9 @@
+import collections
 import logging
 import pathlib
 import csv
+import struct
+import zlib
 
 import numpy as np
 from scipy.interpolate import CubicSpline
@@ -10,162 +13,461 @@ from scipy.interpolate import CubicSpline
 # import matplotlib.animation as animation
 
 import config
+import stageTimer
+from dataStore import hasStore, loadSkeletons, countFrames, saveResult, saveMember, loadMeta, loadColumn
 
+# Version of the key point computation, the cached key points of other versions are computed again.
+# Bump it when the key points of a skeleton change.
+KEYPOINTS_VERSION = 2
 
-def treatData(exportPath, expID, fps, contrast, failedFrames):
+# Columns of the result file (see exportData), in the order of the csv file
+RESULT_COLUMNS = ("time", "xHead", "yHead", "xJoint", "yJoint", "xTorsion", "yTorsion", "xTail", "yTail", "alpha", "beta", "gamma")
+
+# Fewest frames of an angle series for the spectral backend (length of its smoothing kernel)
+SPECTRAL_MIN_FRAMES = 9
+
+# Row of the sliding-window analysis (see windowData)
+WINDOW_DTYPE = np.dtype([("start", float), ("end", float), ("frames", np.int32), ("alphaAmp", float), ("alphaFreq", float),
+                         ("betaAmp", float), ("betaFreq", float), ("gammaAmp", float), ("gammaFreq", float)])
+
+
+def treatData(exportPath, expID, fps, contrast, failedFrames, incremental=None, writeCsv=None):
+
+    # In incremental mode (config.INCREMENTAL_TREATMENT if None) only the key points of the
+    # new or changed frames are computed, the others are taken from data/expID_keypoints.npz
+    # The data is saved in data/expID_result.npz, and also in the csv file with writeCsv (config.EXPORT_CSV if None).
 
     # Init. data
     proportionJoint = config.PROPORTION_JOINT
     proportionTorsion = config.PROPORTION_TORSION 
+    incremental = config.INCREMENTAL_TREATMENT if incremental is None else incremental
+    writeCsv = config.EXPORT_CSV if writeCsv is None else writeCsv
+    timer = stageTimer.startRun()
 
     # Check/Create paths 
     pathlib.Path(exportPath, expID, "data").mkdir(parents=True, exist_ok=True)
  
-    # Number of files
-    nFiles = len(list(pathlib.Path(exportPath,expID,"skeleton").glob("*.npy")))
+    # Number of frames
+    nFiles = countFrames(exportPath, expID)
 
     # Obtain data
     logging.info("Importing Data...")
-    ind, tailP, headP, jointP, nValidFrames, torsionP = importData(exportPath, expID, proportionJoint, proportionTorsion, nFiles)
+    t = timer.tic()
+    keyPoints = importData(exportPath, expID, proportionJoint, proportionTorsion, nFiles, incremental)
+    timer.toc("importData", t)
+
+    treatKeyPoints(keyPoints, exportPath, expID, fps, contrast, failedFrames, nFiles, timer, writeCsv)
+
+
+def treatStream(sink, exportPath, expID, fps, contrast, failedFrames, writeCsv=None):
+
+    # Treatment at the end of a streaming extraction, the key points are taken from its sink
+    # (see KeyPointSink) instead of the saved skeletons
+    writeCsv = config.EXPORT_CSV if writeCsv is None else writeCsv
+    timer = stageTimer.startRun()
+    pathlib.Path(exportPath, expID, "data").mkdir(parents=True, exist_ok=True)
+
+    t = timer.tic()
+    keyPoints = sink.keyPointArrays()
+    timer.toc("importData", t)
+
+    treatKeyPoints(keyPoints, exportPath, expID, fps, contrast, failedFrames, sink.numFrames(), timer, writeCsv)
+    sink.remove()
+
+
+def treatKeyPoints(keyPoints, exportPath, expID, fps, contrast, failedFrames, nFiles, timer, writeCsv=False):
+
+    # Angles, frequency/amplitude and export of the key points (ind, tailP, headP, jointP, nValidFrames, torsionP)
+    (ind, tailP, headP, jointP, nValidFrames, torsionP) = keyPoints
+    backend = config.FREQUENCY_BACKEND
 
     # Compute data
     logging.info("Computing Data...")
-    alpha, _amplalpha = computeAngle(headP, jointP, torsionP, nValidFrames)
-    beta, _amplbeta = computeAngle(headP, jointP, tailP, nValidFrames)
-    gamma, _amplgamma = computeAngle(jointP, torsionP, tailP, nValidFrames)
+    t = timer.tic()
+    alpha, _amplalpha, _degenerateAlpha = computeAngle(headP, jointP, torsionP, nValidFrames)
+    beta, _amplbeta, _degenerateBeta = computeAngle(headP, jointP, tailP, nValidFrames)
+    gamma, _amplgamma, _degenerateGamma = computeAngle(jointP, torsionP, tailP, nValidFrames)
+    t = timer.toc("computeAngle", t)
 
-    time = (nFiles/fps)*ind[:nValidFrames] # time in ms
+    time = frameTime(ind[:nValidFrames], fps)
 
-    dataAlpha = angleData(time, alpha)
-    dataBeta = angleData(time, beta)
-    dataGamma =  angleData(time, gamma)
+    dataAlpha = angleData(time, alpha, backend)
+    dataBeta = angleData(time, beta, backend)
+    dataGamma =  angleData(time, gamma, backend)
+    t = timer.toc("angleData", t)
 
     aData = np.array([dataAlpha, dataBeta, dataGamma], float)
 
     # Export data
     logging.info("Exporting Data...")
-    exportData(time, headP, jointP, torsionP, tailP, alpha, beta, gamma, aData, exportPath, expID, nValidFrames, fps, contrast, failedFrames)
+    exportData(time, headP, jointP, torsionP, tailP, alpha, beta, gamma, aData, exportPath, expID, nValidFrames, fps, contrast, failedFrames,
+               backend)
+    t = timer.toc("exportData", t)
 
+    if config.WINDOW_ANALYSIS:
+        windowData(exportPath, expID, backend=backend)
+        t = timer.toc("windowData", t)
+
+    if writeCsv:
+        exportCsv(exportPath, expID)
+        timer.toc("exportCsv", t)
+
+    stageTimer.finishRun(timer, exportPath, expID, "treatData", nFiles, nFiles-nValidFrames)
     logging.info("Treatment DONE.")
 
 
-def importData(filePath, expID, proportionJoint, proportionTorsion, nFiles):
+def frameTime(ind, fps):
+
+    # Time (ms) of the frames of index ind, recorded at fps frames per second
+    return (1000/fps)*ind
+
+
+def importData(filePath, expID, proportionJoint, proportionTorsion, nFiles, incremental=False, chunkFrames=4096):
+
+    # In incremental mode the key points of each frame are cached with the fingerprint of its
+    # skeleton (see frameFingerprint), only the new or changed frames are computed again.
+    # The skeletons are prepared frame by frame and their key points computed in batches of chunkFrames.
+
+    # Open the skeleton store once (the legacy layout has one file per frame)
+    store = hasStore(filePath, expID)
+    if store:
+        points, offsets, valid = loadSkeletons(filePath, expID)
+
+    # Key points (head, joint, torsion, tail) of every frame
+    validFrames = np.zeros(nFiles, bool)
+    keyPoints = np.zeros((nFiles, 4, 2), int)
+
+    # Key points of the previous treatment
+    if incremental:
+        fingerprints = np.zeros(nFiles, np.int64)
+        cache = loadKeyPoints(filePath, expID, proportionJoint, proportionTorsion, store)
+        nCached = 0
 
-    # Init. the main arrays
+    # Export/Extract the data from the files
+    timer = stageTimer.current
+    pending = [] # frames and prepared skeletons waiting for their key points
+    for i in range(nFiles):
+
+        t = timer.tic()
+        if store:
+            # Take the skeleton from the store, failed frames are marked as not valid
+            skeleton = points[offsets[i]:offsets[i+1]] if valid[i] else 0
+        else:
+            # Skeleton file *.npy (loaded only if it is not cached)
+            skeletonPath = pathlib.Path(filePath, expID, "skeleton", expID + "_" + str(i+1) + ".npy")
+
+        if incremental:
+            fingerprints[i] = frameFingerprint(skeleton if store else skeletonPath)
+            t = timer.toc("fingerprint", t)
+
+        if incremental and (cache is not None) and (i < len(cache["fingerprints"])) and (cache["fingerprints"][i] == fingerprints[i]):
+            # Unchanged frame
+            validFrames[i] = cache["valid"][i]
+            keyPoints[i] = cache["keyPoints"][i]
+            nCached += 1
+        else:
+            if not store:
+                # Load skeleton from a numpy binary array file *.npy
+                skeleton = np.load(skeletonPath)
+            t = timer.toc("loadSkeleton", t)
+
+            if not np.array_equal(skeleton, 0):
+                validFrames[i] = True
+                pending.append((i, prepareSkeleton(skeleton)))
+                timer.toc("prepareSkeleton", t)
+
+        if len(pending) == chunkFrames or (i == nFiles-1 and pending):
+            t = timer.tic()
+            frames = [frame for (frame, _skeleton) in pending]
+            keyPoints[frames] = batchKeyPoints([skeleton for (_frame, skeleton) in pending], proportionJoint, proportionTorsion)
+            pending = []
+            timer.toc("keyPoints", t)
+
+    # Cache the key points for the next treatment
+    if incremental:
+        logging.info("Key points: " + str(nCached) + " cached frames, " + str(nFiles-nCached) + " computed frames.")
+        saveKeyPoints(filePath, expID, proportionJoint, proportionTorsion, store, fingerprints, validFrames, keyPoints)
+
+    return validKeyPoints(validFrames, keyPoints)
+
+
+def validKeyPoints(validFrames, keyPoints):
+
+    # Save points of the valid frames - Fish direction swimming: left
+    nFiles = len(validFrames)
     ind = np.zeros((nFiles), int)
     tailP = np.zeros((nFiles, 2), int)
     headP = np.zeros((nFiles, 2), int)
     jointP = np.zeros((nFiles, 2), int)
     torsionP = np.zeros((nFiles, 2), int)
 
-    # # Debug Only: Start interactive fig to plot skeleton and partition
-    # plt.ion()
-    # fig = plt.figure()
+    validInd = np.count_nonzero(validFrames) # number of valid frames
+    ind[:validInd] = np.flatnonzero(validFrames)
+    (headP[:validInd], jointP[:validInd], torsionP[:validInd], tailP[:validInd]) = np.moveaxis(keyPoints[validFrames], 1, 0)
 
-    # Export/Extract the data from the files
-    validInd = 0 # valid frames index
-    for i in range(nFiles):
-
-        # Load skeleton from a numpy binary array file *.npy
-        skeleton = np.load(pathlib.Path(filePath, expID, "skeleton", expID + "_" + str(i+1) + ".npy"))
-        
-        if not np.array_equal(skeleton, 0):
-            # Data pre-treatment
-            skeleton = np.reshape(skeleton, (np.size(skeleton, 0), 2)) # convert the array-points to a matrix
-            skeleton = skeleton[np.argsort(skeleton[:, 0])] # sort points by x
-            skeleton = np.unique(skeleton, axis=0) # delete repeated points
-            skeleton = uniqueMean(skeleton) # delete repeated points_x and get they mean_y
-            skeleton[:, 1] = -skeleton[:, 1] # convert coords. to R^2. Original ones are image matrix indexes
-
-            # Save points- Fish direction swimming: left
-            ind[validInd] = i
-            tailP[validInd, :] = skeleton[-1, :]
-            headP[validInd, :] = skeleton[0, :]
-            _skeletonLen, joint = lenSK(skeleton, proportionJoint)
-            jointP[validInd, :] = skeleton[joint, :]
-            _skeletonLen, torsion = lenSK(skeleton[joint:, :], proportionTorsion)
-            torsionP[validInd, :] = skeleton[torsion+joint, :]
-
-            # Update the valid index
-            validInd += 1
-
-            # # Debug Only: draw approx
-            # x = skeleton[:, 0]
-            # y = skeleton[:, 1]
-            # plot1 = plt.figure(1)
-            # plt.plot(x, y, 'b-')
-            # plt.plot(x[joint],y[joint],'ro')
-            # plt.plot(x[torsion+joint],y[torsion+joint],'g*')
-            # plt.axis((0, 426.7, -154, -50))
-            # # Update canvas
-            # fig.canvas.draw()
-            # plot1.clf()
-            
     return ind, tailP, headP, jointP, validInd, torsionP
 
 
-def uniqueMean(skeleton):
+class KeyPointSink:
+
+    # Treatment sink of a streaming extraction. It takes the skeletons as the SkeletonStore does
+    # (append/checkpoint/close) and computes the key points of the valid frames as they come: each
+    # skeleton is prepared when it is appended and the key points are sampled in batches of chunkFrames.
+    # The skeletons are also saved in the store if one is given (raw dumps).
+    # A sink is continued from a checkpoint with resume={"frames": ..., "store": ...}.
+
+    def __init__(self, exportPath, expID, proportionJoint, proportionTorsion, store=None, chunkFrames=4096, resume=None):
+        self.exportPath = exportPath
+        self.expID = expID
+        self.proportions = (proportionJoint, proportionTorsion)
+        self.store = store
+        self.chunkFrames = chunkFrames
+        self.valid = []
+        self.keyPoints = []
+        self.pending = []
+
+        if resume is not None:
+            # Drop the frames treated after the checkpoint
+            nFrames = resume["frames"]
+            with np.load(str(self.streamPath())) as stream:
+                valid = stream["valid"][:nFrames]
+                keyPoints = stream["keyPoints"][:np.count_nonzero(valid)]
+            if len(valid) != nFrames:
+                raise Exception("The streamed key points do not match the checkpoint.")
+            self.valid = valid.tolist()
+            self.keyPoints = [keyPoints]
+
+    def streamPath(self):
+        return pathlib.Path(self.exportPath, self.expID, "data", self.expID + "_stream.npz")
+
+    def append(self, skeleton, validFrame):
+        if self.store is not None:
+            self.store.append(skeleton, validFrame)
+
+        self.valid.append(bool(validFrame))
+        if validFrame:
+            timer = stageTimer.current
+            t = timer.tic()
+            self.pending.append(prepareSkeleton(skeleton))
+            timer.toc("prepareSkeleton", t)
+            if len(self.pending) == self.chunkFrames:
+                self.flush()
+
+    def flush(self):
+        # Key points of the pending skeletons
+        if self.pending:
+            timer = stageTimer.current
+            t = timer.tic()
+            self.keyPoints.append(batchKeyPoints(self.pending, *self.proportions))
+            self.pending = []
+            timer.toc("keyPoints", t)
+
+    def numFrames(self):
+        return len(self.valid)
+
+    def keyPointArrays(self):
+        # Key points of the valid frames as importData returns them
+        self.flush()
+        validFrames = np.array(self.valid, bool)
+        keyPoints = np.zeros((len(validFrames), 4, 2), int)
+        if self.keyPoints:
+            keyPoints[validFrames] = np.concatenate(self.keyPoints)
+
+        return validKeyPoints(validFrames, keyPoints)
+
+    def checkpoint(self):
+        # Save the key points of the frames appended so far, returns the state to resume the sink
+        self.flush()
+        pathlib.Path(self.exportPath, self.expID, "data").mkdir(parents=True, exist_ok=True)
+        keyPoints = np.concatenate(self.keyPoints) if self.keyPoints else np.zeros((0, 4, 2), int)
+        np.savez(str(self.streamPath()), valid=np.array(self.valid, bool), keyPoints=keyPoints)
+
+        return {"frames": len(self.valid), "store": None if self.store is None else self.store.checkpoint()}
+
+    def close(self):
+        self.flush()
+        if self.store is not None:
+            self.store.close()
+
+    def remove(self):
+        # Remove the key points of the checkpoints
+        if self.streamPath().exists():
+            self.streamPath().unlink()
+
+
+def prepareSkeleton(skeleton):
+
+    # Data pre-treatment
+    skeleton = np.reshape(skeleton, (np.size(skeleton, 0), 2)) # convert the array-points to a matrix
+    skeleton = skeleton[np.argsort(skeleton[:, 0])] # sort points by x
+    skeleton = np.unique(skeleton, axis=0) # delete repeated points
+    skeleton = uniqueMean(skeleton) # delete repeated points_x and get they mean_y
+    skeleton[:, 1] = -skeleton[:, 1] # convert coords. to R^2. Original ones are image matrix indexes
+
+    return skeleton
+
+
+def batchKeyPoints(skeletons, proportionJoint, proportionTorsion):
+
+    # Head, joint, torsion and tail points of a list of prepared skeletons, (N,4,2) array
+    counts = np.array([len(skeleton) for skeleton in skeletons], int)
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+    points = np.concatenate(skeletons)
+
+    indexes = offsets[:-1, None] + keyPointIndexes(points, offsets, (proportionJoint, proportionTorsion))
+
+    # # Debug Only: draw approx
+    # for i in range(len(skeletons)):
+    #     x = skeletons[i][:, 0]
+    #     y = skeletons[i][:, 1]
+    #     plt.plot(x, y, 'b-')
+    #     plt.plot(points[indexes[i, 0], 0], points[indexes[i, 0], 1], 'ro')
+    #     plt.plot(points[indexes[i, 1], 0], points[indexes[i, 1], 1], 'g*')
+    #     plt.axis((0, 426.7, -154, -50))
+    #     plt.show()
+
+    return np.stack([points[offsets[:-1]], points[indexes[:, 0]], points[indexes[:, 1]], points[offsets[1:]-1]], 1)
+
 
-    skmean = np.array([], int).reshape(0,2)
+def keyPointIndexes(points, offsets, proportions):
 
-    # Count the repeated coords. x and get they index
-    _sk, skind, skcounts = np.unique(skeleton[:,0], return_index=True, return_counts=True)
+    # Indexes of the points at several chained length proportions of a batch of skeletons, where the
+    # skeleton i is points[offsets[i]:offsets[i+1]]. Each proportion is measured on the part of the skeleton
+    # after the previous point (as lenSK(skeleton[joint:], ...)), the indexes are relative to each skeleton.
+    # The lengths are accumulated in the same order as lenSK, so the indexes are the same.
+    counts = np.diff(offsets)
+    nSkeletons = len(counts)
 
-    # Copy unique x coords. and assign the y coords mean
-    for i,ind in enumerate(skind):
-        if skcounts[i] > 1: 
-            ymean = 0
-            for j in range(skcounts[i]):
-                ymean = ymean + skeleton[ind+j, 1]
-            skmean = np.vstack([skmean,[skeleton[i,0], int(ymean/skcounts[i])]])
-        else:  # if not repeated x
-            skmean = np.vstack([skmean,[skeleton[i,0], skeleton[i,1]]])
+    # Length of the segments (the last one of each skeleton joins it with the next one, it is never used)
+    diff = np.diff(points, axis=0)
+    segLen = np.append(np.sqrt(diff[:, 0]*diff[:, 0] + diff[:, 1]*diff[:, 1]), 0.)
 
-    return skmean
+    rows = np.arange(nSkeletons)
+    start = np.zeros(nSkeletons, int)
+    indexes = np.zeros((nSkeletons, len(proportions)), int)
+    for (k, proportion) in enumerate(proportions):
+        # Cumulative length of the remaining part of each skeleton (padded with zeros)
+        nSegments = counts - 1 - start
+        cols = np.arange(max(np.max(nSegments), 1))
+        mask = cols < nSegments[:, None]
+        measure = np.cumsum(np.where(mask, segLen[np.minimum(offsets[:-1, None] + start[:, None] + cols, len(segLen)-1)], 0.), axis=1)
+        skeletonLen = measure[rows, np.maximum(nSegments-1, 0)]
 
+        # First point whose measure is bigger than the proportion of the length
+        cross = mask & (measure > (skeletonLen*proportion)[:, None])
+        if not np.all(np.any(cross, axis=1)):
+            raise Exception("A skeleton is too short to find its key points.")
+        start = start + np.argmax(cross, axis=1) + 1
+        indexes[:, k] = start
 
-def computeAngle(A, B, C, nValidFrames):
+    return indexes
+
+
+def frameFingerprint(skeleton):
+
+    # CRC32 of the skeleton points of the store (and their number) or of the size and
+    # modification time of the skeleton file of the legacy layout
+    if isinstance(skeleton, pathlib.Path):
+        stat = skeleton.stat()
+        return zlib.crc32(struct.pack("<qq", stat.st_size, stat.st_mtime_ns))
+
+    skeleton = np.ascontiguousarray(skeleton, np.int32)
+
+    return zlib.crc32(skeleton, zlib.crc32(struct.pack("<q", skeleton.size)))
+
+
+def keyPointsPath(filePath, expID):
+
+    return pathlib.Path(filePath, expID, "data", expID + "_keypoints.npz")
+
+
+def loadKeyPoints(filePath, expID, proportionJoint, proportionTorsion, store):
+
+    # Cached key points, None if there are not or they were computed with other version/proportions/layout
+    path = keyPointsPath(filePath, expID)
+    if not path.exists():
+        return None
+
+    with np.load(str(path)) as cache:
+        version = int(cache["version"]) if "version" in cache.files else 1
+        if version != KEYPOINTS_VERSION:
+            logging.warning("The cached key points are of other version (" + str(version) + "), they are computed again.")
+            return None
+        if not (np.array_equal(cache["proportions"], [proportionJoint, proportionTorsion]) and (bool(cache["store"]) == store)):
+            return None
+        return {key: cache[key] for key in ("fingerprints", "valid", "keyPoints")}
+
+
+def saveKeyPoints(filePath, expID, proportionJoint, proportionTorsion, store, fingerprints, validFrames, keyPoints):
+
+    pathlib.Path(filePath, expID, "data").mkdir(parents=True, exist_ok=True)
+    np.savez(str(keyPointsPath(filePath, expID)), fingerprints=fingerprints, valid=validFrames, keyPoints=keyPoints,
+             proportions=np.array([proportionJoint, proportionTorsion]), store=store, version=KEYPOINTS_VERSION)
+
+
+def uniqueMean(skeleton):
+
+    # Unique x coords. with the mean of the y coords. of their points (truncated to int), in one pass
+    skx, skinv, skcounts = np.unique(skeleton[:, 0], return_inverse=True, return_counts=True)
+    ysum = np.bincount(np.reshape(skinv, -1), weights=skeleton[:, 1], minlength=len(skx))
+
+    return np.stack([skx, np.trunc(ysum/skcounts)], 1).astype(int)
+
+
+def computeAngle(A, B, C, nValidFrames, dtype=None):
 
     # Amplitude between the tail and the head perpendicular
     # sin(alpha)=(vXu)/||v||·||u||  (permits to obtain the sign of angle)
-    sinAlpha = np.zeros(nValidFrames, float)
-    h = np.zeros(nValidFrames, float)
-    ampl = np.zeros(nValidFrames, float)
+    # All the frames are computed at once, in float64 or in dtype if given (i.e. np.float32).
+    # The frames with a zero length segment are NaN and marked in the returned mask.
+    (A, B, C) = (A[:nValidFrames], B[:nValidFrames], C[:nValidFrames])
+    if dtype is not None:
+        (A, B, C) = (A.astype(dtype), B.astype(dtype), C.astype(dtype))
+
+    (cx, cy) = (C[:, 0]-A[:, 0], C[:, 1]-A[:, 1])
+    (bx, by) = (B[:, 0]-A[:, 0], B[:, 1]-A[:, 1])
+    (dx, dy) = (C[:, 0]-B[:, 0], C[:, 1]-B[:, 1])
+
+    h = np.sqrt(cx**2 + cy**2)
+    norms = h * np.sqrt(bx**2 + by**2)
+    lenBC = np.sqrt(dx**2 + dy**2)
+    degenerate = (norms == 0) | (lenBC == 0)
 
-    for i in range(nValidFrames):
-        h[i] = np.sqrt(np.abs(C[i, 0]-A[i, 0])**2 + np.abs(C[i, 1]-A[i, 1])**2)
-        sinAlpha[i] = ((C[i, 0]-A[i, 0])*(B[i, 1]-A[i, 1]) - (B[i, 0]-A[i, 0])*(C[i, 1]-A[i, 1])) / (np.sqrt((C[i, 0]-A[i, 0])**2 + (C[i, 1]-A[i, 1])**2) * np.sqrt((B[i, 0]-A[i, 0])**2 + (B[i, 1]-A[i, 1])**2))
-        if (np.sqrt((C[i, 0]-A[i, 0])**2 + (C[i, 1]-A[i, 1])**2) * np.sqrt((B[i, 0]-A[i, 0])**2 + (B[i, 1]-A[i, 1])**2)) == 0:
-            print(i)
-        ampl[i] = h[i] * sinAlpha[i]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sinAlpha = (cx*by - bx*cy) / norms
+        ampl = h * sinAlpha
 
-    # Tail angle from the axis headP/jointP
-    alpha = np.zeros(nValidFrames, float)
+        # Tail angle from the axis headP/jointP
+        alpha = np.rad2deg(np.arcsin(ampl/lenBC))
 
-    for i in range(nValidFrames):
-        alpha[i] = np.rad2deg( np.arcsin(ampl[i]/np.sqrt(np.abs(C[i, 0] - B[i, 0])**2 + np.abs(C[i, 1]-B[i, 1])**2)) )
+    if np.any(degenerate):
+        ampl[degenerate] = np.nan
+        alpha[degenerate] = np.nan
+        logging.warning(str(np.count_nonzero(degenerate)) + " frames have a zero length segment, their angles are NaN.")
 
-    return alpha, ampl
+    return alpha, ampl, degenerate
 
 
 def lenSK(skeleton, proportion):
-    # Compute the length of the skeleton
-    skeletonLen = 0
-    for i in range(1,len(skeleton)):
-        skeletonLen += ((skeleton[i-1][0] - skeleton[i][0])**2 + (skeleton[i-1][1] - skeleton[i][1])**2)**(1/2)
 
-    # Compute the desired index point on proportion measure
-    measure = 0
-    for i in range(1,len(skeleton)):
-        measure += ((skeleton[i-1][0] - skeleton[i][0])**2 + (skeleton[i-1][1] - skeleton[i][1])**2)**(1/2)
-        if measure > skeletonLen*proportion:
-            point = i
-            break
+    # Length of the skeleton and index of the point at the proportion of the length
+    skeleton = np.asarray(skeleton)
+    index = keyPointIndexes(skeleton, np.array([0, len(skeleton)]), (proportion,))[0, 0]
+    diff = np.diff(skeleton, axis=0)
+    skeletonLen = np.cumsum(np.append(0., np.sqrt(diff[:, 0]*diff[:, 0] + diff[:, 1]*diff[:, 1])))[-1]
 
-    return skeletonLen, point
+    return skeletonLen, index
 
 
-def angleData(time, angle):
+def angleData(time, angle, backend=None):
+
+    # Mean amplitude and frequency of the angle. The backend (config.FREQUENCY_BACKEND if None) is "spline":
+    # extrema of a cubic spline of the smoothed angle, or "spectral": peak of its spectrum (see spectralData).
+    backend = config.FREQUENCY_BACKEND if backend is None else backend
+    if backend == "spectral":
+        return spectralData(time, angle)
+    if backend != "spline":
+        raise Exception("Unknown frequency backend: " + str(backend))
 
     # Init. data
     interpPart = 15
@@ -189,46 +491,11 @@ def angleData(time, angle):
     # Filter roots
     noiseHDist = dist*interpPart
     noiseVDist = noiseHDist*time[-1]/np.abs(np.max(y)-np.min(y))
-    relativeP = []
-    noiseP = []
-
-    if rootsd[0] >= x[0]:  # first root
-        if (np.abs(rootsd[0]-rootsd[1]) > noiseHDist) or (np.abs(cs(rootsd[0])-cs(rootsd[1])) > noiseVDist):
-            # Append valid root
-            relativeP.append(rootsd[0])
-        else:
-            # Save noise
-            noiseP.append(rootsd[0])
-
-    for i in range(1, len(rootsd)-1):  # mid roots
-            if (np.abs(rootsd[i]-rootsd[i+1]) > noiseHDist) or (np.abs(cs(rootsd[0])-cs(rootsd[1])) > noiseVDist):
-                if (len(noiseP) == 0 ): 
-                    # Append valid root
-                    relativeP.append(rootsd[i])
-                elif (len(noiseP)%2 == 0):
-                    # Append median of the noise roots
-                    noiseP.append(rootsd[i])
-                    relativeP.append(np.median(noiseP))
-                # Restart noise points 
-                noiseP = []
-            else:
-                # Save noise
-                noiseP.append(rootsd[i])
-
-    if rootsd[-1] <= x[-1]:  # last root
-        if len(noiseP) == 0:
-            # Append valid root
-            relativeP.append(rootsd[-1])
-        else:
-            # Append median of the noise roots
-            noiseP.append(rootsd[-1])
-            relativeP.append(np.median(noiseP))
+    relativeP = relativePoints(cs, rootsd, x[0], x[-1], noiseHDist, noiseVDist)
 
     # Compute mean data
-    amp = np.zeros(len(relativeP)-1, float)
-    for i in range(1, len(relativeP)):
-        amp[i-1] = np.abs(cs(relativeP[i])-cs(relativeP[i-1]))/2
-    
+    amp = np.abs(np.diff(cs(relativeP)))/2
+
     meanAmp = np.mean(amp)
     freq = (int((len(relativeP)-1)/2) * 1000)/time[-1]
 
@@ -247,32 +514,323 @@ def angleData(time, angle):
     return meanAmp, freq
 
 
-def exportData(time, headP, jointP, torsionP, tailP, alpha, beta, gamma, aData, exportPath, expID, nValidFrames, fps, contrast, failedFrames):
+def spectralData(time, angle, amplitude=None, band=0.5):
+
+    # Mean amplitude and frequency of the angle from the peak of the spectrum of the smoothed angle (Hann window,
+    # FFT zero padded to twice the length), its frequency interpolated between the bins with a parabola of the log
+    # magnitudes. The amplitude (config.SPECTRAL_AMPLITUDE if None) is the one of the sinusoid of the peak ("peak")
+    # or the RMS of the band [1-band, 1+band]*freq as a sinusoid amplitude ("rms"). It costs O(N log N).
+    # The series shorter than the smoothing kernel or than 8 points of the time grid are NaN.
+    amplitude = config.SPECTRAL_AMPLITUDE if amplitude is None else amplitude
+    kerPts = SPECTRAL_MIN_FRAMES
+    if len(time) < kerPts:
+        return np.nan, np.nan
+
+    # Time grid of the frames
+    step = np.median(np.diff(time))
+    nPoints = int(round((time[-1]-time[0])/step)) + 1
+    if nPoints < 8:
+        return np.nan, np.nan
+
+    # Smooth angle data
+    ker = np.ones(kerPts)/kerPts
+    smoothAngle = np.convolve(angle, ker, mode='same')
+
+    # Resample on the regular time grid if there are failed frames
+    grid = time[0] + step*np.arange(nPoints)
+    if (nPoints != len(time)) or not np.allclose(grid, time):
+        smoothAngle = np.interp(grid, time, smoothAngle)
+
+    # Spectrum of the angle without its mean
+    window = np.hanning(nPoints)
+    nfft = fastLength(2*nPoints)
+    spectrum = np.abs(np.fft.rfft((smoothAngle - np.mean(smoothAngle))*window, nfft))
+
+    # Peak (without the DC bin) and its interpolated position/magnitude
+    peak = 1 + np.argmax(spectrum[1:-1])
+    (a, b, c) = np.log(np.maximum(spectrum[peak-1:peak+2], np.finfo(float).tiny))
+    delta = 0.5*(a-c)/(a-2*b+c) if (a-2*b+c) < 0 else 0.
+    freq = 1000*(peak+delta)/(nfft*step) # time in ms
+
+    if amplitude == "peak":
+        meanAmp = 2*np.exp(b - 0.25*(a-c)*delta)/np.sum(window)
+    elif amplitude == "rms":
+        # Parseval over the one-sided band, normalized by the power of the window
+        bins = np.arange(len(spectrum))*1000/(nfft*step)
+        inBand = (bins >= (1-band)*freq) & (bins <= (1+band)*freq)
+        meanSquare = 2*np.sum(spectrum[inBand]**2)/(nfft*np.sum(window**2))
+        meanAmp = np.sqrt(2*meanSquare)
+    else:
+        raise Exception("Unknown spectral amplitude: " + str(amplitude))
+
+    return meanAmp, freq
+
 
-    # Export all the skeleton data in a cvs file
+def fastLength(n):
+
+    # Smallest 2^a*3^b*5^c length not below n, fast for the FFT of numpy
+    best = 1 << max(n-1, 0).bit_length()
+    p5 = 1
+    while p5 < best:
+        p35 = p5
+        while p35 < best:
+            # Power of two that takes p35 to n
+            best = min(best, p35 << (-(-n//p35) - 1).bit_length())
+            p35 *= 3
+        p5 *= 5
+
+    return best
+
+
+def relativePoints(cs, roots, start, end, noiseHDist, noiseVDist):
+
+    # Relative extrema of the spline among the roots of its derivative. A root closes a group of
+    # noise roots if the next root is farther than noiseHDist or its spline value differs more than noiseVDist.
+    # Each group is replaced by its median, the groups closed before the last root are dropped if they have an
+    # even number of roots. The first and the last roots are only taken inside [start, end].
+    nRoots = len(roots)
+    if nRoots < 2:
+        return roots[(roots >= start) & (roots <= end)]
+
+    values = cs(roots)
+    closes = (np.abs(np.diff(roots)) > noiseHDist) | (np.abs(np.diff(values)) > noiseVDist)
+
+    first = 0 if roots[0] >= start else 1
+    closers = np.flatnonzero(closes[first:]) + first
+    lastIn = roots[-1] <= end
+    if lastIn:
+        closers = np.append(closers, nRoots-1)
+
+    # Groups of roots [starts, closers] and their medians: middle root or mean of the two middle ones of each
+    # sorted group (the roots of the extrapolated ends of the spline can be unsorted)
+    starts = np.concatenate([[first], closers[:-1]+1])[:len(closers)].astype(int)
+    sizes = closers - starts + 1
+    keep = sizes % 2 == 1
+    if lastIn and len(keep) > 0:
+        keep[-1] = True
+
+    grouped = roots[first:first+np.sum(sizes)]
+    grouped = grouped[np.lexsort((grouped, np.repeat(np.arange(len(sizes)), sizes)))]
+    starts -= first
+    medians = (grouped[starts + (sizes-1)//2] + grouped[starts + sizes//2])/2
+
+    return medians[keep]
+
+
+def exportData(time, headP, jointP, torsionP, tailP, alpha, beta, gamma, aData, exportPath, expID, nValidFrames, fps, contrast, failedFrames,
+               backend="spline"):
+
+    # Export all the skeleton data in a single result file (named columns and the run metadata, with the
+    # backend of the frequencies/amplitudes).
+    # The csv file is generated from it on demand (see exportCsv).
+    points = (headP, jointP, torsionP, tailP)
+    columns = [("time", time)]
+    for (name, point) in zip(("Head", "Joint", "Torsion", "Tail"), points):
+        columns += [("x" + name, point[:nValidFrames, 0].astype(np.int32)), ("y" + name, point[:nValidFrames, 1].astype(np.int32))]
+    columns += [("alpha", alpha), ("beta", beta), ("gamma", gamma)]
+
+    meta = {
+        "contrast": contrast, "fps": fps, "failedFrames": failedFrames, "validFrames": int(nValidFrames),
+        "backend": backend if backend != "spectral" else backend + "-" + config.SPECTRAL_AMPLITUDE,
+        "angles": {name: {"meanAmp": float(aData[i, 0]), "freq": float(aData[i, 1])} for (i, name) in enumerate(("alpha", "beta", "gamma"))}
+    }
+    saveResult(exportPath, expID, collections.OrderedDict(columns), meta)
+
+
+def windowData(exportPath, expID, windowMs=None, overlap=None, backend=None, blockWindows=256):
+
+    # Amplitudes and frequencies of the angles in sliding windows (config.WINDOW_MS/WINDOW_OVERLAP if None), saved
+    # in the "windows" member of the result file (rows of WINDOW_DTYPE). The columns are memory mapped and read one
+    # window at a time and the rows are written by blocks, so the memory of this pass does not grow with the recording
+    # length. (The treatment before it holds the whole series, windowData can be run alone on a saved result file.)
+    # The windows with less than half of their frames (i.e. fish lost), or too few frames for the backend, are NaN.
+    backend = config.FREQUENCY_BACKEND if backend is None else backend
+    windowMs = config.WINDOW_MS if windowMs is None else windowMs
+    overlap = config.WINDOW_OVERLAP if overlap is None else overlap
+    if not (windowMs > 0 and 0 <= overlap < 1):
+        raise Exception("The window length must be positive and the overlap in [0,1).")
+    hop = windowMs*(1-overlap)
+
+    time = loadColumn(exportPath, expID, "time")
+    angles = [loadColumn(exportPath, expID, name) for name in ("alpha", "beta", "gamma")]
+
+    # Time step of the frames and number of whole windows
+    nWindows = 0
+    if len(time) > 1:
+        step = np.median(np.diff(time[:1000]))
+        span = time[-1] - time[0] + step
+        nWindows = int((span - windowMs)//hop) + 1 if span >= windowMs else 0
+        minFrames = max(windowMs/step/2, SPECTRAL_MIN_FRAMES if backend == "spectral" else 2)
+
+    def blocks():
+        block = np.zeros(blockWindows, WINDOW_DTYPE)
+        n = 0
+        for k in range(nWindows):
+            start = time[0] + k*hop
+            (first, last) = np.searchsorted(time, (start, start + windowMs))
+
+            row = block[n:n+1]
+            row["start"] = start
+            row["end"] = start + windowMs
+            row["frames"] = last - first
+            for (name, angle) in zip(("alpha", "beta", "gamma"), angles):
+                if last - first < minFrames:
+                    (amp, freq) = (np.nan, np.nan)
+                else:
+                    (amp, freq) = angleData(np.array(time[first:last]) - start, np.array(angle[first:last]), backend)
+                row[name + "Amp"] = amp
+                row[name + "Freq"] = freq
+
+            n += 1
+            if n == blockWindows:
+                yield block
+                n = 0
+        yield block[:n]
+
+    saveMember(exportPath, expID, "windows", blocks(), WINDOW_DTYPE, nWindows)
+    logging.info(str(nWindows) + " windows of " + str(windowMs) + " ms saved in the result file.")
+
+    return nWindows
+
+
+def exportCsv(exportPath, expID, chunkRows=8192):
+
+    # Export all the skeleton data of the result file in a cvs file, reading the memory mapped columns by chunks
+    meta = loadMeta(exportPath, expID)
     dataHeader = "Time(ms), x_Head, y_Head, x_Joint, y_Joint, x_Torsion, y_Torsion, x_Tail, y_Tail, AngleAlpha(dg), AngleBeta(dg), AngleGamma(dg)"
-    data = np.transpose([time, headP[:nValidFrames, 0], headP[:nValidFrames, 1], jointP[:nValidFrames, 0], jointP[:nValidFrames, 1],
-                         torsionP[:nValidFrames, 0], torsionP[:nValidFrames, 1], tailP[:nValidFrames, 0], tailP[:nValidFrames, 1], alpha, beta, gamma])
-    np.savetxt(pathlib.Path(exportPath,expID,expID + ".csv"), data, fmt="%10.5f", delimiter=',', header=dataHeader, comments="")
-    
+    columns = [loadColumn(exportPath, expID, column) for column in RESULT_COLUMNS]
+
+    writer = CsvWriter(pathlib.Path(exportPath, expID, expID + ".csv"), dataHeader, len(columns), chunkRows=chunkRows)
+    for i in range(0, len(columns[0]), chunkRows):
+        writer.append(np.stack([column[i:i+chunkRows] for column in columns], 1))
+
     # Append the freq./initial-conditions to the csv file
-    with open(pathlib.Path(exportPath, expID, expID + ".csv"), 'a') as f:
-        w = csv.writer(f)
-        w.writerow([None])
-        w.writerow([None, "MeanAmp", "Freq(Hz)"])
-        w.writerow(["Alpha", aData[0, 0], aData[0, 1]])
-        w.writerow(["Beta", aData[1, 0], aData[1, 1]])
-        w.writerow(["Gamma", aData[2, 0], aData[2, 1]])
+    angles = meta["angles"]
+    writer.writeRows([
+        [None],
+        [None, "MeanAmp", "Freq(Hz)"],
+        ["Alpha", angles["alpha"]["meanAmp"], angles["alpha"]["freq"]],
+        ["Beta", angles["beta"]["meanAmp"], angles["beta"]["freq"]],
+        ["Gamma", angles["gamma"]["meanAmp"], angles["gamma"]["freq"]],
+        [None],
+        ["Contrast", "Fps", "Failed Frames"],
+        [meta["contrast"], meta["fps"], meta["failedFrames"]]
+    ])
+    writer.close()
+
+
+class CsvWriter:
+
+    # Writer of the csv file of the treated data with the same bytes as np.savetxt("%10.5f", ',' delimiter,
+    # header without comments) followed by rows of the csv module. The table rows can be appended as they
+    # are computed, they are formatted in blocks of chunkRows at once (see formatRows).
+
+    def __init__(self, path, header, nColumns, width=10, decimals=5, chunkRows=8192):
+        self.nColumns = nColumns
+        self.width = width
+        self.decimals = decimals
+        self.chunkRows = chunkRows
+
+        # Text mode, as np.savetxt and the csv module write the file
+        self.file = open(str(path), "w")
+        self.file.write(header + "\n")
+
+    def append(self, rows):
+        rows = np.reshape(np.asarray(rows, float), (-1, self.nColumns))
+        for i in range(0, len(rows), self.chunkRows):
+            self.file.write(formatRows(rows[i:i+self.chunkRows], self.width, self.decimals))
+
+    def writeRows(self, rows):
+        csv.writer(self.file).writerows(rows)
+
+    def close(self):
+        self.file.close()
+
+
+def formatRows(rows, width=10, decimals=5):
+
+    # Text of the rows as ("%{width}.{decimals}f," * nColumns) lines, built as a matrix of characters.
+    # The values are rounded to integers of 10^-decimals units. The rows with a value whose rounding can differ
+    # from the printf one (too close to a tie for the float64 precision, i.e. the exact ties), not finite or too big
+    # are formatted with the % operator.
+    (nRows, nColumns) = np.shape(rows)
+    if nRows == 0:
+        return ""
+    rowFormat = ",".join(["%" + str(width) + "." + str(decimals) + "f"]*nColumns) + "\n"
+    scale = 10**decimals
+
+    scaled = np.abs(rows)*scale
+    with np.errstate(invalid="ignore"):
+        frac = scaled - np.floor(scaled)
+        exact = np.isfinite(scaled) & (scaled < 2.**52) & (np.abs(frac - 0.5) > scaled*2.**-50)
+    slowRows = np.flatnonzero(~np.all(exact, axis=1))
+
+    units = np.rint(np.where(exact, scaled, 0.)).astype(np.int64)
+    negative = np.signbit(rows) & exact
+    intPart = units // scale
+    fracPart = units - intPart*scale
+
+    # Number of digits of the integer part and length of each field (right aligned in width)
+    intDigits = np.ones((nRows, nColumns), np.int8)
+    power = 10
+    while np.any(intPart >= power):
+        intDigits += intPart >= power
+        power *= 10
+    fieldLen = np.maximum(intDigits + 1 + decimals + negative, width)
+    fieldWidth = int(np.max(fieldLen))
+
+    # Character planes of the fields (plane p: character p of all the fields, followed by the delimiter/newline).
+    # The digits are computed one plane at a time, in 32 bits when they fit (d = a - 10*(a//10), faster than
+    # a % 10). Before the first digit of the integer part there are the sign and blanks.
+    planes = np.full((fieldWidth + 1, nRows, nColumns), ord(" "), np.uint8)
+    pointPos = fieldWidth - decimals - 1
+
+    fracPart = fracPart.astype(np.int32)
+    for p in range(fieldWidth-1, pointPos, -1):
+        quotient = fracPart // 10
+        np.add(fracPart - quotient*10, ord("0"), out=planes[p], casting="unsafe")
+        fracPart = quotient
+    planes[pointPos] = ord(".")
+
+    intPart = intPart.astype(np.int32) if power <= 10**9 else intPart
+    for k in range(min(int(np.max(intDigits)) + 1, pointPos)):
+        plane = planes[pointPos-1-k]
+        quotient = intPart // 10
+        if k == 0:
+            np.add(intPart - quotient*10, ord("0"), out=plane, casting="unsafe")
+        else:
+            np.copyto(plane, intPart - quotient*10 + ord("0"), casting="unsafe", where=intPart > 0)
+            plane[negative & (intDigits == k)] = ord("-")
+        intPart = quotient
+
+    planes[fieldWidth] = ord(",")
+    planes[fieldWidth, :, -1] = ord("\n")
+    chars = np.ascontiguousarray(np.moveaxis(planes, 0, 2))
+
+    # Drop the extra blanks of the fields shorter than the widest one (by column if their length is the same in all the rows)
+    extra = fieldWidth - fieldLen
+    if len(slowRows) == 0 and np.all(extra == extra[0]):
+        return np.concatenate([chars[:, j, extra[0, j]:] for j in range(nColumns)], 1).tobytes().decode("ascii")
+
+    chars = chars.reshape(nRows, -1)
+    keep = np.arange(fieldWidth + 1) >= extra[:, :, None]
+    keep = keep.reshape(nRows, -1)
+    keep[slowRows] = False
+    text = chars[keep].tobytes().decode("ascii")
+
+    if len(slowRows) == 0:
+        return text
 
-        w.writerow([None])
-        w.writerow(["Contrast", "Fps", "Failed Frames"])
-        w.writerow([contrast, fps, failedFrames])
+    # Insert the rows formatted with the % operator
+    offsets = np.concatenate([[0], np.cumsum(np.count_nonzero(keep, axis=1))])
+    parts = []
+    start = 0
+    for i in slowRows:
+        parts += [text[start:offsets[i]], rowFormat % tuple(rows[i].tolist())]
+        start = offsets[i]
+    parts.append(text[start:])
 
-    # Export the data in npy files to show faster in showData
-    np.save(pathlib.Path(exportPath, expID, "data", expID + "_time"), time)
-    np.save(pathlib.Path(exportPath, expID, "data", expID + "_alpha"), alpha)
-    np.save(pathlib.Path(exportPath, expID, "data", expID + "_beta"), beta)
-    np.save(pathlib.Path(exportPath, expID, "data", expID + "_gamma"), gamma)
+    return "".join(parts)
 
 
 if __name__ == "__main__":
@@ -288,6 +846,6 @@ if __name__ == "__main__":
     contrast = "dunno"
     failedFrames = "dunno"
 
-    treatData(exportPath, expID, fps, contrast, failedFrames)
+    treatData(exportPath, expID, fps, contrast, failedFrames, writeCsv=True)
     
     logging.info("DONE.")
@@ -1,6 +1,7 @@
 # General libs
 import pathlib
 import logging
+import threading
 import numpy as np
 import cv2 as cv
 from PyQt5 import QtCore, QtWidgets, QtGui
@@ -12,7 +13,8 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg, NavigationToolbar2QT
 
 # Import project libs
-from swimTunnel import swimTunnel
+import config
+from swimTunnel import swimTunnel, selectContrast
 from treatData import treatData
 from showData import showData
 from models import zebraGait_ui, showWindow_ui, resources_rc
@@ -86,9 +88,12 @@ class MainWindow(QtWidgets.QMainWindow, zebraGait_ui.Ui_zebraGait):
             # Run the process in a thread
             self.sendmsg("Select the ROI...")
             self.roi = self.getRoi(self.videoPath)
-            self.runProc = RunProcessThread(self.videoPath, self.exportPath, self.expID, self.fps, self.roi)
+            self.sendmsg("Select the contrast...")
+            self.contrast = selectContrast(self.videoPath, self.roi)
+            self.runProc = RunProcessThread(self.videoPath, self.exportPath, self.expID, self.fps, self.roi, self.contrast)
             self.runProc.done.connect(self.done)
             self.runProc.msg.connect(self.sendmsg)
+            self.runProc.progress.connect(self.updateProgress)
             self.runProc.aborted.connect(self.aborted)
             self.runProc.start()
         except Exception as err:
@@ -107,6 +112,16 @@ class MainWindow(QtWidgets.QMainWindow, zebraGait_ui.Ui_zebraGait):
     
     def sendmsg(self, msg):
         self.progressLabel.setText(msg)
+
+    def updateProgress(self, numFrame, totalFrames):
+        self.progressBar.setMaximum(totalFrames)
+        self.progressBar.setValue(numFrame)
+
+    def closeEvent(self, event):
+        # Abort a running extraction before closing
+        if hasattr(self, "runProc") and self.runProc.isRunning():
+            self.runProc.cancel.set()
+        event.accept()
     
     def check(self):
         importPath = self.savePathLineEdit.text()
@@ -118,6 +133,7 @@ class MainWindow(QtWidgets.QMainWindow, zebraGait_ui.Ui_zebraGait):
     def enabledControls(self, status):
         if status:
             self.progressBar.setMaximum(10)
+            self.progressBar.reset()
             self.progressLabel.setText("Ready")
         elif not status:
             self.progressBar.setMaximum(0)
@@ -236,14 +252,18 @@ class RunProcessThread(QtCore.QThread):
     aborted = QtCore.pyqtSignal(str)
     done = QtCore.pyqtSignal()
     msg = QtCore.pyqtSignal(str)
+    progress = QtCore.pyqtSignal(int, int)
 
-    def __init__(self, videoPath, exportPath, expID, fps, roi):
+    def __init__(self, videoPath, exportPath, expID, fps, roi, contrast):
         QtCore.QThread.__init__(self)
         self.videoPath = videoPath
         self.exportPath = exportPath
         self.expID = expID
         self.fps = fps
         self.roi = roi
+        self.contrast = contrast
+        self.cancel = threading.Event()
+        self.percent = -1
 
     def __del__(self):
         self.wait()
@@ -252,13 +272,24 @@ class RunProcessThread(QtCore.QThread):
         # Run the swimtunnel and the treat data
         try:
             self.msg.emit("Extracting the data...")
-            self.failedFrames, self.contrast = swimTunnel(self.videoPath, self.exportPath, self.expID, self.fps, self.roi)
-            self.msg.emit("Treating data...")
-            treatData(self.exportPath, self.expID, self.fps, self.contrast , self.failedFrames)
+            self.failedFrames, self.contrast = swimTunnel(self.videoPath, self.exportPath, self.expID, self.fps, self.roi,
+                                                          contrast=self.contrast, headless=True, progress=self.emitProgress, cancel=self.cancel,
+                                                          writeCsv=True)
+            if not config.STREAMING_TREATMENT:
+                self.msg.emit("Treating data...")
+                self.progress.emit(0, 0)
+                treatData(self.exportPath, self.expID, self.fps, self.contrast , self.failedFrames, writeCsv=True)
             self.done.emit()
         except Exception as err:
             self.aborted.emit(str(err))
 
+    def emitProgress(self, numFrame, totalFrames):
+        # It emits the extraction progress only when the percentage changes (a signal per frame floods the event loop).
+        percent = int(100*numFrame/totalFrames) if totalFrames > 0 else 0
+        if percent != self.percent:
+            self.percent = percent
+            self.progress.emit(numFrame, totalFrames)
+
 
 if __name__ == "__main__":
 
@@ -1,7 +1,7 @@
 # General libs
 import logging
 import pathlib
-from threading import Thread
+from threading import Event, Thread
 import tkinter as tk
 from tkinter import filedialog, ttk
 import PIL.Image
@@ -16,7 +16,8 @@ import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 
 # Import own libs
-from swimTunnel import swimTunnel
+import config
+from swimTunnel import swimTunnel, selectRoi, selectContrast
 from treatData import treatData
 from showData import showData
 
@@ -42,6 +43,10 @@ class MainWindow:
         self.master=master
         self.master.title("Swim Tunnel")
         master.resizable(width=False, height=False)
+        master.protocol("WM_DELETE_WINDOW", self.clickClose)
+
+        # Cancel token of the running extraction
+        self.cancel = Event()
 
         # # Icon
         # self.img = tk.PhotoImage(file=pathlib.Path("./models/icons/gar-fish.png"))
@@ -105,6 +110,10 @@ class MainWindow:
         self.lblStatus = tk.Label(self.btnFrame, text="Ready", width=28, anchor=tk.W)
         self.lblStatus.grid(column=1, row=0, sticky=tk.W, padx=5, pady=5)
 
+        # Cancel button (only enabled while the video is processed)
+        self.btnCancel = tk.Button(self.btnFrame, text="Cancel", width=5, command=self.clickCancel, state="disable")
+        self.btnCancel.grid(column=2, row=0, sticky=tk.E, padx=5, pady=5)
+
         # Run button
         self.btnRun = tk.Button(self.btnFrame, text="Run", width=5, command=self.clickRun)
         self.btnRun.grid(column=4, row=0, sticky=tk.E, padx=5, pady=5)
@@ -141,11 +150,23 @@ class MainWindow:
                             logging.StreamHandler()]
                 )
 
+                # Select the region of interest and the contrast
+                self.lblStatus.config(text = "Select the ROI and the contrast...")
+                roi = selectRoi(videoPath)
+                contrast = selectContrast(videoPath, roi)
+
                 # Run computations
                 self.lblStatus.config(text = "Processing the video...")
-                failedFrames, contrast = swimTunnel(videoPath, exportPath, expID, fps)
-                self.lblStatus.config(text = "Computing the data...")
-                treatData(exportPath, expID, fps, contrast , failedFrames)
+                self.cancel.clear()
+                self.btnCancel.configure(state="normal")
+                try:
+                    failedFrames, contrast = swimTunnel(videoPath, exportPath, expID, fps, roi, contrast=contrast, headless=True, progress=self.showProgress,
+                                                        cancel=self.cancel, writeCsv=True)
+                finally:
+                    self.btnCancel.configure(state="disable")
+                if not config.STREAMING_TREATMENT:
+                    self.lblStatus.config(text = "Computing the data...")
+                    treatData(exportPath, expID, fps, contrast , failedFrames, writeCsv=True)
             else:
                 raise Exception("The fps value must be in [1,1000].")
         except Exception as err:
@@ -159,6 +180,12 @@ class MainWindow:
             self.lblStatus.config(text="Done. Check the results or select a new video.")
             self.btnShow.configure(state="normal")
 
+    def showProgress(self, numFrame, totalFrames):
+        # It shows the extraction progress in the status label, only when the percentage changes.
+        percent = int(100*numFrame/totalFrames)
+        if percent != int(100*(numFrame-1)/totalFrames):
+            self.lblStatus.config(text = "Processing the video... " + str(percent) + "%")
+
     def showResults(self):
         # It shows the data in the export folder.
         try:
@@ -198,6 +225,16 @@ class MainWindow:
 
             self.iniSavePath = pathlib.Path(fileSavePath) # remember the last opened path
 
+    def clickCancel(self):
+        # Abort the running extraction (at the next frame)
+        self.cancel.set()
+        self.lblStatus.config(text = "Cancelling...")
+
+    def clickClose(self):
+        # Abort a running extraction before closing
+        self.cancel.set()
+        self.master.destroy()
+
     def clickRun(self):
         self.run_thread("run", self.runProcess)
 